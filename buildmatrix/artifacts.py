@@ -0,0 +1,383 @@
+# Copyright (c) <2015-2016>, Eric Dill
+#
+# All rights reserved.  Redistribution and use in source and binary forms, with
+# or without modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Content addressed stores of built packages, so that a variant whose inputs
+have not changed is restored instead of built again. There is a store on
+local disk, and caches that several machines can share.
+"""
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+try:
+    from http.client import HTTPException
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError, URLError
+except ImportError:
+    # python 2
+    from httplib import HTTPException
+    from urllib2 import Request, urlopen, HTTPError, URLError
+
+from .cache import atomic_write
+from .index import local_channel_path
+
+logger = logging.getLogger('buildmatrix.artifacts')
+
+DEFAULT_STORE_SIZE = 20 * 1024  # MB
+DEFAULT_STORE_AGE = 30 * 24 * 60 * 60  # seconds
+ENTRY_FILE = 'entry.json'
+# what moving a package to or from a cache can fail with: the disk, the
+# network (URLError, socket timeouts), or a server that hangs up half way
+# through (IncompleteRead, BadStatusLine)
+TRANSFER_ERRORS = (IOError, OSError, HTTPException)
+
+
+def place(src, dest):
+    """Put a copy of `src` at `dest` without anybody seeing half a file
+
+    Always a copy, never a hard link: conda build writes a package over the
+    existing file in conda-bld when the same build is made again, which
+    would change the other copy too.
+
+    Parameters
+    ----------
+    src, dest : str
+    """
+    dirname = os.path.dirname(dest)
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # somebody else made it first
+            if not os.path.isdir(dirname):
+                raise
+    tmp = os.path.join(dirname, '.tmp-{}-{}'.format(os.getpid(),
+                                                   os.path.basename(dest)))
+    try:
+        shutil.copy2(src, tmp)
+        try:
+            os.rename(tmp, dest)
+        except OSError:
+            # windows will not rename over an existing file
+            os.remove(dest)
+            os.rename(tmp, dest)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+class ArtifactStore(object):
+    """Built packages on local disk, filed under a hash of their inputs
+
+    Each entry is a folder named after the key that holds the package and an
+    entry.json. The folder's modification time is bumped whenever the entry
+    is used, and the least recently used entries are evicted once the store
+    is bigger than `max_size`. Entries that have not been used for `max_age`
+    seconds are evicted too.
+
+    Parameters
+    ----------
+    store_dir : str
+    max_size : int, optional
+        Megabytes the store may take up. None for no limit. Defaults to 20G
+    max_age : float, optional
+        Seconds an unused entry is kept for. None for no limit. Defaults to
+        30 days
+    """
+    def __init__(self, store_dir, max_size=DEFAULT_STORE_SIZE,
+                 max_age=DEFAULT_STORE_AGE):
+        self.store_dir = store_dir
+        self.max_size = max_size
+        self.max_age = max_age
+
+    def __repr__(self):
+        return 'ArtifactStore({!r})'.format(self.store_dir)
+
+    def _entry_dir(self, key):
+        return os.path.join(self.store_dir, key[:2], key)
+
+    def get(self, key, dest):
+        """Restore the package stored under `key` to `dest`
+
+        Returns
+        -------
+        bool
+            False if `key` is not in the store
+        """
+        entry_dir = self._entry_dir(key)
+        try:
+            with open(os.path.join(entry_dir, ENTRY_FILE)) as f:
+                entry = json.load(f)
+            place(os.path.join(entry_dir, entry['file_name']), dest)
+        except (IOError, OSError, ValueError, KeyError):
+            return False
+        try:
+            os.utime(entry_dir, None)
+        except OSError:
+            # evicted by somebody else in the meantime. We got it anyway
+            pass
+        return True
+
+    def put(self, key, path):
+        """Store the package at `path` under `key` and evict old entries"""
+        entry_dir = self._entry_dir(key)
+        file_name = os.path.basename(path)
+        place(path, os.path.join(entry_dir, file_name))
+        # the entry file goes last, so an entry without one is incomplete
+        entry = {'file_name': file_name, 'stored': time.time()}
+        atomic_write(os.path.join(entry_dir, ENTRY_FILE),
+                     json.dumps(entry).encode('utf-8'))
+        self.evict()
+
+    def entries(self):
+        """(last used, bytes, folder) of every entry, oldest first"""
+        entries = []
+        try:
+            prefixes = os.listdir(self.store_dir)
+        except OSError:
+            return entries
+        for prefix in prefixes:
+            prefix_dir = os.path.join(self.store_dir, prefix)
+            try:
+                keys = os.listdir(prefix_dir)
+            except OSError:
+                continue
+            for key in keys:
+                entry_dir = os.path.join(prefix_dir, key)
+                try:
+                    size = sum(os.path.getsize(os.path.join(entry_dir, name))
+                               for name in os.listdir(entry_dir))
+                    entries.append((os.path.getmtime(entry_dir), size,
+                                    entry_dir))
+                except OSError:
+                    continue
+        entries.sort()
+        return entries
+
+    def evict(self):
+        """Remove the entries that are too old or that do not fit"""
+        if self.max_size is None and self.max_age is None:
+            return
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        limit = float('inf')
+        if self.max_size is not None:
+            limit = self.max_size * 1024 * 1024
+        oldest = 0
+        if self.max_age is not None:
+            oldest = time.time() - self.max_age
+        for mtime, size, entry_dir in entries:
+            if total <= limit and mtime >= oldest:
+                break
+            logger.debug('Evicting %s from the artifact store', entry_dir)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+
+
+class HTTPArtifactCache(object):
+    """An artifact cache on a web server that takes GET and PUT
+
+    The layout is the same as an `ArtifactStore`, so a folder that one is
+    kept in can be served as is. Eviction is left to the server.
+
+    Parameters
+    ----------
+    url : str
+    timeout : float, optional
+        Seconds to wait on the server. Defaults to 60
+    """
+    def __init__(self, url, timeout=60):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def __repr__(self):
+        return 'HTTPArtifactCache({!r})'.format(self.url)
+
+    def _url(self, key, name):
+        return '/'.join([self.url, key[:2], key, name])
+
+    def get(self, key, dest):
+        """Download the package stored under `key` to `dest`
+
+        Returns
+        -------
+        bool
+            False if `key` is not in the cache, or the download failed
+        """
+        try:
+            response = urlopen(self._url(key, ENTRY_FILE),
+                               timeout=self.timeout)
+            try:
+                entry = json.loads(response.read().decode('utf-8'))
+            finally:
+                response.close()
+            response = urlopen(self._url(key, entry['file_name']),
+                               timeout=self.timeout)
+        except HTTPError as e:
+            if e.code != 404:
+                logger.warning('Could not look up %s in %s: %s', key,
+                               self.url, e)
+            return False
+        except (URLError, IOError, ValueError, KeyError) as e:
+            logger.warning('Could not look up %s in %s: %s', key, self.url,
+                           e)
+            return False
+        try:
+            self._download(response, dest)
+        except TRANSFER_ERRORS as e:
+            # a timeout or a connection that dropped half way through
+            # (IncompleteRead). The package just gets built
+            logger.warning('Could not download %s from %s: %s', key,
+                           self.url, e)
+            return False
+        finally:
+            response.close()
+        return True
+
+    def _download(self, response, dest):
+        dirname = os.path.dirname(dest)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # somebody else made it first
+                if not os.path.isdir(dirname):
+                    raise
+        fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                shutil.copyfileobj(response, f)
+            place(tmp, dest)
+        finally:
+            os.remove(tmp)
+
+    def _put(self, url, data, length):
+        request = Request(url, data=data)
+        request.add_header('Content-Length', str(length))
+        request.add_header('Content-Type', 'application/octet-stream')
+        # Request(method=...) is python 3 only
+        request.get_method = lambda: 'PUT'
+        urlopen(request, timeout=self.timeout).read()
+
+    def put(self, key, path):
+        """Upload the package at `path` under `key`"""
+        file_name = os.path.basename(path)
+        with open(path, 'rb') as f:
+            self._put(self._url(key, file_name), f, os.path.getsize(path))
+        # the entry goes last, so nobody sees an entry without its package
+        entry = json.dumps({'file_name': file_name,
+                            'stored': time.time()}).encode('utf-8')
+        self._put(self._url(key, ENTRY_FILE), entry, len(entry))
+
+
+def remote_artifact_cache(location, timeout=60):
+    """The shared artifact cache at `location`
+
+    Parameters
+    ----------
+    location : str
+        An http(s):// url, or a file:// url or path of a folder that the
+        machines sharing the cache can all see
+    timeout : float, optional
+        Seconds to wait on an http server
+
+    Returns
+    -------
+    HTTPArtifactCache or ArtifactStore
+    """
+    if location.startswith(('http://', 'https://')):
+        return HTTPArtifactCache(location, timeout=timeout)
+    path = local_channel_path(location) or os.path.abspath(location)
+    # every machine sharing the folder evicting from it would be a mess
+    return ArtifactStore(path, max_size=None, max_age=None)
+
+
+class TieredArtifactCache(object):
+    """A local artifact store in front of a shared cache
+
+    Lookups try the local store first. Packages that come from the shared
+    cache are kept in the local store too, and new packages go to both.
+
+    Parameters
+    ----------
+    local : ArtifactStore or None
+    remote : HTTPArtifactCache or ArtifactStore
+    push : bool, optional
+        False: Only read from `remote`. Defaults to True
+    """
+    def __init__(self, local, remote, push=True):
+        self.local = local
+        self.remote = remote
+        self.push = push
+
+    def __repr__(self):
+        return 'TieredArtifactCache({!r}, {!r})'.format(self.local,
+                                                       self.remote)
+
+    def get(self, key, dest):
+        """Restore the package stored under `key` to `dest`
+
+        Returns
+        -------
+        bool
+            False if `key` is in neither cache, or could not be restored
+        """
+        if self.local is not None and self.local.get(key, dest):
+            return True
+        if not self.remote.get(key, dest):
+            return False
+        if self.local is not None:
+            try:
+                self.local.put(key, dest)
+            except (IOError, OSError) as e:
+                # a full disk, say. Rather than stop the run, build it
+                logger.warning('Could not keep %s in %r: %s', dest,
+                               self.local, e)
+                return False
+        return True
+
+    def put(self, key, path):
+        """Store the package at `path` under `key` in both caches
+
+        Not being able to reach the shared cache is not an error
+        """
+        if self.local is not None:
+            self.local.put(key, path)
+        if not self.push:
+            return
+        try:
+            self.remote.put(key, path)
+        except TRANSFER_ERRORS as e:
+            logger.warning('Could not push %s to %r: %s', path, self.remote,
+                           e)
@@ -0,0 +1,369 @@
+# Copyright (c) <2015-2016>, Eric Dill
+#
+# All rights reserved.  Redistribution and use in source and binary forms, with
+# or without modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+On-disk caches that let buildmatrix skip work it has already done on a
+previous run.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+
+logger = logging.getLogger('buildmatrix.cache')
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache',
+                                 'buildmatrix')
+DEFAULT_BUILD_NAME_CACHE_SIZE = 10000
+
+
+def atomic_write(path, data):
+    """Write `data` to `path` so that readers never see a partial file
+
+    Parameters
+    ----------
+    path : str
+    data : bytes
+    """
+    dirname = os.path.dirname(path)
+    if not os.path.exists(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # somebody else made it first
+            if not os.path.isdir(dirname):
+                raise
+    fd, tmp = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # windows will not rename over an existing file
+            os.remove(path)
+            os.rename(tmp, path)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+
+
+def hash_recipe_dir(recipe_dir):
+    """Hash the names and contents of every file in a recipe folder
+
+    Parameters
+    ----------
+    recipe_dir : str
+
+    Returns
+    -------
+    str
+        The hex digest. It changes whenever a file in the recipe is added,
+        removed, renamed or edited.
+    """
+    sha = hashlib.sha256()
+    for root, dirs, files in os.walk(recipe_dir):
+        # walk in a stable order and ignore vcs folders
+        dirs[:] = sorted(d for d in dirs if d not in ('.git', '.hg', '.svn'))
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            relpath = os.path.relpath(path, recipe_dir).replace(os.sep, '/')
+            sha.update(relpath.encode('utf-8'))
+            sha.update(b'\0')
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(65536), b''):
+                    sha.update(chunk)
+            sha.update(b'\0')
+    return sha.hexdigest()
+
+
+def hash_key(**parts):
+    """Hash some json-able keyword arguments into a stable cache key"""
+    blob = json.dumps(parts, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(blob).hexdigest()
+
+
+class BuildNameCache(object):
+    """Persistent cache of `determine_build_name` results
+
+    One json file is stored per entry so that several buildmatrix processes
+    can share the cache without a lock. The modification time of an entry is
+    bumped whenever it is read, and once there are more than `max_entries`
+    the least recently used entries are removed. The entries are only
+    counted once per instance; after that `put` keeps a running count and
+    only lists the folder again when the count goes over `max_entries`.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Folder to keep the entries in
+    max_entries : int, optional
+        Maximum number of entries to keep. Defaults to 10000
+    """
+    def __init__(self, cache_dir, max_entries=DEFAULT_BUILD_NAME_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        # entries in `cache_dir`, as far as this instance knows
+        self._count = None
+
+    def key(self, recipe_hash, recipe_dir, python, numpy, conda_npy,
+            conda_build_version, croot=None):
+        """Compute the cache key for one variant of a recipe
+
+        Parameters
+        ----------
+        recipe_hash : str
+            Output of `hash_recipe_dir`
+        recipe_dir : str
+            Where the recipe lives. It ends up in the build command, so the
+            same recipe in a different checkout gets its own entry
+        python, numpy, conda_npy : str
+            The variant being rendered
+        conda_build_version : str
+        croot : str, optional
+            The conda-bld folder that the packages are built into. It ends
+            up in the cached path, so a run with another conda-bld folder
+            gets its own entry
+
+        Returns
+        -------
+        str
+        """
+        return hash_key(recipe_hash=recipe_hash, recipe_dir=recipe_dir,
+                        python=python, numpy=numpy, CONDA_NPY=conda_npy,
+                        conda_build=conda_build_version, croot=croot)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def get(self, key):
+        """Look up a cached (path, build_cmd) tuple
+
+        Returns
+        -------
+        tuple or None
+            None if `key` is not in the cache
+        """
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        try:
+            os.utime(path, None)
+        except OSError:
+            # evicted by somebody else in the meantime. Still a hit.
+            pass
+        return entry['path'], entry['build_cmd']
+
+    def put(self, key, value):
+        """Store a (path, build_cmd) tuple and evict old entries if needed"""
+        path, build_cmd = value
+        data = json.dumps({'path': path, 'build_cmd': build_cmd})
+        if self._count is None:
+            self._count = len(self._entry_names())
+        if not os.path.exists(self._path(key)):
+            self._count += 1
+        atomic_write(self._path(key), data.encode('utf-8'))
+        if self._count > self.max_entries:
+            self.evict()
+
+    def _entry_names(self):
+        try:
+            return [name for name in os.listdir(self.cache_dir)
+                    if name.endswith('.json')]
+        except OSError:
+            return []
+
+    def evict(self):
+        """Remove the least recently used entries beyond `max_entries`"""
+        names = self._entry_names()
+        self._count = len(names)
+        if len(names) <= self.max_entries:
+            return
+        entries = []
+        for name in names:
+            path = os.path.join(self.cache_dir, name)
+            try:
+                entries.append((os.path.getmtime(path), path))
+            except OSError:
+                continue
+        entries.sort()
+        for mtime, path in entries[:len(entries) - self.max_entries]:
+            logger.debug('Evicting %s from the build name cache', path)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self._count = min(self._count, self.max_entries)
+
+
+class BuildHistory(object):
+    """How long builds took on previous runs
+
+    Durations are kept per package name, python and numpy version (not per
+    package version, so a version bump does not lose the history) as an
+    exponentially weighted average, in a single json file.
+
+    Parameters
+    ----------
+    path : str
+        The json file to keep the durations in
+    smoothing : float, optional
+        Weight of the newest duration in the average. Defaults to 0.5
+    """
+    def __init__(self, path, smoothing=0.5):
+        self.path = path
+        self.smoothing = smoothing
+        try:
+            with open(path) as f:
+                self.durations = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.durations = {}
+
+    @staticmethod
+    def key(name, python, numpy):
+        """The key that the durations of one variant are kept under"""
+        return '{} py{} np{}'.format(name, python, numpy)
+
+    def get(self, key, default=None):
+        """Average seconds that `key` took to build, or `default`"""
+        return self.durations.get(key, default)
+
+    def record(self, key, seconds):
+        """Fold a new build duration into the average for `key`"""
+        old = self.durations.get(key)
+        if old is None:
+            self.durations[key] = seconds
+        else:
+            self.durations[key] = (self.smoothing * seconds +
+                                   (1 - self.smoothing) * old)
+
+    def save(self):
+        """Write the durations to `path`"""
+        atomic_write(self.path, json.dumps(self.durations, indent=1,
+                                           sort_keys=True).encode('utf-8'))
+
+
+class Checkpoint(object):
+    """Where a run is up to, so that a run that died can be resumed
+
+    The file is json lines. The first line holds the plan of the run and a
+    key that says which recipes and options it was made for. Every later
+    line records a variant moving to a new state, so that saving progress
+    is an append of one line instead of a rewrite of the whole file. A line
+    that was cut short by a crash is ignored.
+
+    Parameters
+    ----------
+    path : str
+        The checkpoint file
+    """
+    PLANNED = 'planned'
+    BUILDING = 'building'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+    SKIPPED = 'skipped'
+
+    def __init__(self, path):
+        self.path = path
+
+    def start(self, key, plan, planned=()):
+        """Begin a new checkpoint, replacing the old one
+
+        Parameters
+        ----------
+        key : str
+            Identifies the recipes and options that `plan` was made for
+        plan : dict
+            Anything json-able that is needed to pick the run up again
+        planned : iterable of str, optional
+            Names to record in the PLANNED state
+        """
+        lines = [json.dumps({'key': key, 'plan': plan})]
+        lines.extend(json.dumps({'name': name, 'state': self.PLANNED})
+                     for name in planned)
+        atomic_write(self.path, ('\n'.join(lines) + '\n').encode('utf-8'))
+
+    def load(self, key):
+        """Read the checkpoint back
+
+        Parameters
+        ----------
+        key : str
+            Must match the key that the checkpoint was started with
+
+        Returns
+        -------
+        plan : dict or None
+            None if there is no checkpoint or it is for another `key`
+        states : dict
+            Maps name -> the last state recorded for it, and whatever else
+            was recorded with it
+        """
+        try:
+            with open(self.path) as f:
+                lines = f.read().split('\n')
+            header = json.loads(lines[0])
+        except (IOError, OSError, ValueError):
+            return None, {}
+        if header.get('key') != key:
+            logger.info('The checkpoint at %s is for different recipes or '
+                        'options', self.path)
+            return None, {}
+        states = {}
+        for line in lines[1:]:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # an empty line or one that was being written when we died
+                continue
+            states[entry['name']] = entry
+        return header['plan'], states
+
+    def set_state(self, name, state, **info):
+        """Record that `name` is now in `state`
+
+        Parameters
+        ----------
+        name : str
+        state : str
+            One of the state attributes, or any other string
+        info
+            Any json-able details to keep with the state
+        """
+        info.update(name=name, state=state)
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(info) + '\n')
+            f.flush()
+            # a preempted node should not lose what it did
+            os.fsync(f.fileno())
@@ -36,23 +36,56 @@ buildmatrix /folder/of/recipes --python 2.7 3.4 3.5 --numpy 1.10 1.11 -c some_co
 
 buildmatrix --help
 """
+import heapq
 import json
 import itertools
 import logging
+import multiprocessing
 import os
 import pdb
+import re
+import shutil
 import signal
 import subprocess
 import sys
 import tempfile
+import threading
 import time
 import traceback
 from argparse import ArgumentParser
+from collections import deque
 from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 from pprint import pformat
-
+try:
+    from queue import Empty, Queue
+except ImportError:
+    # python 2
+    from Queue import Empty, Queue
+
+import conda_build
+import yaml
 from conda.api import get_index
+from conda_build import config as conda_build_config
 from conda_build.metadata import MetaData
+try:
+    # conda-build >= 2.0 exposes a python api that can render the output file
+    # name without paying for a new conda process every time
+    from conda_build import api as conda_build_api
+except ImportError:
+    conda_build_api = None
+
+from .artifacts import (DEFAULT_STORE_AGE, DEFAULT_STORE_SIZE,
+                        TRANSFER_ERRORS, ArtifactStore, TieredArtifactCache,
+                        place, remote_artifact_cache)
+from .cache import (BuildHistory, BuildNameCache, Checkpoint,
+                    DEFAULT_BUILD_NAME_CACHE_SIZE, DEFAULT_CACHE_DIR,
+                    hash_key, hash_recipe_dir)
+from .envs import DEFAULT_PREFETCH_JOBS, Prefetcher, Solver, env_key
+from .index import (DEFAULT_INDEX_TTL, IndexCache, PackageIndex,
+                    local_channel_path, local_package_index)
+from .workqueue import (DEFAULT_LEASE, FAILED, SUCCEEDED, TIMED_OUT,
+                        WorkQueue, default_worker_name)
 
 logger = logging.getLogger('cli.py')
 current_subprocs = set()
@@ -60,6 +93,18 @@ shutdown = False
 
 DEFAULT_PY = '3.5'
 DEFAULT_NP_VER = '1.11'
+RENDER_ENGINES = ('auto', 'api', 'subprocess')
+RESOURCES_FILE = 'buildmatrix.yaml'
+# cores that a recipe which does not say how many it needs is given
+DEFAULT_BUILD_CPUS = 1
+DEFAULT_POLL_INTERVAL = 5
+DEFAULT_BUILD_LOG_DIR = os.path.join(tempfile.gettempdir(), 'buildmatrix',
+                                     'builds')
+DEFAULT_LOG_TAIL_LINES = 200
+DEFAULT_KILL_GRACE = 10
+# seconds that what a build started may hold on to its output after it exits
+DEFAULT_LEFTOVER_GRACE = 10
+DEFAULT_PREFLIGHT_JOBS = 4
 
 
 @contextmanager
@@ -77,9 +122,17 @@ def handle_signal(signum, frame):
     # send signal recieved to subprocesses
     global shutdown
     shutdown = True
-    for proc in current_subprocs:
+    # builds run in threads, so copy the set before walking it
+    for proc in list(current_subprocs):
         if proc.poll() is None:
-            proc.send_signal(signum)
+            if hasattr(os, 'killpg'):
+                # builds run in their own process group, see run_logged
+                try:
+                    os.killpg(proc.pid, signum)
+                except OSError:
+                    pass
+            else:
+                proc.send_signal(signum)
     print("Killing build script due to receiving signum={}"
           "".format(signum))
     sys.exit(1)
@@ -89,12 +142,38 @@ signal.signal(signal.SIGINT, handle_signal)
 signal.signal(signal.SIGTERM, handle_signal)
 
 
-def get_file_names_on_anaconda_channel(channel):
+def native_subdir():
+    """The conda subdir that packages built on this machine end up in
+
+    Returns
+    -------
+    str
+        Something like 'linux-64'
+    """
+    try:
+        from conda.base.context import context
+    except ImportError:
+        # conda < 4.2
+        from conda.config import subdir
+        return subdir
+    return context.subdir
+
+
+def get_file_names_on_anaconda_channel(channel, index_cache=None,
+                                       subdirs=None):
     """Get the names of **all** the files on a channel
 
     Parameters
     ----------
     channel : str
+        Channel name or url. A file:// url or a path that is absolute or
+        starts with ./ has its repodata.json files read directly
+    index_cache : IndexCache, optional
+        If not None, fetch the channel index through this on-disk cache
+        instead of conda's `get_index`
+    subdirs : iterable, optional
+        Subdirs to look in when using `index_cache` or a local channel.
+        Defaults to the native subdir and 'noarch'
 
     Returns
     -------
@@ -102,25 +181,116 @@ def get_file_names_on_anaconda_channel(channel):
         The file names of all files on an anaconda channel.
         Something like 'linux-64/album-0.0.2.post0-0_g6b05c00_py27.tar.bz2'
     """
+    if local_channel_path(channel) is not None:
+        if subdirs is None:
+            subdirs = [native_subdir(), 'noarch']
+        return set(local_package_index(channel, subdirs))
+    if index_cache is not None:
+        if subdirs is None:
+            subdirs = [native_subdir(), 'noarch']
+        return index_cache.file_names(channel, subdirs)
     index = get_index([channel], prepend=False)
     file_names = [v['channel'].split('/')[-1] + '/' + k.split('::')[1] for k, v in index.items()]
     return set(file_names)
 
 
-def Popen(cmd):
+def get_package_index(channels, names, index_cache=None, subdirs=None):
+    """Find the builds of only the packages that we have recipes for
+
+    The channel indexes are fetched concurrently.
+
+    Parameters
+    ----------
+    channels : str or list
+        Channel(s) to look on. Earlier channels win when a build is on more
+        than one of them. Local paths and file:// urls have their
+        repodata.json files read directly, without touching the network
+    names : iterable
+        Package names to look for on the channels
+    index_cache : IndexCache, optional
+        If not None, fetch the channel indexes through this on-disk cache
+        instead of conda's `get_index`
+    subdirs : iterable, optional
+        Subdirs to look in when using `index_cache` or a local channel.
+        Defaults to the native subdir and 'noarch'. conda's `get_index`
+        always looks at both
+
+    Returns
+    -------
+    PackageIndex
+        Supports `'linux-64/album-0.0.2.post0-0_g6b05c00_py27.tar.bz2' in
+        packages`, like the set from `get_file_names_on_anaconda_channel`, and
+        `packages.channel_for(...)` to find out where it was found
+    """
+    if not isinstance(channels, (list, tuple)):
+        channels = [channels]
+    names = set(names)
+    if subdirs is None:
+        subdirs = [native_subdir(), 'noarch']
+    if index_cache is not None:
+        jobs = [(channel, [subdir]) for channel in channels
+                for subdir in subdirs]
+
+        def fetch(job):
+            channel, job_subdirs = job
+            return index_cache.package_index(channel, job_subdirs,
+                                             names=names)
+    else:
+        jobs = channels
+
+        def fetch(channel):
+            if local_channel_path(channel) is not None:
+                return local_package_index(channel, subdirs, names=names)
+            packages = PackageIndex(names)
+            for k, v in get_index([channel], prepend=False).items():
+                packages.add(
+                    v['channel'].split('/')[-1] + '/' + k.split('::')[1],
+                    channel)
+            return packages
+
+    if not jobs:
+        # no channels, or no subdirs to look in
+        return PackageIndex(names)
+    # fetching the indexes is all waiting on the network, so threads will do
+    pool = ThreadPool(len(jobs))
+    try:
+        # map keeps the order of the channels so that the merge below lets the
+        # earlier channels win
+        indexes = pool.map(fetch, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    packages = PackageIndex(names)
+    for index in indexes:
+        packages.update(index)
+    if index_cache is not None:
+        for channel in channels:
+            if (local_channel_path(channel) is None and
+                    all((channel, subdir) in index_cache.missing
+                        for subdir in subdirs)):
+                # most likely a typo, and everything gets built again
+                logger.warning('The channel %s has none of the subdirs %s. '
+                               'Is it the right channel?', channel,
+                               ', '.join(subdirs))
+    return packages
+
+
+def Popen(cmd, env=None):
     """Returns stdout, stderr and the return code
 
     Parameters
     ----------
     cmd : list
         List of strings to be sent to subprocess.Popen
+    env : dict, optional
+        Environment to run `cmd` in. Defaults to this process' environment
 
     Returns
     -------
     stdout : """
     # capture the output with subprocess.Popen
     try:
-        proc = subprocess.Popen(cmd, stderr=subprocess.PIPE)
+        proc = subprocess.Popen(cmd, stderr=subprocess.PIPE, env=env)
         current_subprocs.add(proc)
     except subprocess.CalledProcessError as cpe:
         print(cpe)
@@ -134,6 +304,157 @@ def Popen(cmd):
     return stdout, stderr, proc.returncode
 
 
+def kill_process_group(proc, grace=DEFAULT_KILL_GRACE):
+    """Terminate `proc` and everything it started
+
+    The group gets SIGTERM, and SIGKILL if it is still around after `grace`
+    seconds. Where there are no process groups only `proc` is killed.
+    """
+    if not hasattr(os, 'killpg'):
+        proc.kill()
+        return
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+        deadline = time.time() + grace
+        while proc.poll() is None and time.time() < deadline:
+            time.sleep(0.1)
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        # the group is already gone
+        pass
+
+
+def run_logged(cmd, log_path, env=None, tail_lines=DEFAULT_LOG_TAIL_LINES,
+               timeout=None, output_timeout=None):
+    """Run `cmd`, streaming its stdout and stderr to `log_path` as it goes
+
+    Only the last `tail_lines` lines of the output are kept in memory, so a
+    chatty build costs no more than a quiet one. The log file is flushed
+    line by line and can be followed while the build runs.
+
+    `cmd` runs in its own process group. If it takes longer than `timeout`,
+    or goes `output_timeout` seconds without printing anything, the whole
+    group is killed (see `kill_process_group`), so that a hung test or post
+    link script does not hold up the run. The limits hold until `cmd` has
+    exited and its output is closed, whichever comes last, and whatever
+    `cmd` leaves running with the output still open is killed
+    `DEFAULT_LEFTOVER_GRACE` seconds after it exits.
+
+    Parameters
+    ----------
+    cmd : list
+        List of strings to be sent to subprocess.Popen
+    log_path : str
+        File to write the output to. Its folder is created if needed
+    env : dict, optional
+        Environment to run `cmd` in. Defaults to this process' environment
+    tail_lines : int, optional
+        Number of lines at the end of the output to return
+    timeout : float, optional
+        Seconds `cmd` may run for. Defaults to no limit
+    output_timeout : float, optional
+        Seconds `cmd` may go without any output. Defaults to no limit
+
+    Returns
+    -------
+    returncode : int
+    tail : str
+        The end of the output
+    timed_out : str or None
+        None, or why `cmd` was killed
+    """
+    dirname = os.path.dirname(log_path)
+    if dirname and not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # another build made it first
+            if not os.path.isdir(dirname):
+                raise
+    tail = deque(maxlen=tail_lines)
+    kwargs = {}
+    if sys.version_info >= (3, 2):
+        kwargs['start_new_session'] = True
+    elif hasattr(os, 'setsid'):
+        kwargs['preexec_fn'] = os.setsid
+    start = last_output = time.time()
+    timed_out = []
+    # set once the output is closed
+    closed = threading.Event()
+    # set once there is nothing left to watch
+    done = threading.Event()
+
+    def watchdog():
+        limits = [limit for limit in (timeout, output_timeout) if limit]
+        interval = min([1.0] + [limit / 4. for limit in limits])
+        exited = None
+        while not done.is_set():
+            now = time.time()
+            if timeout and now - start > timeout:
+                timed_out.append('took longer than {}s'.format(timeout))
+            elif output_timeout and now - last_output > output_timeout:
+                timed_out.append('no output for {}s'.format(output_timeout))
+            if timed_out:
+                kill_process_group(proc)
+                return
+            if exited is None and proc.poll() is not None:
+                exited = now
+            if exited is not None and closed.is_set():
+                return
+            if (exited is not None and
+                    now - exited > DEFAULT_LEFTOVER_GRACE):
+                # a daemon that the build started would keep the output
+                # open forever
+                logger.warning('Killing what %s left running', cmd[0])
+                kill_process_group(proc, grace=0)
+                return
+            done.wait(interval)
+
+    with open(log_path, 'wb') as log:
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                stderr=subprocess.STDOUT, env=env, **kwargs)
+        current_subprocs.add(proc)
+        try:
+            thread = threading.Thread(target=watchdog)
+            thread.daemon = True
+            thread.start()
+            # cap the length of a line too, in case a build prints a
+            # progress bar with carriage returns and no newlines
+            for line in iter(lambda: proc.stdout.readline(8192), b''):
+                last_output = time.time()
+                log.write(line)
+                log.flush()
+                tail.append(line)
+            # a build can close its output and carry on, the watchdog keeps
+            # an eye on it until it exits
+            closed.set()
+            proc.stdout.close()
+            proc.wait()
+        finally:
+            done.set()
+            current_subprocs.discard(proc)
+        if timed_out:
+            message = '\nbuildmatrix: killed the build, it {}\n'.format(
+                timed_out[0])
+            log.write(message.encode('utf-8'))
+            tail.append(message.encode('utf-8'))
+    return (proc.returncode, b''.join(tail).decode('utf-8', 'replace'),
+            timed_out[0] if timed_out else None)
+
+
+def build_log_path(log_dir, build_name):
+    """Where the output of building `build_name` goes
+
+    `log_dir`/subdir/package-version-build.log
+    """
+    base = build_name
+    for ext in ('.tar.bz2', '.conda'):
+        if base.endswith(ext):
+            base = base[:-len(ext)]
+            break
+    return os.path.join(log_dir, *(base + '.log').split('/'))
+
+
 def check_output(cmd):
     try:
         ret = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
@@ -147,7 +468,75 @@ def check_output(cmd):
         return name
 
 
-def determine_build_name(path_to_recipe, *conda_build_args):
+def _conda_build_api_kwargs(conda_build_args):
+    """Translate conda build command line args into conda_build.api kwargs
+
+    Parameters
+    ----------
+    conda_build_args : list
+        Something like ['--python', '3.4', '--numpy', '1.11']
+
+    Returns
+    -------
+    dict
+        Something like {'python': '3.4', 'numpy': '1.11'}
+
+    Raises
+    ------
+    ValueError
+        If there is an argument that we do not know how to translate
+    """
+    kwargs = {}
+    args = list(conda_build_args)
+    while args:
+        flag = args.pop(0)
+        if flag not in ('--python', '--numpy') or not args:
+            raise ValueError("Cannot translate conda build argument {} for "
+                             "the conda_build api".format(flag))
+        kwargs[flag.lstrip('-')] = args.pop(0)
+    return kwargs
+
+
+def render_build_name(path_to_recipe, *conda_build_args):
+    """Render the output file name in this process with conda_build's api
+
+    Parameters
+    ----------
+    path_to_recipe : str
+        The location of the recipe on disk
+    *conda_build_args : list
+        The same extra arguments that `determine_build_name` takes. Only
+        '--python' and '--numpy' are understood.
+
+    Returns
+    -------
+    package_name : str
+        Something like:
+        /home/edill/mc/conda-bld/linux-64/pims-0.3.3.post0-0_g1bea480_py27.tar.bz2
+
+    Raises
+    ------
+    ImportError
+        If the conda_build api is not available
+    ValueError
+        If `conda_build_args` contains arguments that the api does not take
+    """
+    if conda_build_api is None:
+        raise ImportError("conda_build.api is not available. conda-build>=2.0 "
+                          "is required to render build names in process")
+    kwargs = _conda_build_api_kwargs(conda_build_args)
+    if hasattr(conda_build_api, 'get_output_file_paths'):
+        # conda-build 3 can hand back more than one output
+        ret = conda_build_api.get_output_file_paths(path_to_recipe, **kwargs)
+    else:
+        ret = conda_build_api.get_output_file_path(path_to_recipe, **kwargs)
+    if isinstance(ret, (list, tuple)):
+        # match `conda build --output`, where we take the last line
+        ret = ret[-1]
+    return ret
+
+
+def determine_build_name(path_to_recipe, *conda_build_args, **kwargs):
     """Figure out what conda says the output built package name is going to be
     Parameters
     ----------
@@ -157,19 +546,43 @@ def determine_build_name(path_to_recipe, *conda_build_args):
         List of extra arguments to be appeneded to the conda build command.
         For example, this might include ['--python', '3.4'], to tell
         conda-build to build a python 3.4 package
+    engine : {'auto', 'api', 'subprocess'}, optional
+        How to figure out the build name. 'api' renders the recipe in this
+        process with conda_build's python api, 'subprocess' asks
+        `conda build --output`, and 'auto' tries the api first and falls back
+        to the subprocess. Defaults to 'subprocess'
 
     Returns
     -------
     package_name : str
         Something like:
         /home/edill/mc/conda-bld/linux-64/pims-0.3.3.post0-0_g1bea480_py27.tar.bz2
+    build_cmd : list
+        The conda build command that will build `package_name`
     """
+    engine = kwargs.pop('engine', 'subprocess')
+    if kwargs:
+        raise TypeError("Unexpected keyword arguments: {}".format(kwargs))
+    if engine not in RENDER_ENGINES:
+        raise ValueError("engine must be one of {}. You passed in {}".format(
+            RENDER_ENGINES, engine))
     conda_build_args = [] if conda_build_args is None else list(
         conda_build_args)
     logger.debug('conda_build_args=%s', conda_build_args)
     cmd = ['conda', 'build', path_to_recipe, '--output'] + conda_build_args
     logger.debug('cmd=%s', cmd)
-    ret = check_output(cmd)
+    if engine in ('auto', 'api'):
+        try:
+            ret = [render_build_name(path_to_recipe, *conda_build_args)]
+        except Exception as e:
+            if engine == 'api':
+                raise RuntimeError("{} raised while rendering {} with the "
+                                   "conda_build api".format(e, cmd))
+            logger.debug('Falling back to `conda build --output`. The '
+                         'conda_build api raised %s', e)
+            ret = check_output(cmd)
+    else:
+        ret = check_output(cmd)
     logger.debug('ret=%s', ret)
     # if len(ret) > 1:
     #     logger.debug('recursing...')
@@ -185,7 +598,404 @@ def determine_build_name(path_to_recipe, *conda_build_args):
     return ret[-1], cmd
 
 
-def decide_what_to_build(recipes_path, python, packages, numpy):
+def parse_memory(value):
+    """Turn a memory size into megabytes
+
+    >>> parse_memory('16G'), parse_memory('512M'), parse_memory(2048)
+    (16384, 512, 2048)
+    """
+    if isinstance(value, (int, float)):
+        return int(value)
+    value = str(value).strip().upper().rstrip('B')
+    units = {'K': 1. / 1024, 'M': 1, 'G': 1024, 'T': 1024 * 1024}
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(float(value))
+
+
+def parse_duration(value):
+    """Turn a duration into seconds
+
+    >>> parse_duration('2h'), parse_duration('90m'), parse_duration(30)
+    (7200.0, 5400.0, 30.0)
+    """
+    if isinstance(value, (int, float)):
+        return float(value)
+    value = str(value).strip().lower()
+    units = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60}
+    if value and value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value)
+
+
+def total_memory():
+    """Megabytes of physical memory on this machine, or None if unknown"""
+    try:
+        return (os.sysconf('SC_PAGE_SIZE') *
+                os.sysconf('SC_PHYS_PAGES')) // (1024 * 1024)
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def get_resources(recipe_dir, meta=None):
+    """Find out how much of the machine a recipe needs to build
+
+    The hints come from a buildmatrix.yaml next to the meta.yaml, or from
+    the buildmatrix section of the meta.yaml's extra section::
+
+        extra:
+          buildmatrix:
+            cpus: 16
+            memory: 16G
+
+    Parameters
+    ----------
+    recipe_dir : str
+    meta : dict, optional
+        The parsed meta.yaml
+
+    Returns
+    -------
+    cpus : int or None
+        Number of cores the build uses. None if the recipe does not say
+    memory : int
+        Megabytes of memory the build needs. 0 if the recipe does not say
+    """
+    hints = _build_hints(recipe_dir, meta)
+    cpus = hints.get('cpus')
+    if cpus is not None:
+        cpus = int(cpus)
+    return cpus, parse_memory(hints.get('memory', 0))
+
+
+def _build_hints(recipe_dir, meta=None):
+    hints = {}
+    if meta is not None:
+        hints = (meta.get('extra') or {}).get('buildmatrix') or {}
+    sidecar = os.path.join(recipe_dir, RESOURCES_FILE)
+    if os.path.exists(sidecar):
+        with open(sidecar) as f:
+            hints = yaml.safe_load(f) or {}
+    return hints
+
+
+def get_timeouts(recipe_dir, meta=None):
+    """Find out how long a recipe is allowed to take to build
+
+    The hints live in the same places as the ones of `get_resources`::
+
+        extra:
+          buildmatrix:
+            timeout: 2h
+            output_timeout: 20m
+
+    Parameters
+    ----------
+    recipe_dir : str
+    meta : dict, optional
+        The parsed meta.yaml
+
+    Returns
+    -------
+    timeout : float or None
+        Seconds the whole build may take. None if the recipe does not say
+    output_timeout : float or None
+        Seconds the build may go without printing anything. None if the
+        recipe does not say
+    """
+    hints = _build_hints(recipe_dir, meta)
+    return tuple(parse_duration(hints[key]) if hints.get(key) else None
+                 for key in ('timeout', 'output_timeout'))
+
+
+class Recipe(object):
+    """A conda recipe that is parsed once per run
+
+    The MetaData is read when the Recipe is created and the bits of it that
+    the planner needs are shared by all of the recipe's variants, so the
+    yaml/jinja work is only done once no matter how many python/numpy
+    combinations get built.
+
+    Parameters
+    ----------
+    recipe_dir : str
+        Folder that contains the meta.yaml
+
+    Attributes
+    ----------
+    metadata : MetaData
+    name, version : str
+    build, run, test : tuple
+        The requirements listed in the recipe
+    subdir : str
+        The subdir that the built packages end up in. 'noarch' for noarch
+        recipes, otherwise the native subdir
+    cpus, memory
+        What the recipe needs to build. See `get_resources`
+    timeout, output_timeout
+        How long the recipe may take to build. See `get_timeouts`
+    """
+    def __init__(self, recipe_dir):
+        self.recipe_dir = recipe_dir
+        self.metadata = MetaData(recipe_dir)
+        self.name = self.metadata.meta['package']['name']
+        self.version = str(self.metadata.meta['package'].get('version', ''))
+        self.build, self.run, self.test = (
+            tuple(deps) for deps in get_deps_from_metadata(self.metadata))
+        build_section = self.metadata.meta.get('build') or {}
+        if build_section.get('noarch') or build_section.get('noarch_python'):
+            self.subdir = 'noarch'
+        else:
+            self.subdir = native_subdir()
+        self.cpus, self.memory = get_resources(recipe_dir,
+                                               self.metadata.meta)
+        self.timeout, self.output_timeout = get_timeouts(recipe_dir,
+                                                         self.metadata.meta)
+
+    def __repr__(self):
+        return 'Recipe({!r})'.format(self.recipe_dir)
+
+    def build_versions(self, python, numpy):
+        """The python and numpy versions that this recipe needs to build for
+
+        Parameters
+        ----------
+        python : list
+            Python versions that were asked for
+        numpy : list
+            Numpy versions that were asked for
+
+        Returns
+        -------
+        python_build_versions, numpy_build_versions : list
+        """
+        # only need to do multiple numpy builds if the meta.yaml pins the numpy
+        # version in build and run.
+        numpy_build_versions = numpy
+        if 'numpy x.x' not in self.build:
+            numpy_build_versions = [DEFAULT_NP_VER]
+        python_build_versions = python
+        if 'python' not in set(self.build + self.run):
+            python_build_versions = [DEFAULT_PY]
+        return python_build_versions, numpy_build_versions
+
+    def variant(self, python, numpy, full_build_path, build_command):
+        """Make the Variant record for one python/numpy build of this recipe"""
+        return Variant(
+            name=self.name, version=self.version, python=python, numpy=numpy,
+            full_build_path=full_build_path, build_command=build_command,
+            build_deps=self.build, run_deps=self.run, test_deps=self.test,
+            recipe_dir=self.recipe_dir, cpus=self.cpus, memory=self.memory,
+            timeout=self.timeout, output_timeout=self.output_timeout)
+
+
+class Variant(object):
+    """One planned build: a recipe at a specific python and numpy version
+
+    This only holds what the planner and the builder need. The full MetaData
+    is parsed again on demand (and then kept) if something asks for it.
+
+    Attributes
+    ----------
+    name, version : str
+        Package name and version from the recipe
+    python, numpy : str
+        The versions this variant is built against
+    full_build_path : str
+        Where conda build will put the package
+    build_name : str
+        The last two path components of `full_build_path`. Something like
+        'linux-64/album-0.0.2.post0-0_g6b05c00_py27.tar.bz2'
+    build_command : list
+        The conda build command that builds this variant
+    build_deps, run_deps, test_deps : tuple
+        The requirements listed in the recipe
+    recipe_dir : str
+    found_on : str
+        The channel that already has this build, if any
+    cpus : int or None
+        Number of cores the build uses, if the recipe says
+    memory : int
+        Megabytes of memory the build needs. 0 if the recipe does not say
+    timeout, output_timeout : float or None
+        Seconds the build may take, and may go without output, if the
+        recipe says
+    input_hash : str or None
+        Hash of everything that goes into the build, see
+        `compute_input_hashes`
+    """
+    __slots__ = ('name', 'version', 'python', 'numpy', 'full_build_path',
+                 'build_name', 'build_command', 'build_deps', 'run_deps',
+                 'test_deps', 'recipe_dir', 'found_on', 'cpus', 'memory',
+                 'timeout', 'output_timeout', 'input_hash', '_metadata')
+
+    def __init__(self, name, version, python, numpy, full_build_path,
+                 build_command, build_deps=(), run_deps=(), test_deps=(),
+                 recipe_dir=None, cpus=None, memory=0, timeout=None,
+                 output_timeout=None):
+        self.name = name
+        self.version = version
+        self.python = python
+        self.numpy = numpy
+        self.full_build_path = full_build_path
+        self.build_name = os.sep.join(full_build_path.split(os.sep)[-2:])
+        self.build_command = build_command
+        self.build_deps = tuple(build_deps)
+        self.run_deps = tuple(run_deps)
+        self.test_deps = tuple(test_deps)
+        self.recipe_dir = recipe_dir
+        self.found_on = None
+        self.cpus = cpus
+        self.memory = memory
+        self.timeout = timeout
+        self.output_timeout = output_timeout
+        self.input_hash = None
+        self._metadata = None
+
+    def __repr__(self):
+        return 'Variant({!r})'.format(self.build_name)
+
+    def to_dict(self):
+        """The Variant as a json-able dict, see `from_dict`"""
+        return dict((attr, getattr(self, attr)) for attr in self.__slots__
+                    if attr not in ('build_name', '_metadata'))
+
+    @classmethod
+    def from_dict(cls, dct):
+        """Make a Variant from the output of `to_dict`"""
+        dct = dict(dct)
+        found_on = dct.pop('found_on', None)
+        input_hash = dct.pop('input_hash', None)
+        variant = cls(**dct)
+        variant.found_on = found_on
+        variant.input_hash = input_hash
+        return variant
+
+    @property
+    def metadata(self):
+        """The conda_build MetaData for this recipe, parsed on first access"""
+        if self._metadata is None:
+            self._metadata = MetaData(self.recipe_dir)
+        return self._metadata
+
+    @property
+    def meta(self):
+        """The parsed meta.yaml, like `MetaData.meta`"""
+        return self.metadata.meta
+
+
+def find_recipe_dirs(recipes_path):
+    """The folders in `recipes_path` that have a meta.yaml
+
+    Parameters
+    ----------
+    recipes_path : str
+        Path to a recipe or to a folder of recipes
+
+    Returns
+    -------
+    list
+        Absolute paths, sorted by folder name
+    """
+    recipes_path = os.path.abspath(recipes_path)
+    if 'meta.yaml' in os.listdir(recipes_path):
+        folders = [recipes_path]
+    else:
+        folders = sorted(os.listdir(recipes_path))
+    recipe_dirs = []
+    for folder in folders:
+        recipe_dir = os.path.join(recipes_path, folder)
+        if os.path.isfile(recipe_dir):
+            continue
+        if 'meta.yaml' not in os.listdir(recipe_dir):
+            continue
+        recipe_dirs.append(recipe_dir)
+    return recipe_dirs
+
+
+def load_recipes(recipes_path):
+    """Parse every recipe in `recipes_path`
+
+    Parameters
+    ----------
+    recipes_path : str
+        Path to a recipe or to a folder of recipes
+
+    Returns
+    -------
+    list
+        Recipe objects, sorted by folder name
+    """
+    recipes = []
+    for recipe_dir in find_recipe_dirs(recipes_path):
+        logger.debug('Evaluating recipe: {}'.format(recipe_dir))
+        recipes.append(Recipe(recipe_dir))
+    return recipes
+
+
+# `environ[...]` or `environ.get(...)` in the jinja of a meta.yaml
+_USES_ENVIRON = re.compile(r'\benviron\s*(?:\[|\.\s*get\b)')
+# the `path:` of a source, as in `  path: ../src` or `  - path: ../src`
+_SOURCE_PATH = re.compile(r'^\s*(?:-\s*)?path\s*:\s*(.*?)\s*$', re.MULTILINE)
+
+
+def _build_name_is_cacheable(recipe_dir):
+    """Whether the build name only depends on the files in the recipe
+
+    Recipes that use the GIT_* variables or read setup.py get their version
+    from the source code, which can change without the recipe changing.
+    Neither can recipes that read the environment, or whose `source: path:`
+    is outside of the recipe folder.
+    """
+    with open(os.path.join(recipe_dir, 'meta.yaml')) as f:
+        text = f.read()
+    if any(marker in text for marker in
+           ('GIT_', 'load_setup_py_data', 'load_setuptools')):
+        return False
+    if _USES_ENVIRON.search(text):
+        return False
+    recipe_dir = os.path.abspath(recipe_dir)
+    for path in _SOURCE_PATH.findall(text):
+        path = path.split(' #', 1)[0].strip().strip('\'"')
+        if '{' in path:
+            # jinja, which could point anywhere
+            return False
+        source = os.path.normpath(os.path.join(recipe_dir, path))
+        if source != recipe_dir and not source.startswith(
+                os.path.join(recipe_dir, '')):
+            return False
+    return True
+
+
+def _render_variant(args):
+    """Determine the build name for one (recipe, python, numpy) variant
+
+    Module level so that it can be shipped to a multiprocessing pool.
+
+    Parameters
+    ----------
+    args : tuple
+        (recipe_dir, python, numpy, render_engine)
+
+    Returns
+    -------
+    tuple or RuntimeError
+        The (path, build_cmd) from `determine_build_name`, or the
+        RuntimeError that it raised so that the caller can log it
+    """
+    recipe_dir, py, npy, render_engine = args
+    try:
+        with env_var('CONDA_NPY', npy):
+            return determine_build_name(
+                recipe_dir, '--python', py, '--numpy', npy,
+                engine=render_engine)
+    except RuntimeError as re:
+        return re
+
+
+def decide_what_to_build(recipes_path, python, packages, numpy, plan_jobs=1,
+                         render_engine='auto', build_name_cache=None,
+                         recipes=None, recipe_hashes=None):
     """Figure out which packages need to be built
 
     Parameters
@@ -196,19 +1006,32 @@ def decide_what_to_build(recipes_path, python, packages, numpy):
         List of python versions to build
     packages : list
         List of packages that already exist on the anaconda channel we are
-        interested in
+        interested in. If it has a `channel_for` method (see PackageIndex)
+        that is used to record which channel each skipped build is on.
     numpy : list
         List of numpy versions to build.
+    plan_jobs : int, optional
+        Number of processes to use to render the build names. Defaults to 1,
+        which renders every variant in this process, one at a time
+    render_engine : {'auto', 'api', 'subprocess'}, optional
+        How to render the build names. See `determine_build_name`.
+        Defaults to 'auto'
+    build_name_cache : BuildNameCache, optional
+        If not None, reuse the build names that were figured out on a
+        previous run for recipes that have not changed since then
+    recipes : list, optional
+        The output of `load_recipes(recipes_path)`, if it has already been
+        called. Saves parsing the recipes a second time
+    recipe_hashes : dict, optional
+        `hash_recipe_dir` of the recipe folders, if it has already been
+        called. Saves reading the recipes a second time
 
     Returns
     -------
     metas_to_build : list
-        the metadata for the conda build with three extra fields:
-            - full_build_path
-            - build_name
-            - build_command
+        Variant records for the builds that need to happen
     metas_not_to_build : list
-        Same as `packages_to_build`
+        Variant records for the builds that already exist on the channel
     """
 
     metas_not_to_build = []
@@ -218,58 +1041,91 @@ def decide_what_to_build(recipes_path, python, packages, numpy):
     # logger.info('{: <8} | {}'.format('to build', 'built package name'))
     recipes_path = os.path.abspath(recipes_path)
     logger.info("recipes_path = {}".format(recipes_path))
-    if 'meta.yaml' in os.listdir(recipes_path):
-        folders = [recipes_path]
-    else:
-        folders = sorted(os.listdir(recipes_path))
+    if recipes is None:
+        recipes = load_recipes(recipes_path)
     logger.info("\nFiguring out which recipes need to build...")
-    for folder in folders:
-        recipe_dir = os.path.join(recipes_path, folder)
-        if os.path.isfile(recipe_dir):
-            continue
-        if 'meta.yaml' not in os.listdir(recipe_dir):
-            continue
-        logger.debug('Evaluating recipe: {}'.format(recipe_dir))
-        build, run, test = get_deps_from_metadata(recipe_dir)
-        # only need to do multiple numpy builds if the meta.yaml pins the numpy
-        # version in build and run.
-        numpy_build_versions = numpy
-        if 'numpy x.x' not in build:
-            numpy_build_versions = [DEFAULT_NP_VER]
-        python_build_versions = python
-        if 'python' not in set(build + run):
-            python_build_versions = [DEFAULT_PY]
+    # the build names are paths in conda-bld, wherever that is this time
+    croot = conda_bld_dir() if build_name_cache is not None else None
+    recipe_hashes = recipe_hashes or {}
+    variants = []
+    for recipe in recipes:
+        recipe_dir = recipe.recipe_dir
+        python_build_versions, numpy_build_versions = recipe.build_versions(
+            python, numpy)
+        recipe_hash = None
+        if (build_name_cache is not None and
+                _build_name_is_cacheable(recipe_dir)):
+            recipe_hash = recipe_hashes.get(recipe_dir)
+            if recipe_hash is None:
+                recipe_hash = hash_recipe_dir(recipe_dir)
         for py, npy in itertools.product(python_build_versions,
                                          numpy_build_versions):
-            logger.debug("Checking py={} and npy={}".format(py, npy))
-            try:
-                with env_var('CONDA_NPY', npy):
-                    path_to_built_package, build_cmd = determine_build_name(
-                        recipe_dir, '--python', py, '--numpy', npy)
-            except RuntimeError as re:
-                logger.error(re)
-                continue
-            if '.tar.bz' not in path_to_built_package:
-                on_anaconda_channel = True
-                name_on_anaconda = "Skipping {}".format(
-                    folder, py, npy
-                )
+            cache_key = None
+            if recipe_hash is not None:
+                cache_key = build_name_cache.key(
+                    recipe_hash, recipe_dir, py, npy, npy,
+                    conda_build.__version__, croot=croot)
+            variants.append((recipe, py, npy, cache_key))
+
+    rendered = [None] * len(variants)
+    if build_name_cache is not None:
+        for idx, variant in enumerate(variants):
+            cache_key = variant[-1]
+            if cache_key is not None:
+                rendered[idx] = build_name_cache.get(cache_key)
+    misses = [idx for idx, result in enumerate(rendered) if result is None]
+    logger.debug("Build name cache hits: %s/%s",
+                 len(variants) - len(misses), len(variants))
+
+    # Each build name costs a full recipe render, so fan them out over a
+    # process pool. `map` hands the results back in the order that the
+    # variants were submitted, so the plan is the same as the serial one.
+    render_args = [(variants[idx][0].recipe_dir, ) + variants[idx][1:3] +
+                   (render_engine, ) for idx in misses]
+    if plan_jobs > 1 and len(render_args) > 1:
+        logger.info("Rendering %s variants with %s processes",
+                    len(render_args), plan_jobs)
+        pool = multiprocessing.Pool(min(plan_jobs, len(render_args)))
+        try:
+            results = pool.map(_render_variant, render_args, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_render_variant(args) for args in render_args]
+    for idx, result in zip(misses, results):
+        rendered[idx] = result
+        cache_key = variants[idx][-1]
+        if cache_key is not None and not isinstance(result, RuntimeError):
+            build_name_cache.put(cache_key, result)
+
+    for (recipe, py, npy, _), result in zip(variants, rendered):
+        logger.debug("Checking py={} and npy={}".format(py, npy))
+        if isinstance(result, RuntimeError):
+            logger.error(result)
+            continue
+        path_to_built_package, build_cmd = result
+        if '.tar.bz' not in path_to_built_package:
+            on_anaconda_channel = True
+            name_on_anaconda = "Skipping {}".format(
+                os.path.basename(recipe.recipe_dir), py, npy
+            )
+        else:
+            variant = recipe.variant(py, npy, path_to_built_package,
+                                     build_cmd)
+            name_on_anaconda = variant.build_name
+            on_anaconda_channel = name_on_anaconda in packages
+            if on_anaconda_channel:
+                if hasattr(packages, 'channel_for'):
+                    variant.found_on = packages.channel_for(name_on_anaconda)
+                    name_on_anaconda = '{} (on {})'.format(
+                        name_on_anaconda, variant.found_on)
+                metas_not_to_build.append(variant)
             else:
-                name_on_anaconda = os.sep.join(
-                    path_to_built_package.split(os.sep)[-2:])
-                # pdb.set_trace()
-                meta = MetaData(recipe_dir)
-                on_anaconda_channel = name_on_anaconda in packages
-                meta.full_build_path = path_to_built_package
-                meta.build_name = name_on_anaconda
-                meta.build_command = build_cmd
-                if on_anaconda_channel:
-                    metas_not_to_build.append(meta)
-                else:
-                    metas_to_build.append(meta)
-
-            logger.info('{:<8} | {:<5} | {:<5} | {}'.format(
-                str(not bool(on_anaconda_channel)), py, npy, name_on_anaconda))
+                metas_to_build.append(variant)
+
+        logger.info('{:<8} | {:<5} | {:<5} | {}'.format(
+            str(not bool(on_anaconda_channel)), py, npy, name_on_anaconda))
 
     return metas_to_build, metas_not_to_build
 
@@ -277,8 +1133,10 @@ def decide_what_to_build(recipes_path, python, packages, numpy):
 def get_deps_from_metadata(path):
     """
     Extract all dependencies from a recipe. Return tuple of (build, run, test)
+
+    `path` can also be an already parsed MetaData object
     """
-    meta = MetaData(path)
+    meta = path if isinstance(path, MetaData) else MetaData(path)
     test = meta.meta.get('test', {}).get('requires', [])
     run = meta.meta.get('requirements', {}).get('run', [])
     build = meta.meta.get('requirements', {}).get('build', [])
@@ -294,13 +1152,13 @@ def sanitize_names(list_of_names):
 
 def build_dependency_graph(metas):
     """
-    Given an input list of MetaData objects, build a directional graph of
+    Given an input list of Variant records, build a directional graph of
     how the dependencies are related.  Gotchas include determining the
     package name without the version pinning and without conda selectors.
 
     Parameters
     ----------
-    metas : iterable of MetaData objects
+    metas : iterable of Variant records
 
     Returns
     -------
@@ -325,16 +1183,16 @@ def build_dependency_graph(metas):
     logger.debug("Building dependency graph for %s libraries", len(metas))
 
     for meta in metas:
-        name = meta.meta['package']['name']
+        name = meta.name
+        if name in build_deps:
+            # every variant of a recipe shares the same requirements
+            continue
         logger.debug('name=%s', name)
-        build_deps[name] = sanitize_names(
-            meta.meta.get('requirements', {}).get('build', []))
+        build_deps[name] = sanitize_names(meta.build_deps)
         logger.debug('build_deps=%s', build_deps)
-        run_deps[name] = sanitize_names(
-            meta.meta.get('requirements', {}).get('run', []))
+        run_deps[name] = sanitize_names(meta.run_deps)
         logger.debug('run_deps=%s', run_deps)
-        test_deps[name] = sanitize_names(
-            meta.meta.get('test', {}).get('requires', []))
+        test_deps[name] = sanitize_names(meta.test_deps)
         logger.debug('test_deps=%s', test_deps)
     # pdb.set_trace()
     # union = copy.deepcopy(build_deps)
@@ -349,113 +1207,1398 @@ def build_dependency_graph(metas):
     return union
 
 
+def _find_cycle(package_dependencies, packages):
+    """Find one dependency cycle among `packages`
+
+    Parameters
+    ----------
+    package_dependencies : dict
+        package -> iterable of the packages it depends on
+    packages : iterable
+        Packages that are known to contain a cycle, e.g. the ones that a
+        topological sort could not get to
+
+    Returns
+    -------
+    list
+        Something like ['a', 'b', 'a'] for a depends on b depends on a
+    """
+    packages = set(packages)
+    for start in sorted(packages):
+        # walk the remaining dependencies until we come back around. Every
+        # remaining package has at least one remaining dependency, so the
+        # walk can not dead end
+        path = [start]
+        seen = {start: 0}
+        node = start
+        while True:
+            node = sorted(dep for dep in package_dependencies[node]
+                          if dep in packages)[0]
+            if node in seen:
+                return path[seen[node]:] + [node]
+            seen[node] = len(path)
+            path.append(node)
+
+
+def build_variant_graph(metas, dependency_graph=None):
+    """
+    Like `build_dependency_graph`, but with one node per Variant
+
+    A variant only depends on the variants of its in-tree dependencies that it
+    will actually be built against: the ones with the same python version if
+    the dependency is built per python version, and also the same numpy
+    version if both recipes pin 'numpy x.x'. That way the python 2.7 build of a
+    package can start as soon as the python 2.7 builds of its dependencies
+    are done, without waiting on every other variant.
+
+    Parameters
+    ----------
+    metas : iterable of Variant records
+    dependency_graph : dict, optional
+        The output of `build_dependency_graph(metas)`, if it has already been
+        called
+
+    Returns
+    -------
+    dict
+        Maps each variant's build_name to the list of build_names it depends
+        on. Can be passed to `resolve_dependencies`
+    """
+    metas = list(metas)
+    if dependency_graph is None:
+        dependency_graph = build_dependency_graph(metas)
+    by_name = {}
+    for meta in metas:
+        by_name.setdefault(meta.name, []).append(meta)
+
+    def pins_python(meta):
+        return 'python' in set(meta.build_deps + meta.run_deps)
+
+    def pins_numpy(meta):
+        return 'numpy x.x' in meta.build_deps
+
+    graph = {}
+    for meta in metas:
+        upstream = []
+        for name in sorted(dependency_graph.get(meta.name, ())):
+            for dep in by_name.get(name, ()):
+                if pins_python(dep) and dep.python != meta.python:
+                    continue
+                if (pins_numpy(dep) and pins_numpy(meta) and
+                        dep.numpy != meta.numpy):
+                    continue
+                upstream.append(dep.build_name)
+        graph[meta.build_name] = upstream
+    return graph
+
+
 def resolve_dependencies(package_dependencies):
     """
     Given a dictionary mapping a package to its dependencies, return a
     generator of packages to install, sorted by the required install
     order.
 
+    This is a topological sort (Kahn's algorithm) that runs in
+    O(packages + dependencies). When more than one package is ready to go,
+    they come out in sorted order, so the result is deterministic.
+
     >>> deps = resolve_dependencies({'a': ['b', 'c'], 'b': ['c'],
-                                     'c': ['d'], 'd': []})
+    ...                              'c': ['d'], 'd': []})
     >>> list(deps)
     ['d', 'c', 'b', 'a']
 
-    Notes
-    -----
-    copied from conda-build-all. Thanks @pelson!
-    """
-    remaining_dependencies = package_dependencies.copy()
-    completed_packages = []
-
-    # A maximum of 10000 iterations. Beyond that and there is probably a
-    # problem.
-    for failsafe in range(10000):
-        for package, deps in sorted(remaining_dependencies.copy().items()):
-            if all(dependency in completed_packages for dependency in deps):
-                completed_packages.append(package)
-                remaining_dependencies.pop(package)
-                yield package
-            else:
-                # Put a check in to ensure that all the dependencies were
-                # defined as packages, otherwise we will never succeed.
-                for dependency in deps:
-                    if dependency not in package_dependencies:
-                        msg = ('The package {} depends on {}, but it was not '
-                               'part of the package_dependencies dictionary.'
-                               ''.format(package, dependency))
-                        raise ValueError(msg)
-
-        # Close off the loop if we've completed the dependencies.
-        if not remaining_dependencies:
-            break
-    else:
-        raise ValueError('Dependencies could not be resolved. '
-                         'Remaining dependencies: {}'
-                         ''.format(remaining_dependencies))
-
-
-def run_build(build_order, allow_failures=False):
-    """Build packages that do not already exist at {{ channel }}
+    Raises
+    ------
+    ValueError
+        If a package depends on something that is not a key of
+        `package_dependencies`, or if the dependencies form a cycle. The
+        message names the packages in the cycle.
+    """
+    # Put a check in to ensure that all the dependencies were defined as
+    # packages, otherwise we will never succeed.
+    for package, deps in sorted(package_dependencies.items()):
+        for dependency in deps:
+            if dependency not in package_dependencies:
+                msg = ('The package {} depends on {}, but it was not '
+                       'part of the package_dependencies dictionary.'
+                       ''.format(package, dependency))
+                raise ValueError(msg)
+
+    num_deps = {}
+    dependents = {package: [] for package in package_dependencies}
+    for package, deps in package_dependencies.items():
+        deps = set(deps)
+        num_deps[package] = len(deps)
+        for dependency in deps:
+            dependents[dependency].append(package)
+
+    ready = [package for package, count in num_deps.items() if count == 0]
+    heapq.heapify(ready)
+    while ready:
+        package = heapq.heappop(ready)
+        del num_deps[package]
+        yield package
+        for dependent in dependents[package]:
+            num_deps[dependent] -= 1
+            if num_deps[dependent] == 0:
+                heapq.heappush(ready, dependent)
+
+    if num_deps:
+        cycle = _find_cycle(package_dependencies, num_deps)
+        raise ValueError('Dependencies could not be resolved. There is a '
+                         'dependency cycle: {}. Remaining dependencies: {}'
+                         ''.format(' -> '.join(cycle), sorted(num_deps)))
+
+
+def critical_path_lengths(package_dependencies, durations, default=1.0):
+    """How long it will take to build each node and everything downstream
 
     Parameters
     ----------
-    build_order : iterable
-        The order that the packages should be built in
-    recipes_path : str
-        Iterable of conda build Metadata objects.
-        HINT: output of `decide_what_to_build` is probably what should be
-        passed in here
-    allow_failures : bool, optional
+    package_dependencies : dict
+        Maps a node to the nodes it depends on. Same as for
+        `resolve_dependencies`
+    durations : dict
+        Maps a node to how long it takes to build
+    default : float, optional
+        Duration to use for the nodes that are not in `durations`
 
+    Returns
+    -------
+    dict
+        Maps each node to the duration of the longest chain of builds that
+        starts with it. Building the nodes with the longest chains first keeps
+        them from holding up the end of a parallel build.
+
+    >>> lengths = critical_path_lengths({'a': [], 'b': ['a'], 'c': []},
+    ...                                 {'a': 1, 'b': 10, 'c': 5})
+    >>> sorted(lengths.items())
+    [('a', 11), ('b', 10), ('c', 5)]
     """
-    build_or_test_failed = []
-    build_success = []
-    # for each package
-    for meta in build_order:
-        full_build_path = meta.full_build_path
-        build_name = meta.build_name
-        build_command = meta.build_command
-        # output the package build name
-        print("Building: %s" % build_name)
-        # need to run the build command with --output again or conda freaks out
-        # stdout, stderr, returncode = Popen(build_command + ['--output'])
-        # output the build command
-        print("Build cmd: %s" % ' '.join(build_command))
-        np = ''
-        try:
-            np_idx = build_command.index('--numpy')
-        except ValueError:
-            # --numpy is not in build_command
-            pass
-        else:
-            # get the numpy version as the argument following the `--numpy`
-            # flag
-            np = build_command[np_idx+1]
-        with env_var('CONDA_NPY', np):
-            stdout, stderr, returncode = Popen(build_command)
-        if returncode != 0:
-            build_or_test_failed.append(build_name)
-            message = ('\n\n========== STDOUT ==========\n'
-                       '\n{}'
-                       '\n\n========== STDERR ==========\n'
-                       '\n{}'.format(pformat(stdout), pformat(stderr)))
-            logger.error(message)
-            if not allow_failures:
-                sys.exit(1)
-
-        build_success.append(build_name)
+    dependents = {}
+    for node, deps in package_dependencies.items():
+        for dep in set(deps):
+            dependents.setdefault(dep, []).append(node)
+    lengths = {}
+    for node in reversed(list(resolve_dependencies(package_dependencies))):
+        downstream = [lengths[dependent]
+                      for dependent in dependents.get(node, ())]
+        lengths[node] = (durations.get(node, default) +
+                         max(downstream or [0]))
+    return lengths
+
+
+def transitive_dependents(package_dependencies, nodes):
+    """Everything that depends on `nodes`, directly or further down
 
-    return {
-        'build_success': sorted(build_success),
-        'build_or_test_failed': sorted(build_or_test_failed),
-    }
+    Parameters
+    ----------
+    package_dependencies : dict
+        Maps a node to the nodes it depends on. Same as for
+        `resolve_dependencies`
+    nodes : iterable
+        The nodes to start from. They are not part of the result unless
+        they depend on each other
 
+    Returns
+    -------
+    set
 
-def pdb_hook(exctype, value, traceback):
-    pdb.post_mortem(traceback)
+    >>> sorted(transitive_dependents({'a': [], 'b': ['a'], 'c': ['b'],
+    ...                               'd': []}, ['a']))
+    ['b', 'c']
+    """
+    dependents = {}
+    for node, deps in package_dependencies.items():
+        for dep in set(deps):
+            dependents.setdefault(dep, []).append(node)
+    found = set()
+    todo = list(nodes)
+    while todo:
+        for dependent in dependents.get(todo.pop(), ()):
+            if dependent not in found:
+                found.add(dependent)
+                todo.append(dependent)
+    return found
+
+
+def sort_build_order(metas, dependency_graph=None):
+    """Put Variant records in the order that they need to be built in
+
+    The variants are grouped by package name once and then emitted in the
+    order that `resolve_dependencies` puts the package names in, so this is
+    linear in the number of variants. Variants of the same package keep the
+    order they were passed in.
+
+    Parameters
+    ----------
+    metas : iterable of Variant records
+        Probably `metas_to_build` from `decide_what_to_build`
+    dependency_graph : dict, optional
+        The output of `build_dependency_graph(metas)`, if it has already been
+        called
+
+    Returns
+    -------
+    list
+        The Variant records in build order
+    """
+    if dependency_graph is None:
+        dependency_graph = build_dependency_graph(metas)
+    by_name = {}
+    for meta in metas:
+        by_name.setdefault(meta.name, []).append(meta)
+    return [meta for name in resolve_dependencies(dependency_graph)
+            for meta in by_name.get(name, ())]
+
+
+def compute_input_hashes(metas, dependency_graph=None, recipe_hashes=None,
+                         solver=None, jobs=1):
+    """Hash everything that goes into building each variant
+
+    The hash covers the contents of the recipe, the variant, its build
+    requirements, the conda-build version and the hashes of the variants it
+    depends on, so a change to a recipe changes the hash of everything
+    downstream of it too. The hash is set as `input_hash` on each variant.
+
+    With a `solver`, the build requirements are the exact packages that they
+    resolve to, so a new release of a requirement that is not pinned changes
+    the hash too. Variants whose build environment cannot be solved, and
+    everything downstream of them, get no hash.
+
+    Parameters
+    ----------
+    metas : iterable
+        Variant records
+    dependency_graph : dict, optional
+        Maps build_name -> the build_names it depends on, probably from
+        `build_variant_graph`
+    recipe_hashes : dict, optional
+        Maps recipe_dir -> `hash_recipe_dir` of it, for the recipes that
+        have been hashed already
+    solver : Solver, optional
+        Resolves the build requirements. Without one they are hashed as
+        declared
+    jobs : int, optional
+        Number of build environments to solve at the same time
+
+    Returns
+    -------
+    dict
+        Maps build_name -> input hash, or None
+    """
+    metas = list(metas)
+    by_build_name = dict((meta.build_name, meta) for meta in metas)
+    dependency_graph = dependency_graph or {}
+    graph = {}
+    for meta in metas:
+        graph[meta.build_name] = [
+            dep for dep in dependency_graph.get(meta.build_name, ())
+            if dep in by_build_name]
+    recipe_hashes = dict(recipe_hashes or {})
+    build_envs = {}
+    if solver is not None:
+        # the packages built in this run are covered by the upstream hashes
+        planned = set(meta.name for meta in metas)
+        specs = dict((meta.build_name, build_env_specs(meta, planned))
+                     for meta in metas)
+        solutions = _solve_all([specs[meta.build_name] for meta in metas
+                                if specs[meta.build_name]], solver, jobs)
+        for meta in metas:
+            if not specs[meta.build_name]:
+                build_envs[meta.build_name] = []
+                continue
+            solution = solutions[env_key(specs[meta.build_name])]
+            if solution and solution['packages'] is not None:
+                build_envs[meta.build_name] = solution['packages']
+    hashes = {}
+    for build_name in resolve_dependencies(graph):
+        meta = by_build_name[build_name]
+        if meta.recipe_dir not in recipe_hashes:
+            recipe_hashes[meta.recipe_dir] = hash_recipe_dir(meta.recipe_dir)
+        upstream = [hashes[dep] for dep in graph[build_name]]
+        if ((solver is not None and build_name not in build_envs) or
+                None in upstream):
+            # not known what it would be built with
+            hashes[build_name] = meta.input_hash = None
+            continue
+        hashes[build_name] = hash_key(
+            recipe=recipe_hashes[meta.recipe_dir], build_name=build_name,
+            python=meta.python, numpy=meta.numpy,
+            build_deps=sorted(meta.build_deps),
+            build_env=build_envs.get(build_name),
+            upstream=sorted(upstream),
+            conda_build=conda_build.__version__)
+        meta.input_hash = hashes[build_name]
+    return hashes
+
+
+def update_local_index(folders):
+    """Index local channel folders so that conda build sees new packages"""
+    for folder in sorted(set(folders)):
+        try:
+            if conda_build_api is not None and hasattr(conda_build_api,
+                                                       'update_index'):
+                conda_build_api.update_index(folder)
+            else:
+                check_output(['conda', 'index', folder])
+        except Exception as e:
+            logger.warning('Could not index %s: %s', folder, e)
+
+
+def restore_artifacts(metas, store, jobs=8):
+    """Restore the variants that are in `store` instead of building them
+
+    Parameters
+    ----------
+    metas : iterable
+        Variant records with their `input_hash` set
+    store : ArtifactStore or TieredArtifactCache
+    jobs : int, optional
+        Number of variants to look up at the same time. Lookups in a shared
+        cache are mostly waiting on the network
+
+    Returns
+    -------
+    restored, remaining : list
+        The variants that were restored to their `full_build_path`, and the
+        ones that still need building
+    """
+    metas = list(metas)
+
+    def restore(meta):
+        return bool(meta.input_hash) and store.get(meta.input_hash,
+                                                   meta.full_build_path)
+
+    if jobs > 1 and len(metas) > 1:
+        pool = ThreadPool(min(jobs, len(metas)))
+        try:
+            found = pool.map(restore, metas, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        found = [restore(meta) for meta in metas]
+    restored = []
+    remaining = []
+    for meta, hit in zip(metas, found):
+        if hit:
+            logger.info('Restored %s from %r', meta.build_name, store)
+            restored.append(meta)
+        else:
+            remaining.append(meta)
+    if restored:
+        # so that the builds downstream of them can find them
+        update_local_index(os.path.dirname(meta.full_build_path)
+                           for meta in restored)
+    return restored, remaining
+
+
+def store_artifact(store, meta, path=None):
+    """Put a freshly built variant in `store`. Failing to is not fatal"""
+    if store is None or not meta.input_hash:
+        return
+    try:
+        store.put(meta.input_hash, path or meta.full_build_path)
+    except TRANSFER_ERRORS as e:
+        logger.warning('Could not store %s: %s', meta.build_name, e)
+
+
+def build_env_specs(meta, exclude=()):
+    """The conda specs of the environment that a variant is built in
+
+    The build requirements of the recipe with python and 'numpy x.x' pinned
+    to the versions of the variant. The ones on packages in `exclude`, like
+    the packages built in the same run, are left out
+
+    >>> meta = Variant('a', '1', '3.5', '1.11', '/bld/linux-64/a-1-0.tar.bz2',
+    ...                [], build_deps=['python', 'numpy x.x', 'six >=1.9'])
+    >>> build_env_specs(meta)
+    ['numpy 1.11*', 'python 3.5*', 'six >=1.9']
+    >>> build_env_specs(meta, exclude={'six'})
+    ['numpy 1.11*', 'python 3.5*']
+    """
+    return _pin_specs(meta.build_deps, meta, exclude)
+
+
+def test_env_specs(meta, exclude=()):
+    """The conda specs of the environment that a variant is tested in
+
+    The run and test requirements of the recipe, pinned and left out like
+    in `build_env_specs`. The package itself is not in them, it does not
+    exist until it is built
+
+    >>> meta = Variant('a', '1', '3.5', '1.11', '/bld/linux-64/a-1-0.tar.bz2',
+    ...                [], run_deps=['python', 'numpy x.x'],
+    ...                test_deps=['nose'])
+    >>> test_env_specs(meta)
+    ['nose', 'numpy 1.11*', 'python 3.5*']
+    """
+    return _pin_specs(meta.run_deps + meta.test_deps, meta, exclude)
+
+
+def _pin_specs(deps, meta, exclude=()):
+    specs = set()
+    for dep in deps:
+        name = dep.split()[0]
+        if name in exclude:
+            continue
+        if name == 'python':
+            specs.add('python {}*'.format(meta.python))
+        elif dep.split()[1:] == ['x.x']:
+            specs.add('{} {}*'.format(name, meta.numpy))
+        else:
+            specs.add(dep)
+    return sorted(specs)
+
+
+def solve_environments(metas, solver, jobs=1):
+    """Solve the build and test environments of every variant before building
+
+    Requirements on packages that are built in the same run are left out,
+    they cannot be solved until those are built. Variants that need the same
+    environment share one solve.
+
+    Parameters
+    ----------
+    metas : iterable
+        Variant records
+    solver : Solver
+        Solves the environments and keeps the solutions for the rest of the
+        run
+    jobs : int, optional
+        Number of environments to solve at the same time
+
+    Returns
+    -------
+    dict
+        Maps the build_name of each variant whose build or test requirements
+        cannot be met -> why
+    """
+    metas = list(metas)
+    planned = set(meta.name for meta in metas)
+    spec_sets = {}
+    for meta in metas:
+        for kind, specs in (('build', build_env_specs(meta, planned)),
+                            ('test', test_env_specs(meta, planned))):
+            if specs:
+                spec_sets.setdefault(env_key(specs), (specs, []))[1].append(
+                    (meta, kind))
+    spec_sets = [spec_sets[key] for key in sorted(spec_sets)]
+    logger.info('Solving %s environments for %s variants', len(spec_sets),
+                len(metas))
+    solutions = _solve_all([specs for specs, _ in spec_sets], solver, jobs)
+    unsatisfiable = {}
+    for specs, users in spec_sets:
+        solution = solutions[env_key(specs)]
+        if not solution or not solution['unsatisfiable']:
+            continue
+        for meta, kind in users:
+            unsatisfiable.setdefault(meta.build_name, '{} requirements {} '
+                                     'cannot be met: {}'.format(
+                                         kind, ' '.join(specs),
+                                         solution['unsatisfiable']))
+    return unsatisfiable
+
+
+def _solve_all(spec_lists, solver, jobs=1):
+    # env_key -> solution of each distinct list of specs, `jobs` at a time
+    todo = dict((env_key(specs), specs) for specs in spec_lists)
+    keys = sorted(todo)
+    if jobs > 1 and len(keys) > 1:
+        pool = ThreadPool(min(jobs, len(keys)))
+        try:
+            solutions = pool.map(solver.solve, [todo[key] for key in keys],
+                                 chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        solutions = [solver.solve(todo[key]) for key in keys]
+    return dict(zip(keys, solutions))
+
+
+def build_env_vars(build_command, cpus=None):
+    """The environment variables that a conda build command needs set
+
+    Parameters
+    ----------
+    build_command : list
+        The conda build command
+    cpus : int, optional
+        If not None, set CPU_COUNT so that the build script uses this many
+        cores. Otherwise CPU_COUNT is left to the environment, where conda
+        build takes it to mean every core on the machine if it is not set
+
+    Returns
+    -------
+    dict
+        CONDA_NPY set to the --numpy version of the command, and CPU_COUNT
+        if `cpus` is given
+    """
+    np = ''
+    try:
+        np_idx = build_command.index('--numpy')
+    except ValueError:
+        # --numpy is not in build_command
+        pass
+    else:
+        # get the numpy version as the argument following the `--numpy`
+        # flag
+        np = build_command[np_idx+1]
+    env = {'CONDA_NPY': np}
+    if cpus is not None:
+        env['CPU_COUNT'] = str(cpus)
+    return env
+
+
+def build_env(build_command, cpus=None):
+    """The environment to run a conda build command in
+
+    Builds can run in parallel threads, so rather than setting CONDA_NPY in
+    os.environ with `env_var` each build gets its own copy of the environment
+
+    Parameters
+    ----------
+    build_command : list
+        The conda build command
+    cpus : int, optional
+        See `build_env_vars`
+
+    Returns
+    -------
+    dict
+        os.environ updated with `build_env_vars`
+    """
+    env = dict(os.environ)
+    env.update(build_env_vars(build_command, cpus))
+    return env
+
+
+def build_priorities(build_order, dependency_graph, history=None):
+    """How urgent each build is: the length of the chain of builds after it
+
+    Parameters
+    ----------
+    build_order : list
+        Variant records
+    dependency_graph : dict
+        Maps build_name -> the build_names it depends on
+    history : BuildHistory, optional
+        How long the builds took on previous runs. Variants that have never
+        been built are assumed to take as long as the typical one that has
+
+    Returns
+    -------
+    dict
+        build_name -> seconds on the critical path from it to the end
+    """
+    return critical_path_lengths(dependency_graph,
+                                 expected_durations(build_order, history))
+
+
+def expected_durations(build_order, history=None):
+    """How long each build should take, going by the previous runs
+
+    Parameters
+    ----------
+    build_order : list
+        Variant records
+    history : BuildHistory, optional
+        How long the builds took on previous runs. Variants that have never
+        been built are assumed to take as long as the typical one that has
+
+    Returns
+    -------
+    dict
+        build_name -> seconds
+    """
+    durations = {}
+    if history is not None:
+        for meta in build_order:
+            duration = history.get(
+                history.key(meta.name, meta.python, meta.numpy))
+            if duration is not None:
+                durations[meta.build_name] = duration
+    known = sorted(durations.values())
+    default = known[len(known) // 2] if known else 1.0
+    for meta in build_order:
+        durations.setdefault(meta.build_name, default)
+    return durations
+
+
+def run_build(build_order, allow_failures=False, jobs=1,
+              dependency_graph=None, history=None, cpus=None, memory=None,
+              log_dir=DEFAULT_BUILD_LOG_DIR, timeout=None,
+              output_timeout=None, checkpoint=None, keep_going=False,
+              artifact_store=None, prefetcher=None):
+    """Build packages that do not already exist at {{ channel }}
+
+    Up to `jobs` builds run at the same time. A build starts once everything
+    it depends on in `dependency_graph` has been built. When more than one
+    build is ready to go, the one with the longest chain of builds downstream
+    of it (timed with `history`) goes first, so that long chains do not hold
+    up the end of the run. Without a dependency graph every chain is a
+    single build, so with `history` the builds that took longest last time
+    go first. Ties go to the one that comes first in `build_order`, so
+    without a dependency graph or `history` the packages are built in
+    exactly `build_order`.
+
+    If `cpus` or `memory` are given, builds are also packed so that the cores
+    and memory that the running builds declare (see `get_resources`) stay
+    within them. A build that needs more than the whole budget is run on its
+    own. When the most urgent ready build does not fit yet, room is kept for
+    it: smaller builds only go ahead of it if they should be done before it
+    can start, or fit next to it.
+
+    Parameters
+    ----------
+    build_order : iterable
+        The order that the packages should be built in
+    recipes_path : str
+        Iterable of Variant records.
+        HINT: output of `decide_what_to_build` is probably what should be
+        passed in here
+    allow_failures : bool, optional
+        True: Keep building after a build fails. Builds that depend on the
+        failed one still get built. False: Do not start any more builds
+        once one fails, wait for the running ones and exit with status 1
+    jobs : int, optional
+        How many builds to run at once. Defaults to 1
+    dependency_graph : dict, optional
+        Maps build_name -> the build_names it depends on, probably from
+        `build_variant_graph`. Dependencies that are not in `build_order`
+        are ignored. Defaults to no dependencies, which is only safe with
+        `jobs=1`
+    history : BuildHistory, optional
+        How long the builds took on previous runs. The durations of the
+        successful builds are recorded in it and saved as they finish
+    cpus : int, optional
+        Total cores that the running builds can use. Defaults to no limit.
+        Builds that do not declare how many they use get CPU_COUNT set to
+        an even share of them when `jobs` > 1, and are counted as that many.
+        With `jobs=1` they are counted as one and CPU_COUNT is left alone
+    memory : int, optional
+        Total megabytes of memory that the running builds can use. Defaults
+        to no limit
+    log_dir : str, optional
+        Folder to write the output of each build to (see `build_log_path`)
+    timeout : float, optional
+        Seconds a build may take before it is killed, for the recipes that
+        do not set their own (see `get_timeouts`). Defaults to no limit
+    output_timeout : float, optional
+        Seconds a build may go without output before it is killed, for the
+        recipes that do not set their own. Defaults to no limit
+    checkpoint : Checkpoint, optional
+        Where to record the state of each build as it starts and finishes
+    keep_going : bool, optional
+        True: When a build fails, skip everything that depends on it in
+        `dependency_graph`, but keep building the rest. Takes precedence
+        over `allow_failures`
+    artifact_store : ArtifactStore or TieredArtifactCache, optional
+        Where to keep the successful builds, under their `input_hash`
+    prefetcher : Prefetcher, optional
+        If given, the packages of the build requirements of every variant
+        (see `build_env_specs`), but for the ones built in this run, are
+        fetched in the background, highest priority first, and a build waits
+        for its own to be fetched
+
+    Returns
+    -------
+    dict
+        The build_names that were built in 'build_success', that failed in
+        'build_or_test_failed', that were killed by a timeout in
+        'build_timed_out' and that were skipped because something they
+        depend on failed in 'upstream_failed'
+    """
+    build_or_test_failed = []
+    build_timed_out = []
+    build_success = []
+    upstream_failed = []
+    build_order = list(build_order)
+    dependency_graph = dependency_graph or {}
+    planned = {}
+    for idx, meta in enumerate(build_order):
+        planned[meta.build_name] = (idx, meta)
+
+    # Kahn style bookkeeping so that finding the next build to start is cheap
+    graph = {}
+    num_deps = {}
+    dependents = {}
+    for meta in build_order:
+        deps = set(dep for dep in dependency_graph.get(meta.build_name, ())
+                   if dep in planned)
+        graph[meta.build_name] = deps
+        num_deps[meta.build_name] = len(deps)
+        for dep in deps:
+            dependents.setdefault(dep, []).append(meta.build_name)
+
+    # Critical path first
+    durations = expected_durations(build_order, history)
+    priority = critical_path_lengths(graph, durations)
+    ready = [(-priority[meta.build_name], idx, meta.build_name)
+             for idx, meta in enumerate(build_order)
+             if not num_deps[meta.build_name]]
+    heapq.heapify(ready)
+
+    # packages built in this run are not anywhere to be fetched yet. Left
+    # out the same way as in `solve_environments`, so that the prefetch
+    # finds the solutions of the preflight
+    in_tree = set(meta.name for meta in build_order)
+    if prefetcher is not None:
+        # in the order that the builds will most likely start in
+        upcoming = sorted((-priority[meta.build_name], idx)
+                          for idx, meta in enumerate(build_order))
+        prefetcher.start(build_env_specs(build_order[idx], in_tree)
+                         for _, idx in upcoming)
+
+    # the cores that builds which do not say are given, if they have to share
+    share = None
+    if jobs > 1:
+        share = max(DEFAULT_BUILD_CPUS,
+                    (cpus or multiprocessing.cpu_count()) // jobs)
+
+    def build_cpus(meta):
+        return meta.cpus or share
+
+    finished = Queue()
+
+    def build(meta, log_path):
+        start = time.time()
+        returncode, tail, timed_out = -1, '', None
+        try:
+            specs = build_env_specs(meta, in_tree)
+            if prefetcher is not None and specs:
+                # so that conda build does not download the same packages
+                # while the prefetch is at it
+                prefetcher.fetch(specs)
+            returncode, tail, timed_out = run_logged(
+                meta.build_command, log_path,
+                env=build_env(meta.build_command, build_cpus(meta)),
+                timeout=meta.timeout or timeout,
+                output_timeout=meta.output_timeout or output_timeout)
+            if returncode == 0 and not timed_out:
+                # here rather than in the main loop, because pushing to a
+                # shared cache can take a while
+                store_artifact(artifact_store, meta)
+        except Exception:
+            returncode, tail, timed_out = -1, traceback.format_exc(), None
+        finally:
+            # do not leave the main loop waiting for this build forever, no
+            # matter what happened to it
+            finished.put((meta, log_path, tail, returncode, timed_out,
+                          time.time() - start))
+
+    def needs(meta):
+        return build_cpus(meta) or DEFAULT_BUILD_CPUS, meta.memory or 0
+
+    max_cpus = float('inf') if cpus is None else cpus
+    max_memory = float('inf') if memory is None else memory
+
+    def fits(meta, free_cpus, free_memory):
+        need_cpus, need_memory = needs(meta)
+        return need_cpus <= free_cpus and need_memory <= free_memory
+
+    def next_build():
+        # The highest priority build, if it fits in what is left of the
+        # budget. If nothing is running, it goes no matter how big it is
+        top = planned[ready[0][2]][1]
+        if not running or fits(top, max_cpus - used_cpus,
+                               max_memory - used_memory):
+            return heapq.heappop(ready)
+        # Otherwise the resources are held for it: find out when enough of
+        # the running builds should be done for it to fit, and only start
+        # smaller builds that will be done by then or fit next to it
+        # ("EASY backfilling")
+        need_cpus, need_memory = needs(top)
+        free_cpus = max_cpus - used_cpus
+        free_memory = max_memory - used_memory
+        reserved_at = now = time.time()
+        for end, build_name in sorted((end, build_name) for build_name, end
+                                      in expected_ends.items()):
+            freed_cpus, freed_memory = needs(planned[build_name][1])
+            free_cpus += freed_cpus
+            free_memory += freed_memory
+            reserved_at = max(reserved_at, end)
+            if need_cpus <= free_cpus and need_memory <= free_memory:
+                break
+        spare_cpus = max(free_cpus - need_cpus, 0)
+        spare_memory = max(free_memory - need_memory, 0)
+        for item in sorted(ready)[1:]:
+            meta = planned[item[2]][1]
+            if not fits(meta, max_cpus - used_cpus, max_memory - used_memory):
+                continue
+            if (now + durations[meta.build_name] <= reserved_at or
+                    fits(meta, spare_cpus, spare_memory)):
+                ready.remove(item)
+                heapq.heapify(ready)
+                return item
+        return None
+
+    running = 0
+    used_cpus = 0
+    used_memory = 0
+    # build_name -> when the running builds should be done
+    expected_ends = {}
+    stop = False
+    while running or (ready and not stop):
+        while ready and not stop and running < jobs:
+            item = next_build()
+            if item is None:
+                # wait for something to finish and free up resources
+                break
+            _, idx, build_name = item
+            meta = planned[build_name][1]
+            need_cpus, need_memory = needs(meta)
+            used_cpus += need_cpus
+            used_memory += need_memory
+            expected_ends[build_name] = time.time() + durations[build_name]
+            # output the package build name
+            print("Building: %s" % build_name)
+            # need to run the build command with --output again or conda
+            # freaks out
+            # stdout, stderr, returncode = Popen(build_command + ['--output'])
+            # output the build command
+            print("Build cmd: %s" % ' '.join(meta.build_command))
+            log_path = build_log_path(log_dir, build_name)
+            print("Build log: %s" % log_path)
+            if checkpoint is not None:
+                checkpoint.set_state(build_name, checkpoint.BUILDING)
+            thread = threading.Thread(target=build, args=(meta, log_path))
+            thread.daemon = True
+            thread.start()
+            running += 1
+
+        # wait in short chunks so that signals still get handled
+        while True:
+            try:
+                (meta, log_path, tail, returncode, timed_out,
+                 duration) = finished.get(timeout=1)
+            except Empty:
+                continue
+            break
+        running -= 1
+        del expected_ends[meta.build_name]
+        need_cpus, need_memory = needs(meta)
+        used_cpus -= need_cpus
+        used_memory -= need_memory
+        if checkpoint is not None:
+            checkpoint.set_state(
+                meta.build_name, checkpoint.SUCCEEDED if returncode == 0 and
+                not timed_out else checkpoint.FAILED)
+        if timed_out or returncode != 0:
+            if timed_out:
+                build_timed_out.append(meta.build_name)
+                logger.error('%s was killed because it %s',
+                             meta.build_name, timed_out)
+            else:
+                build_or_test_failed.append(meta.build_name)
+            logger.error('%s failed. The full output is in %s'
+                         '\n\n========== END OF OUTPUT ==========\n\n%s',
+                         meta.build_name, log_path, tail)
+            if keep_going:
+                # the dependents never become ready, because the failed
+                # build does not count towards their dependencies. Just say
+                # so
+                for skipped in sorted(
+                        transitive_dependents(graph, [meta.build_name]) -
+                        set(upstream_failed)):
+                    upstream_failed.append(skipped)
+                    logger.error('Skipping %s: upstream %s failed', skipped,
+                                 meta.build_name)
+                    if checkpoint is not None:
+                        checkpoint.set_state(skipped, checkpoint.SKIPPED,
+                                             upstream=meta.build_name)
+                continue
+            if not allow_failures:
+                # let the running builds finish, but do not start new ones
+                stop = True
+                continue
+        else:
+            build_success.append(meta.build_name)
+            if history is not None:
+                history.record(history.key(meta.name, meta.python, meta.numpy),
+                               duration)
+                history.save()
+        for dependent in dependents.get(meta.build_name, ()):
+            num_deps[dependent] -= 1
+            if num_deps[dependent] == 0:
+                heapq.heappush(ready, (-priority[dependent],
+                                       planned[dependent][0], dependent))
+
+    if stop:
+        sys.exit(1)
+
+    return {
+        'build_success': sorted(build_success),
+        'build_or_test_failed': sorted(build_or_test_failed),
+        'build_timed_out': sorted(build_timed_out),
+        'upstream_failed': sorted(upstream_failed),
+    }
+
+
+def run_distributed(build_order, queue_path, allow_failures=False,
+                    dependency_graph=None, history=None,
+                    poll_interval=DEFAULT_POLL_INTERVAL, timeout=None,
+                    output_timeout=None, checkpoint=None, keep_going=False,
+                    artifact_store=None, lease=DEFAULT_LEASE):
+    """Publish the builds to a work queue and wait for workers to build them
+
+    This is the coordinator side of `run_build` for builds that are spread
+    over several machines. `buildmatrix worker` processes pointed at
+    `queue_path` do the actual building (see `run_worker`).
+
+    Parameters
+    ----------
+    build_order : iterable
+        Iterable of Variant records
+    queue_path : str
+        The sqlite database of the work queue. Whatever was in it before is
+        replaced
+    allow_failures : bool, optional
+        True: Keep building after a build fails. False: Do not hand out any
+        more builds once one fails, wait for the running ones and exit with
+        status 1
+    dependency_graph : dict, optional
+        Maps build_name -> the build_names it depends on
+    history : BuildHistory, optional
+        Used to hand out the builds on the critical path first. The
+        durations of the successful builds are recorded in it
+    poll_interval : float, optional
+        Seconds to wait between looking at the queue
+    timeout, output_timeout : float, optional
+        Same as `run_build`. The workers enforce them
+    checkpoint : Checkpoint, optional
+        Where to record the state of each build as the workers report it
+    keep_going : bool, optional
+        Same as `run_build`
+    artifact_store : ArtifactStore or TieredArtifactCache, optional
+        Where to keep the packages that the workers copy back
+    lease : float, optional
+        Seconds a worker may go without a sign of life before its build is
+        handed to another worker
+
+    Returns
+    -------
+    dict
+        Same as `run_build`
+    """
+    build_order = list(build_order)
+    dependency_graph = dependency_graph or {}
+    planned = set(meta.build_name for meta in build_order)
+    graph = {}
+    for meta in build_order:
+        graph[meta.build_name] = set(
+            dep for dep in dependency_graph.get(meta.build_name, ())
+            if dep in planned)
+    priority = build_priorities(build_order, graph, history)
+    # so that the workers can tell if their checkout of a recipe differs
+    recipe_hashes = dict((recipe_dir, hash_recipe_dir(recipe_dir))
+                         for recipe_dir in set(meta.recipe_dir
+                                               for meta in build_order)
+                         if recipe_dir)
+    jobs = [{'build_name': meta.build_name,
+             'command': meta.build_command,
+             'env': build_env_vars(meta.build_command, meta.cpus),
+             'full_build_path': meta.full_build_path,
+             'recipe_dir': meta.recipe_dir,
+             'recipe_hash': recipe_hashes.get(meta.recipe_dir),
+             'priority': priority[meta.build_name],
+             'timeout': meta.timeout or timeout,
+             'output_timeout': meta.output_timeout or output_timeout}
+            for meta in build_order]
+    by_build_name = dict((meta.build_name, meta) for meta in build_order)
+
+    build_or_test_failed = []
+    build_timed_out = []
+    build_success = []
+    upstream_failed = []
+    stop = False
+    queue = WorkQueue(queue_path)
+    try:
+        # with keep_going the queue holds back the dependents of failed
+        # builds by itself
+        queue.publish(jobs, graph,
+                      allow_failures=allow_failures and not keep_going,
+                      lease=lease)
+        logger.info('Published %s builds to %s', len(jobs), queue_path)
+        reported = set()
+        while True:
+            # builds of workers that died would keep the queue from ever
+            # being done
+            queue.requeue_expired()
+            # look at is_done first so that builds which finish in between
+            # are still picked up below
+            done = queue.is_done()
+            finished = (queue.jobs(SUCCEEDED) + queue.jobs(FAILED) +
+                        queue.jobs(TIMED_OUT))
+            for job in finished:
+                if job['build_name'] in reported:
+                    continue
+                reported.add(job['build_name'])
+                if checkpoint is not None:
+                    checkpoint.set_state(
+                        job['build_name'], checkpoint.SUCCEEDED
+                        if job['state'] == SUCCEEDED else checkpoint.FAILED,
+                        artifact=job['artifact'])
+                if job['state'] == TIMED_OUT:
+                    build_timed_out.append(job['build_name'])
+                elif job['state'] == FAILED:
+                    build_or_test_failed.append(job['build_name'])
+                if job['state'] != SUCCEEDED:
+                    logger.error('%s failed on %s\n\n========== END OF '
+                                 'OUTPUT ==========\n\n%s', job['build_name'],
+                                 job['worker'], job['output'])
+                    if keep_going:
+                        for skipped in sorted(
+                                transitive_dependents(
+                                    graph, [job['build_name']]) -
+                                set(upstream_failed)):
+                            upstream_failed.append(skipped)
+                            logger.error('Skipping %s: upstream %s failed',
+                                         skipped, job['build_name'])
+                            if checkpoint is not None:
+                                checkpoint.set_state(
+                                    skipped, checkpoint.SKIPPED,
+                                    upstream=job['build_name'])
+                    elif not allow_failures and not stop:
+                        # let the running builds finish, but do not hand
+                        # out new ones
+                        stop = True
+                        queue.cancel_pending()
+                    continue
+                build_success.append(job['build_name'])
+                logger.info('%s was built on %s: %s', job['build_name'],
+                            job['worker'], job['artifact'])
+                if job['artifact']:
+                    store_artifact(artifact_store,
+                                   by_build_name[job['build_name']],
+                                   job['artifact'])
+                if history is not None:
+                    meta = by_build_name[job['build_name']]
+                    history.record(
+                        history.key(meta.name, meta.python, meta.numpy),
+                        job['finished'] - job['started'])
+                    history.save()
+            if done:
+                # nothing can claim the skipped builds, but say so in the
+                # queue too
+                queue.cancel_pending()
+                break
+            time.sleep(poll_interval)
+    finally:
+        queue.close()
+
+    if stop:
+        sys.exit(1)
+
+    return {
+        'build_success': sorted(build_success),
+        'build_or_test_failed': sorted(build_or_test_failed),
+        'build_timed_out': sorted(build_timed_out),
+        'upstream_failed': sorted(upstream_failed),
+    }
+
+
+def collect_artifact(full_build_path, build_name, artifact_dir):
+    """Copy a built package to `artifact_dir`/`build_name`
+
+    Returns
+    -------
+    str or None
+        Where the package was copied to. None if it was not found
+    """
+    if not os.path.exists(full_build_path):
+        logger.warning('The build succeeded but %s does not exist',
+                       full_build_path)
+        return None
+    dest = os.path.join(artifact_dir, *build_name.split('/'))
+    dirname = os.path.dirname(dest)
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            # another worker made it first
+            if not os.path.isdir(dirname):
+                raise
+    # copy next to the destination and rename so that nobody sees half of it
+    tmp = os.path.join(dirname, '.tmp-{}-{}'.format(
+        os.getpid(), os.path.basename(dest)))
+    shutil.copy2(full_build_path, tmp)
+    os.rename(tmp, dest)
+    return dest
+
+
+def conda_bld_dir():
+    """The conda-bld folder that conda build puts packages in on this machine
+
+    Going by the conda build configuration here (croot in the .condarc,
+    CONDA_BLD_PATH), which can differ from the coordinator's
+    """
+    if hasattr(conda_build_config, 'Config'):
+        # conda-build >= 2.0
+        return conda_build_config.Config().croot
+    return conda_build_config.config.croot
+
+
+def recipe_mismatch(job):
+    """Why the recipe of a claimed build cannot be built here, if it cannot
+
+    The build command names the recipe folder on the coordinator, so the
+    recipes have to be checked out at the same path, with the same contents,
+    on every worker.
+
+    Returns
+    -------
+    str or None
+        None if the recipe is the same as on the coordinator
+    """
+    recipe_dir = job.get('recipe_dir')
+    if not recipe_dir or not job.get('recipe_hash'):
+        return None
+    if not os.path.isdir(recipe_dir):
+        return ('The recipe {} is not on this machine. The recipes need to '
+                'be checked out at the same path on every worker'.format(
+                    recipe_dir))
+    if hash_recipe_dir(recipe_dir) != job['recipe_hash']:
+        return ('The recipe {} on this machine is not the same as on the '
+                'coordinator. Check out the same revision on every '
+                'worker'.format(recipe_dir))
+    return None
+
+
+def fetch_upstream_artifacts(queue, job, bld_dir):
+    """Copy the packages that a claimed build depends on into the local
+    conda-bld and index it, so that conda build finds them even when they
+    were built on another machine
+
+    Parameters
+    ----------
+    queue : WorkQueue
+    job : dict
+        The claimed build, see `WorkQueue.claim`
+    bld_dir : str
+        The conda-bld folder of this machine, see `conda_bld_dir`
+    """
+    folders = []
+    for build_name, artifact in queue.upstream_artifacts(job['build_name']):
+        dest = os.path.join(bld_dir, *build_name.split('/'))
+        if os.path.exists(dest):
+            # built here, or fetched for an earlier build
+            continue
+        logger.info('Fetching %s from %s', build_name, artifact)
+        place(artifact, dest)
+        folders.append(os.path.dirname(dest))
+    update_local_index(folders)
+
+
+class _Heartbeat(object):
+    """Renews the lease of a worker on a build from a thread of its own,
+    with a connection of its own"""
+    def __init__(self, queue_path, build_name, worker):
+        self.queue_path = queue_path
+        self.build_name = build_name
+        self.worker = worker
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def _run(self):
+        queue = WorkQueue(self.queue_path)
+        try:
+            interval = queue.lease() / 3.
+            while not self._stop.wait(interval):
+                try:
+                    if not queue.heartbeat(self.build_name, self.worker):
+                        logger.warning('%s was handed to another worker',
+                                       self.build_name)
+                        return
+                except Exception as e:
+                    # the next one may get through before the lease is up
+                    logger.warning('Could not renew the lease on %s: %s',
+                                   self.build_name, e)
+        finally:
+            queue.close()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_worker(queue_path, artifact_dir=None,
+               poll_interval=DEFAULT_POLL_INTERVAL, name=None,
+               log_dir=DEFAULT_BUILD_LOG_DIR, bld_dir=None):
+    """Build whatever is ready in a work queue until there is nothing left
+
+    Before each build, the packages it depends on that were built by other
+    workers are copied into the local conda-bld (see
+    `fetch_upstream_artifacts`). The claim on the build is renewed while it
+    runs, so that the build goes back in the queue if this worker dies.
+
+    The recipes have to be checked out at the same path as on the
+    coordinator, with the same contents. A build whose recipe is not fails
+    with a message that says so (see `recipe_mismatch`).
+
+    Parameters
+    ----------
+    queue_path : str
+        The sqlite database that the coordinator publishes to
+    artifact_dir : str, optional
+        Where to copy the built packages to, in a folder per subdir.
+        Defaults to an 'artifacts' folder next to `queue_path`
+    poll_interval : float, optional
+        Seconds to wait when no build is ready
+    name : str, optional
+        What to call this worker in the queue. Defaults to hostname:pid
+    log_dir : str, optional
+        Folder to write the output of each build to. The end of the output
+        of failed builds is also reported to the queue
+    bld_dir : str, optional
+        The conda-bld folder that conda build puts packages in here.
+        Defaults to the one in the conda build configuration (see
+        `conda_bld_dir`)
+
+    Returns
+    -------
+    dict
+        The builds that this worker ran, like `run_build`
+    """
+    name = name or default_worker_name()
+    if bld_dir is None:
+        bld_dir = conda_bld_dir()
+    if artifact_dir is None:
+        artifact_dir = os.path.join(
+            os.path.dirname(os.path.abspath(queue_path)), 'artifacts')
+    build_or_test_failed = []
+    build_timed_out = []
+    build_success = []
+    queue = WorkQueue(queue_path)
+    try:
+        while not shutdown:
+            job = queue.claim(name)
+            if job is None:
+                if queue.is_done():
+                    break
+                time.sleep(poll_interval)
+                continue
+            print("Building: %s" % job['build_name'])
+            print("Build cmd: %s" % ' '.join(job['command']))
+            env = dict(os.environ)
+            env.update(job['env'])
+            log_path = build_log_path(log_dir, job['build_name'])
+            print("Build log: %s" % log_path)
+            artifact = None
+            # where the package ends up on this machine, rather than on the
+            # coordinator
+            full_build_path = os.path.join(bld_dir,
+                                           *job['build_name'].split('/'))
+            with _Heartbeat(queue_path, job['build_name'], name):
+                try:
+                    mismatch = recipe_mismatch(job)
+                    if mismatch is not None:
+                        logger.error(mismatch)
+                        returncode, tail, timed_out = -1, mismatch, None
+                    else:
+                        fetch_upstream_artifacts(queue, job, bld_dir)
+                        returncode, tail, timed_out = run_logged(
+                            job['command'], log_path, env=env,
+                            timeout=job['timeout'],
+                            output_timeout=job['output_timeout'])
+                    if returncode == 0 and not timed_out:
+                        artifact = collect_artifact(full_build_path,
+                                                    job['build_name'],
+                                                    artifact_dir)
+                except Exception:
+                    # report it, or the build stays running until the lease
+                    # runs out and then goes to the next worker to fail
+                    returncode, tail, timed_out = (-1, traceback.format_exc(),
+                                                   None)
+            if timed_out:
+                build_timed_out.append(job['build_name'])
+                logger.error('%s was killed because it %s', job['build_name'],
+                             timed_out)
+            elif returncode == 0:
+                build_success.append(job['build_name'])
+            else:
+                build_or_test_failed.append(job['build_name'])
+                logger.error('%s failed. The full output is in %s\n\n%s',
+                             job['build_name'], log_path, tail)
+            queue.report(job['build_name'], returncode, artifact=artifact,
+                         output=tail, timed_out=bool(timed_out), worker=name)
+    finally:
+        queue.close()
+    return {
+        'build_success': sorted(build_success),
+        'build_or_test_failed': sorted(build_or_test_failed),
+        'build_timed_out': sorted(build_timed_out),
+    }
+
+
+def worker_cli(argv=None):
+    p = ArgumentParser(
+        prog='buildmatrix worker',
+        description="""
+Build the packages that a `buildmatrix --queue` coordinator publishes to a
+work queue. Start as many workers as you like, on any machine that can see the
+queue and has the recipes checked out at the same path as the coordinator.
+They exit once there is nothing left to build.
+""",
+    )
+    p.add_argument(
+        'queue',
+        help="The work queue (sqlite database) that the coordinator uses"
+    )
+    p.add_argument(
+        '--artifact-dir',
+        help=("Folder to copy the built packages to. Defaults to an "
+              "'artifacts' folder next to the queue")
+    )
+    p.add_argument(
+        '--poll-interval', type=float, default=DEFAULT_POLL_INTERVAL,
+        help=("Seconds to wait when no build is ready. Defaults to "
+              "%(default)s")
+    )
+    p.add_argument(
+        '--name',
+        help="Name of this worker in the queue. Defaults to hostname:pid"
+    )
+    p.add_argument(
+        '--build-log-dir', default=DEFAULT_BUILD_LOG_DIR,
+        help=("Folder to write the output of each build to. Defaults to "
+              "%(default)s")
+    )
+    p.add_argument(
+        '-l', '--log',
+        nargs='?',
+        help='Name of the log file to write'
+    )
+    p.add_argument(
+        '-v', '--verbose', help="Enable DEBUG level logging. Default is INFO",
+        default=False, action="store_true"
+    )
+    args = p.parse_args(argv)
+    init_logging(log_file=args.log,
+                 loglevel=logging.DEBUG if args.verbose else logging.INFO)
+    results = run_worker(os.path.abspath(args.queue),
+                         artifact_dir=args.artifact_dir,
+                         poll_interval=args.poll_interval, name=args.name,
+                         log_dir=args.build_log_dir)
+    logger.info('Worker summary\n%s', pformat(results))
+    if results['build_or_test_failed'] or results['build_timed_out']:
+        sys.exit(1)
+
+
+def pdb_hook(exctype, value, traceback):
+    pdb.post_mortem(traceback)
 
 
 def cli():
+    if sys.argv[1:2] == ['worker']:
+        return worker_cli(sys.argv[2:])
     p = ArgumentParser(
         description="""
 Tool for building a folder of conda recipes where only the ones that don't
@@ -475,10 +2618,12 @@ already exist are built.
     )
     p.add_argument(
         '-c', "--channel",
-        action='store',
-        nargs='?',
-        help="Conda channel to check for pre-existing artifacts",
-        default="anaconda"
+        action='append',
+        help=("Conda channel to check for pre-existing artifacts. Can be "
+              "given more than once, in which case a package is not built if "
+              "it exists on any of them. A file:// url, absolute path or "
+              "path starting with ./ is read from disk. Defaults to "
+              "anaconda")
     )
     p.add_argument(
         '-l', '--log',
@@ -504,6 +2649,29 @@ already exist are built.
                                   "packages if one of them fails"),
         default=False, action="store_true"
     )
+    p.add_argument(
+        '-k', '--keep-going', default=False, action="store_true",
+        help=("When a build fails, skip the builds that depend on it but keep "
+              "building everything else")
+    )
+    p.add_argument(
+        '-j', '--jobs', type=int, default=1,
+        help=("Number of conda builds to run at the same time. A build starts "
+              "as soon as the builds it depends on are done. Defaults to "
+              "%(default)s")
+    )
+    p.add_argument(
+        '--cpus', type=int, default=multiprocessing.cpu_count(),
+        help=("Total cores that parallel builds can use. Recipes declare how "
+              "many they use in a {} file or under extra/buildmatrix in the "
+              "meta.yaml. Defaults to %(default)s".format(RESOURCES_FILE))
+    )
+    p.add_argument(
+        '--memory', type=parse_memory, default=total_memory(),
+        help=("Total memory that parallel builds can use, e.g. 64G. Recipes "
+              "declare how much they need like --cpus. Defaults to the "
+              "memory of this machine")
+    )
     p.add_argument(
         '--dry-run', help="Figure out what to build and then exit",
         default=False, action="store_true"
@@ -512,10 +2680,149 @@ already exist are built.
         '--plan-file', help="File to output json version of the plan",
         action="store"
     )
+    p.add_argument(
+        '--plan-jobs', help=("Number of processes to use to figure out the "
+                             "build names. Defaults to %(default)s"),
+        type=int, default=1, action="store"
+    )
+    p.add_argument(
+        '--render-engine', choices=RENDER_ENGINES, default='auto',
+        help=("How to figure out the build names. 'api' renders the recipes "
+              "in process with conda_build's api, 'subprocess' calls `conda "
+              "build --output` and 'auto' tries the api and falls back to the "
+              "subprocess. Defaults to %(default)s")
+    )
+    p.add_argument(
+        '--cache-dir', default=DEFAULT_CACHE_DIR,
+        help="Folder to keep buildmatrix's caches in. Defaults to %(default)s"
+    )
+    p.add_argument(
+        '--no-index-cache', dest='index_cache', default=True,
+        action='store_false',
+        help=("Do not cache the channel index on disk. Use conda's get_index "
+              "instead")
+    )
+    p.add_argument(
+        '--index-ttl', type=float, default=DEFAULT_INDEX_TTL,
+        help=("Seconds that a cached channel index is used without checking "
+              "the channel for changes. Defaults to %(default)s")
+    )
+    p.add_argument(
+        '--no-build-name-cache', dest='build_name_cache', default=True,
+        action='store_false',
+        help=("Do not reuse the build names figured out on previous runs for "
+              "recipes that have not changed")
+    )
+    p.add_argument(
+        '--build-name-cache-size', type=int,
+        default=DEFAULT_BUILD_NAME_CACHE_SIZE,
+        help=("Maximum number of build names to keep in the cache. Defaults "
+              "to %(default)s")
+    )
+    p.add_argument(
+        '--build-log-dir', default=DEFAULT_BUILD_LOG_DIR,
+        help=("Folder to write the output of each build to, as it runs. "
+              "Defaults to %(default)s")
+    )
+    p.add_argument(
+        '--build-timeout', type=parse_duration,
+        help=("Kill builds that take longer than this, e.g. 2h. Recipes can "
+              "set their own timeout like --cpus. Defaults to no limit")
+    )
+    p.add_argument(
+        '--output-timeout', type=parse_duration,
+        help=("Kill builds that print nothing for this long, e.g. 30m. "
+              "Recipes can set their own output_timeout. Defaults to no "
+              "limit")
+    )
+    p.add_argument(
+        '--checkpoint',
+        help=("File to record the plan and the state of every build in as "
+              "the run goes. Defaults to a file for the recipes_path in "
+              "--cache-dir/checkpoints. Dry runs leave it alone")
+    )
+    p.add_argument(
+        '--resume', default=False, action='store_true',
+        help=("Carry on from the --checkpoint of a run that died, skipping "
+              "the planning and the builds that already succeeded")
+    )
+    p.add_argument(
+        '--artifact-store', default=False, action='store_true',
+        help=("Keep the built packages in --cache-dir and restore packages "
+              "whose recipe and inputs have not changed from there instead "
+              "of building them. The inputs include the exact packages that "
+              "the build requirements resolve to")
+    )
+    p.add_argument(
+        '--artifact-store-size', type=parse_memory, default=DEFAULT_STORE_SIZE,
+        help=("How big the artifact store may get, e.g. 50G. The least "
+              "recently used packages are evicted first. Defaults to 20G")
+    )
+    p.add_argument(
+        '--artifact-store-age', type=parse_duration, default=DEFAULT_STORE_AGE,
+        help=("Evict packages from the artifact store that have not been used "
+              "for this long, e.g. 7d. Defaults to 30d")
+    )
+    p.add_argument(
+        '--artifact-cache',
+        help=("Url (http or https, taking GET and PUT) or folder of an "
+              "artifact cache shared between machines. Packages whose inputs "
+              "have not changed are downloaded from it instead of built, and "
+              "new packages are uploaded to it")
+    )
+    p.add_argument(
+        '--no-artifact-push', dest='artifact_push', default=True,
+        action='store_false',
+        help="Only download from the --artifact-cache, never upload to it"
+    )
+    p.add_argument(
+        '--prefetch', default=False, action='store_true',
+        help=("Download the packages that the builds need into conda's "
+              "package cache in the background, while the builds before "
+              "them run. Not with --queue")
+    )
+    p.add_argument(
+        '--prefetch-jobs', type=int, default=DEFAULT_PREFETCH_JOBS,
+        help=("Number of builds to fetch the packages of at the same time. "
+              "Defaults to %(default)s")
+    )
+    p.add_argument(
+        '--preflight', default=False, action='store_true',
+        help=("Before building anything, solve the build and test "
+              "environments of every variant, to find the ones whose "
+              "requirements cannot be met. They fail the run up front, or "
+              "are skipped with --keep-going or --allow-failures")
+    )
+    p.add_argument(
+        '--preflight-jobs', type=int, default=DEFAULT_PREFLIGHT_JOBS,
+        help=("Number of environments to solve at the same time, for "
+              "--preflight and the artifact store. Defaults to %(default)s")
+    )
+    p.add_argument(
+        '--queue',
+        help=("Do not build here. Publish the builds to a work queue (a "
+              "sqlite database on a filesystem that the workers can see) and "
+              "wait for `buildmatrix worker QUEUE` processes to build them")
+    )
+    p.add_argument(
+        '--poll-interval', type=float, default=DEFAULT_POLL_INTERVAL,
+        help=("Seconds between looks at the --queue. Defaults to "
+              "%(default)s")
+    )
+    p.add_argument(
+        '--queue-lease', type=float, default=DEFAULT_LEASE,
+        help=("Seconds a worker may go without a sign of life before its "
+              "build is handed to another worker. Defaults to %(default)s")
+    )
 
     args = p.parse_args()
+    if args.keep_going and args.allow_failures:
+        p.error('--keep-going skips the builds that depend on a failed one, '
+                '--allow-failures builds them anyway. Pick one')
     if not args.python:
         args.python = [DEFAULT_PY]
+    if not args.channel:
+        args.channel = ['anaconda']
     args_dct = dict(args._get_kwargs())
     use_pdb = args_dct.pop('pdb')
     if use_pdb:
@@ -525,11 +2832,6 @@ already exist are built.
     log = args_dct.pop('log')
     init_logging(log_file=log, loglevel=loglevel)
     args_dct['recipes_path'] = os.path.abspath(args.recipes_path)
-    if args_dct.get('channel') is None:
-        p.print_help()
-        logger.error("\nError: Need to pass in an anaconda channel with '-c' or "
-              "'--channel'\n")
-        sys.exit(1)
 
     logger.info(args_dct)
     run(**args_dct)
@@ -551,10 +2853,27 @@ def init_logging(log_file=None, loglevel=logging.INFO):
     logger.setLevel(loglevel)
 
     logger.addHandler(file_handler)
+    # and the helper modules, which log to 'buildmatrix.*'
+    package_logger = logging.getLogger('buildmatrix')
+    package_logger.setLevel(loglevel)
+    package_logger.addHandler(file_handler)
 
 
 def run(recipes_path, python, channel, numpy, allow_failures=False,
-        dry_run=False, plan_file=None):
+        dry_run=False, plan_file=None, plan_jobs=1, render_engine='auto',
+        cache_dir=DEFAULT_CACHE_DIR, build_name_cache=True,
+        build_name_cache_size=DEFAULT_BUILD_NAME_CACHE_SIZE, index_cache=True,
+        index_ttl=DEFAULT_INDEX_TTL, jobs=1, cpus=None, memory=None,
+        queue=None, poll_interval=DEFAULT_POLL_INTERVAL,
+        queue_lease=DEFAULT_LEASE,
+        build_log_dir=DEFAULT_BUILD_LOG_DIR, build_timeout=None,
+        output_timeout=None, checkpoint=None, resume=False,
+        keep_going=False, artifact_store=False,
+        artifact_store_size=DEFAULT_STORE_SIZE,
+        artifact_store_age=DEFAULT_STORE_AGE, artifact_cache=None,
+        artifact_push=True, prefetch=False,
+        prefetch_jobs=DEFAULT_PREFETCH_JOBS, preflight=False,
+        preflight_jobs=DEFAULT_PREFLIGHT_JOBS):
     """
     Run the build for all recipes listed in recipes_path
 
@@ -564,15 +2883,104 @@ def run(recipes_path, python, channel, numpy, allow_failures=False,
         Folder that contains conda recipes
     python : iterable
         Iterable of python versions to build conda packages for
-    channel : str
-        The channel to check for packages
+    channel : str or list
+        The channel(s) to check for packages
     numpy : iterable
         Iterable of numpy versions to build conda packages for
     allow_failures : bool, optional
         True: Continue building packages after one has failed.
         Defaults to False
     plan_file : str, optional
-        If not None, then output the plan to a file in json format
+        If not None, then output the plan to a file in json format: a list,
+        in build order, of the parsed meta.yaml of each build with the
+        `Variant.to_dict` of the build under 'variant'
+    plan_jobs : int, optional
+        Number of processes to use while figuring out what to build.
+        Defaults to 1
+    render_engine : {'auto', 'api', 'subprocess'}, optional
+        How to figure out the build names. See `determine_build_name`.
+        Defaults to 'auto'
+    cache_dir : str, optional
+        Folder to keep buildmatrix's caches in
+    build_name_cache : bool, optional
+        True: Reuse the build names of recipes that have not changed since the
+        last run. Defaults to True
+    build_name_cache_size : int, optional
+        Maximum number of build names to keep in the cache
+    index_cache : bool, optional
+        True: Keep the channel index in `cache_dir` and only download it
+        again when it has changed. Defaults to True
+    index_ttl : float, optional
+        Seconds that the cached channel index is used without checking the
+        channel for changes
+    jobs : int, optional
+        Number of conda builds to run at the same time. Defaults to 1
+    cpus : int, optional
+        Total cores that the running builds can use. Defaults to no limit
+    memory : int, optional
+        Total megabytes of memory that the running builds can use. Defaults
+        to no limit
+    queue : str, optional
+        If not None, publish the builds to the work queue in this sqlite
+        database and wait for `buildmatrix worker` processes to build them,
+        instead of building here. `jobs`, `cpus` and `memory` are ignored
+    poll_interval : float, optional
+        Seconds between looks at the `queue`
+    queue_lease : float, optional
+        Seconds a worker may go without a sign of life before its build is
+        handed to another worker
+    build_log_dir : str, optional
+        Folder to write the output of each build to
+    build_timeout : float, optional
+        Seconds a build may take before it is killed, unless its recipe says
+        otherwise. Defaults to no limit
+    output_timeout : float, optional
+        Seconds a build may go without output before it is killed, unless
+        its recipe says otherwise. Defaults to no limit
+    checkpoint : str, optional
+        File to record the plan and the state of each build in as the run
+        goes. Defaults to a file in `cache_dir`/checkpoints that is named
+        after `recipes_path`. Dry runs do not write it
+    resume : bool, optional
+        True: Pick up from the `checkpoint` of an earlier run with the same
+        recipes and options. The planning is skipped, and so are the builds
+        that succeeded and whose packages are still there. Defaults to False
+    keep_going : bool, optional
+        True: When a build fails, skip the builds that depend on it and keep
+        building everything else. Defaults to False
+    artifact_store : bool, optional
+        True: Keep the packages that get built in `cache_dir`, filed under a
+        hash of their inputs, and restore them from there instead of building
+        them again while the inputs stay the same. The build requirements go
+        into the hash as the packages that they resolve to (see
+        `compute_input_hashes`). Defaults to False
+    artifact_store_size : int, optional
+        Megabytes the artifact store may take up
+    artifact_store_age : float, optional
+        Seconds a package that is not used is kept in the artifact store for
+    artifact_cache : str, optional
+        An http(s) url or a folder of an artifact cache that is shared with
+        other machines. Packages are looked up in it, after the local
+        artifact store, by the same input hash
+    artifact_push : bool, optional
+        True: Upload the packages that get built to `artifact_cache`.
+        Defaults to True
+    prefetch : bool, optional
+        True: Download the packages of the build requirements of the builds
+        into conda's package cache in the background, while the builds
+        before them run. Ignored with `queue`. Defaults to False
+    prefetch_jobs : int, optional
+        Number of builds to fetch the packages of at the same time
+    preflight : bool, optional
+        True: Solve the build and test environments of every variant before
+        building anything. If the requirements of some cannot be met, the
+        run stops there, unless `keep_going` or `allow_failures` say to
+        build the rest. The solutions are kept for the rest of the run, and
+        `prefetch` fetches exactly the solved packages instead of solving
+        again. conda build still solves the environments it builds in.
+        Defaults to False
+    preflight_jobs : int, optional
+        Number of environments to solve at the same time
     """
     # check to make sure that the recipes_path exists
     if not os.path.exists(recipes_path):
@@ -582,28 +2990,170 @@ def run(recipes_path, python, channel, numpy, allow_failures=False,
         numpy = os.environ.get("CONDA_NPY", "1.11")
         if not isinstance(numpy, list):
             numpy = [numpy]
-    # get all file names that are in the channel I am interested in
-    packages = get_file_names_on_anaconda_channel(channel)
-
-    metas_to_build, metas_to_skip = decide_what_to_build(
-        recipes_path, python, packages, numpy)
+    if not isinstance(channel, (list, tuple)):
+        channel = [channel]
+
+    if checkpoint is None:
+        # one for each recipe tree, so that runs on different trees can share
+        # the cache dir without clobbering each other's checkpoint
+        checkpoint = os.path.join(
+            cache_dir, 'checkpoints',
+            hash_key(recipes_path=os.path.abspath(recipes_path))[:16] +
+            '.jsonl')
+    progress = Checkpoint(checkpoint)
+    # a checkpoint is only good for the same recipes, with the same contents,
+    # built for the same versions and channels
+    recipe_hashes = dict((recipe_dir, hash_recipe_dir(recipe_dir))
+                         for recipe_dir in find_recipe_dirs(recipes_path))
+    checkpoint_key = hash_key(recipes=sorted(recipe_hashes.items()),
+                              python=python, numpy=numpy, channel=channel)
+    plan, states = None, {}
+    if resume:
+        plan, states = progress.load(checkpoint_key)
+        if plan is None:
+            logger.info('No checkpoint to resume from in %s. Starting from '
+                        'scratch', checkpoint)
+    if plan is not None:
+        logger.info('Resuming from %s', checkpoint)
+        metas_to_build = [Variant.from_dict(dct) for dct in plan['build']]
+        metas_to_skip = [Variant.from_dict(dct) for dct in plan['skip']]
+    else:
+        recipes = load_recipes(recipes_path)
+        if not recipes:
+            print('No recipes to build!. Exiting 0')
+            sys.exit(0)
+        # get the builds on the channel I am interested in of the packages
+        # that I have recipes for
+        channel_index = None
+        if index_cache:
+            channel_index = IndexCache(os.path.join(cache_dir, 'index'),
+                                       ttl=index_ttl)
+        # only the subdirs that the recipes build into need to be looked at
+        packages = get_package_index(
+            channel, set(recipe.name for recipe in recipes),
+            index_cache=channel_index,
+            subdirs=sorted(set(recipe.subdir for recipe in recipes)))
+
+        name_cache = None
+        if build_name_cache:
+            name_cache = BuildNameCache(
+                os.path.join(cache_dir, 'build-names'),
+                max_entries=build_name_cache_size)
+        metas_to_build, metas_to_skip = decide_what_to_build(
+            recipes_path, python, packages, numpy, plan_jobs=plan_jobs,
+            render_engine=render_engine, build_name_cache=name_cache,
+            recipes=recipes, recipe_hashes=recipe_hashes)
+        # the Variant records have everything the rest of the run needs
+        del recipes
+        # a dry run leaves the checkpoint of the last real run alone
+        if not dry_run:
+            progress.start(checkpoint_key, {
+                'build': [meta.to_dict() for meta in metas_to_build],
+                'skip': [meta.to_dict() for meta in metas_to_skip]},
+                planned=[meta.build_name for meta in metas_to_build])
     if metas_to_build == []:
         print('No recipes to build!. Exiting 0')
         sys.exit(0)
 
+    # builds that succeeded on the run being resumed do not need doing again,
+    # as long as the package did not go missing in the meantime
+    resumed = []
+    remaining = []
+    for meta in metas_to_build:
+        state = states.get(meta.build_name, {})
+        if (state.get('state') == Checkpoint.SUCCEEDED and
+                any(path and os.path.exists(path) for path in
+                    (meta.full_build_path, state.get('artifact')))):
+            resumed.append(meta.build_name)
+        else:
+            remaining.append(meta)
+    if resumed:
+        logger.info('%s packages were built before the run was resumed',
+                    len(resumed))
+
+    # and neither do the ones that were built before with the same inputs
+    store = None
+    restored = []
+    if artifact_store:
+        store = ArtifactStore(os.path.join(cache_dir, 'artifacts'),
+                              max_size=artifact_store_size,
+                              max_age=artifact_store_age)
+    if artifact_cache:
+        store = TieredArtifactCache(store, remote_artifact_cache(
+            artifact_cache), push=artifact_push)
+    # solves are kept for the rest of the run, and shared with the preflight
+    # and the prefetch
+    solver = None
+    if store is not None or preflight:
+        solver = Solver()
+    if store is not None:
+        compute_input_hashes(
+            metas_to_build, build_variant_graph(metas_to_build),
+            recipe_hashes, solver=solver, jobs=preflight_jobs)
+        if not dry_run:
+            restored, remaining = restore_artifacts(remaining, store)
+            for meta in restored:
+                progress.set_state(meta.build_name, Checkpoint.SUCCEEDED)
+
+    # find out now, rather than after everything before them was built, if
+    # some variants cannot be built at all
+    unsatisfiable = {}
+    unsatisfiable_dependents = []
+    if preflight and remaining:
+        unsatisfiable = solve_environments(remaining, solver,
+                                           jobs=preflight_jobs)
+        for build_name in sorted(unsatisfiable):
+            logger.error('%s cannot be built, its %s', build_name,
+                         unsatisfiable[build_name])
+        if unsatisfiable and not (keep_going or allow_failures):
+            logger.error('Not building anything, because the requirements of '
+                         '%s packages cannot be met', len(unsatisfiable))
+            sys.exit(1)
+        graph = build_variant_graph(remaining) if keep_going else {}
+        for build_name in sorted(unsatisfiable):
+            if not dry_run:
+                progress.set_state(build_name, Checkpoint.FAILED,
+                                   reason='unsatisfiable')
+            for skipped in sorted(
+                    transitive_dependents(graph, [build_name]) -
+                    set(unsatisfiable) - set(unsatisfiable_dependents)):
+                unsatisfiable_dependents.append(skipped)
+                logger.error('Skipping %s: upstream %s cannot be built',
+                             skipped, build_name)
+                if not dry_run:
+                    progress.set_state(skipped, Checkpoint.SKIPPED,
+                                       upstream=build_name)
+        remaining = [meta for meta in remaining
+                     if meta.build_name not in unsatisfiable and
+                     meta.build_name not in unsatisfiable_dependents]
+    if remaining == []:
+        if unsatisfiable:
+            print('Nothing left that can be built!. Exiting 1')
+            sys.exit(1)
+        print('Nothing left to build!. Exiting 0')
+        sys.exit(0)
+
     # sort into the correct order
-    dependency_graph = build_dependency_graph(metas_to_build)
-    metas_name_order = resolve_dependencies(dependency_graph)
-    build_order = [meta for name in metas_name_order for meta in metas_to_build
-                   if meta.meta['package']['name'] == name]
+    dependency_graph = build_dependency_graph(remaining)
+    build_order = sort_build_order(remaining, dependency_graph)
+    variant_graph = build_variant_graph(remaining, dependency_graph)
     logger.info("\nThis is the determined build order...")
     for meta in build_order:
         logger.info(meta.build_name)
 
     if plan_file:
-        plan = {}
+        # the parsed meta.yaml, as it always was, plus the Variant record.
+        # Each meta.yaml is only parsed once, however many variants it has
+        recipe_metas = {}
+        plan = []
+        for meta in build_order:
+            if meta.recipe_dir not in recipe_metas:
+                recipe_metas[meta.recipe_dir] = MetaData(meta.recipe_dir).meta
+            entry = dict(recipe_metas[meta.recipe_dir])
+            entry['variant'] = meta.to_dict()
+            plan.append(entry)
         with open(plan_file, 'w') as f:
-            json.dump([meta.meta for meta in build_order], f)
+            json.dump(plan, f)
 
     # bail out if we're in dry run mode
     if dry_run:
@@ -611,11 +3161,36 @@ def run(recipes_path, python, channel, numpy, allow_failures=False,
         sys.exit(0)
 
 
+    prefetcher = None
+    if prefetch:
+        prefetcher = Prefetcher(jobs=prefetch_jobs, solver=solver)
+
     # Run the actual build
     try:
-        results = run_build(build_order, allow_failures=allow_failures)
+        history = BuildHistory(os.path.join(cache_dir, 'build-durations.json'))
+        if queue:
+            results = run_distributed(
+                build_order, queue, allow_failures=allow_failures,
+                dependency_graph=variant_graph, history=history,
+                poll_interval=poll_interval, lease=queue_lease,
+                timeout=build_timeout,
+                output_timeout=output_timeout, checkpoint=progress,
+                keep_going=keep_going, artifact_store=store)
+        else:
+            results = run_build(build_order, allow_failures=allow_failures,
+                                jobs=jobs, dependency_graph=variant_graph,
+                                history=history, cpus=cpus, memory=memory,
+                                log_dir=build_log_dir, timeout=build_timeout,
+                                output_timeout=output_timeout,
+                                checkpoint=progress, keep_going=keep_going,
+                                artifact_store=store, prefetcher=prefetcher)
         results['alreadybuilt'] = sorted([skip.build_name
                                           for skip in metas_to_skip])
+        results['resumed'] = sorted(resumed)
+        results['restored'] = sorted(meta.build_name for meta in restored)
+        results['unsatisfiable'] = sorted(unsatisfiable)
+        results['upstream_failed'] = sorted(results['upstream_failed'] +
+                                            unsatisfiable_dependents)
     except Exception as e:
         tb = traceback.format_exc()
         message = ("Major error encountered in attempt to build\n{}\n{}"
@@ -634,16 +3209,40 @@ def run(recipes_path, python, channel, numpy, allow_failures=False,
             logger.info('section: {:<25}. number build: {}'.format(k, v))
         if results['build_or_test_failed']:
             message = ("Some packages failed to build\n{}"
-                       "\n{}".format(pformat(results['build_or_test_failed'])))
+                       "".format(pformat(results['build_or_test_failed'])))
             logger.error(message)
+        if results['build_timed_out']:
+            logger.error("Some packages were killed for taking too long\n%s",
+                         pformat(results['build_timed_out']))
+        if results['unsatisfiable']:
+            logger.error("Some packages were not built because their "
+                         "requirements cannot be met\n%s",
+                         pformat(results['unsatisfiable']))
+        if results['upstream_failed']:
+            logger.error("Some packages were skipped because a package they "
+                         "depend on failed\n%s",
+                         pformat(results['upstream_failed']))
         if results['build_success']:
             logger.info("Packages build successfully")
             logger.info(pformat(results['build_success']))
+        if results['resumed']:
+            logger.info("Packages built before the run was resumed")
+            logger.info(pformat(results['resumed']))
+        if results['restored']:
+            logger.info("Packages restored from the artifact store")
+            logger.info(pformat(results['restored']))
         if results['alreadybuilt']:
-            logger.info('Packages that already exist in {}'.format(channel))
-            logger.info(pformat(results['alreadybuilt']))
-
-        if results['build_or_test_failed']:
+            found_on = {}
+            for skip in metas_to_skip:
+                found_on.setdefault(skip.found_on, []).append(skip.build_name)
+            for chan in channel:
+                if found_on.get(chan):
+                    logger.info('Packages that already exist in {}'.format(
+                        chan))
+                    logger.info(pformat(sorted(found_on[chan])))
+
+        if (results['build_or_test_failed'] or results['build_timed_out'] or
+                results['unsatisfiable']):
             # exit with a failed status code
             sys.exit(1)
 
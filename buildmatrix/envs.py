@@ -0,0 +1,282 @@
+# Copyright (c) <2015-2016>, Eric Dill
+#
+# All rights reserved.  Redistribution and use in source and binary forms, with
+# or without modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Work on the conda environments of builds that can be done before the builds
+get to it: fetching their packages ahead of time, and solving them up front
+to find out whether their requirements can be met at all.
+"""
+import json
+import logging
+import os
+import subprocess
+import tempfile
+import threading
+import time
+try:
+    from queue import Empty, Queue
+except ImportError:
+    # python 2
+    from Queue import Empty, Queue
+
+from .cache import hash_key
+
+logger = logging.getLogger('buildmatrix.envs')
+
+DEFAULT_PREFETCH_JOBS = 2
+# what the conda of the day calls it when specs cannot be met
+UNSATISFIABLE_ERRORS = ('Unsatisfiable', 'NotFound', 'NoPackagesFound',
+                        'Conflict')
+
+
+def env_key(specs):
+    """The key that a set of conda package specs is filed under"""
+    return hash_key(specs=sorted(set(specs)))
+
+
+def _link_spec(link):
+    """Turn a LINK action of `conda create --json` into an exact spec
+
+    Newer condas describe the package with a dict, older ones with a string
+    like 'defaults::numpy-1.11.0-py35_0 2'
+    """
+    if isinstance(link, dict):
+        if 'name' in link and 'version' in link:
+            return '{}={}={}'.format(link['name'], link['version'],
+                                     link.get('build_string',
+                                              link.get('build', '')))
+        link = link.get('dist_name') or link['dist']
+    dist = link.split()[0].split('::')[-1]
+    return '='.join(dist.rsplit('-', 2))
+
+
+def _unsatisfiable(output):
+    """The reason in the json error of conda, if it says the specs cannot be
+    met, else None"""
+    kind = output.get('exception_name') or output.get('error_type') or ''
+    if any(name in kind for name in UNSATISFIABLE_ERRORS):
+        return output.get('message') or output.get('error') or kind
+    return None
+
+
+class Solver(object):
+    """Solve conda environments without creating them
+
+    `conda create --dry-run --json` works out the exact packages that a set
+    of specs needs. Every set is only solved once for as long as the Solver
+    is around, which is meant to be one run: concurrent calls for the same
+    set wait for the first. Nothing is kept for the next run, by then the
+    channels may have changed.
+
+    Parameters
+    ----------
+    conda : str, optional
+        The conda executable
+    """
+    def __init__(self, conda='conda'):
+        self.conda = conda
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._solutions = {}
+
+    def __repr__(self):
+        return 'Solver({!r})'.format(self.conda)
+
+    def get(self, specs):
+        """The solution of `specs`, or None if they were not solved
+
+        Returns
+        -------
+        dict or None
+            'specs' that were solved, and either the exact 'packages' (as
+            name=version=build specs) or why the specs are 'unsatisfiable'
+        """
+        return self._solutions.get(env_key(specs))
+
+    def solve(self, specs):
+        """Solve `specs`, or hand back the solution from earlier
+
+        Returns
+        -------
+        dict or None
+            See `get`. None if conda failed for some other reason than the
+            specs, e.g. a channel could not be reached
+        """
+        key = env_key(specs)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            if key not in self._solutions:
+                self._solutions[key] = self._solve(key, specs)
+            return self._solutions[key]
+
+    def _solve(self, key, specs):
+        specs = sorted(set(specs))
+        # the prefix is never created, it only has to not exist
+        cmd = [self.conda, 'create', '--dry-run', '--json', '--use-local',
+               '--prefix', os.path.join(tempfile.gettempdir(),
+                                        'buildmatrix-solve-' + key[:12])]
+        logger.debug('Solving %s', ' '.join(specs))
+        proc = subprocess.Popen(cmd + specs, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        stdout, stderr = proc.communicate()
+        try:
+            output = json.loads(stdout.decode('utf-8'))
+        except ValueError:
+            logger.warning('Could not solve %s: %s', ' '.join(specs),
+                           stderr.decode('utf-8', 'replace').strip())
+            return None
+        solution = {'specs': specs, 'packages': None, 'unsatisfiable': None}
+        if proc.returncode == 0:
+            actions = output.get('actions') or {}
+            if isinstance(actions, list):
+                # one per prefix, and there is only the one
+                actions = actions[0] if actions else {}
+            solution['packages'] = sorted(
+                _link_spec(link) for link in actions.get('LINK', ()))
+        else:
+            solution['unsatisfiable'] = _unsatisfiable(output)
+            if solution['unsatisfiable'] is None:
+                logger.warning('Could not solve %s: %s', ' '.join(specs),
+                               output.get('message') or output.get('error'))
+                return None
+        return solution
+
+
+class Prefetcher(object):
+    """Puts the packages that builds need in conda's package cache before
+    the builds get to them
+
+    conda build cannot be handed a ready made build environment, it always
+    creates its own. What it can be spared is waiting on the downloads:
+    `conda create --download-only` downloads and extracts the packages of a
+    set of specs into the package cache, and conda build links them from
+    there. `start` does that for the builds that are coming up in the
+    background, while the earlier builds run. Each set of specs is only
+    fetched once, unless fetching it failed.
+
+    Parameters
+    ----------
+    jobs : int, optional
+        Number of sets of specs to fetch at the same time in the background.
+        Defaults to 2
+    conda : str, optional
+        The conda executable
+    solver : Solver, optional
+        If it has a solution for a set of specs, exactly those packages are
+        fetched instead of solving again
+    """
+    def __init__(self, jobs=DEFAULT_PREFETCH_JOBS, conda='conda',
+                 solver=None):
+        self.jobs = jobs
+        self.conda = conda
+        self.solver = solver
+        self._lock = threading.Lock()
+        self._key_locks = {}
+        self._fetched = {}
+
+    def __repr__(self):
+        return 'Prefetcher(jobs={!r})'.format(self.jobs)
+
+    def fetch(self, specs):
+        """Fetch the packages of `specs` unless that was done already
+
+        Several threads can ask for the same `specs` at once, only the first
+        fetches them and the rest wait for it.
+
+        Parameters
+        ----------
+        specs : list of str
+            conda package specs, like 'python 3.5*'
+
+        Returns
+        -------
+        bool
+            Whether the packages are in the package cache. Failing to fetch
+            is not an error, the build will find out what is wrong. It is not
+            remembered either, the next fetch of `specs` tries again
+        """
+        key = env_key(specs)
+        with self._lock:
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            if not self._fetched.get(key):
+                self._fetched[key] = self._fetch(key, specs)
+            return self._fetched[key]
+
+    def _fetch(self, key, specs):
+        packages = sorted(set(specs))
+        solution = self.solver and self.solver.get(specs)
+        if solution and solution['packages']:
+            packages = solution['packages']
+        # conda wants a prefix to solve for, but never creates it
+        prefix = os.path.join(tempfile.gettempdir(),
+                              'buildmatrix-prefetch-' + key[:12])
+        cmd = [self.conda, 'create', '--download-only', '--yes', '--quiet',
+               '--use-local', '--prefix', prefix] + packages
+        logger.info('Fetching the packages for %s', ' '.join(packages))
+        start = time.time()
+        try:
+            subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+        except (subprocess.CalledProcessError, OSError) as e:
+            logger.warning('Could not fetch the packages for %s: %s',
+                           ' '.join(packages), e)
+            return False
+        logger.debug('Fetched the packages for %s in %.1fs',
+                     ' '.join(packages), time.time() - start)
+        return True
+
+    def start(self, spec_sets):
+        """Fetch the packages of each set of specs, in order, from background
+        threads, and return right away
+
+        Parameters
+        ----------
+        spec_sets : iterable of list
+        """
+        todo = Queue()
+        queued = set()
+        for specs in spec_sets:
+            if specs and env_key(specs) not in queued:
+                queued.add(env_key(specs))
+                todo.put(specs)
+
+        def work():
+            while True:
+                try:
+                    specs = todo.get_nowait()
+                except Empty:
+                    return
+                self.fetch(specs)
+
+        for _ in range(min(self.jobs, todo.qsize())):
+            thread = threading.Thread(target=work)
+            # nothing is lost if the run ends before they are done
+            thread.daemon = True
+            thread.start()
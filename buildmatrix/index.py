@@ -0,0 +1,511 @@
+# Copyright (c) <2015-2016>, Eric Dill
+#
+# All rights reserved.  Redistribution and use in source and binary forms, with
+# or without modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+Fetch and cache the package indexes (repodata.json) of conda channels.
+"""
+import gzip
+import io
+import json
+import logging
+import mmap
+import os
+import re
+import ssl
+import time
+
+try:
+    from urllib.request import (HTTPSHandler, ProxyHandler, Request,
+                                build_opener, url2pathname)
+    from urllib.error import HTTPError, URLError
+    from urllib.parse import urlparse
+except ImportError:
+    # python 2
+    from urllib import url2pathname
+    from urllib2 import (HTTPSHandler, ProxyHandler, Request, build_opener,
+                         HTTPError, URLError)
+    from urlparse import urlparse
+try:
+    # conda >= 4.3
+    from conda.models.channel import Channel
+except ImportError:
+    Channel = None
+try:
+    # conda < 4.3
+    from conda.config import normalize_urls
+except ImportError:
+    normalize_urls = None
+
+from .cache import atomic_write
+
+logger = logging.getLogger('buildmatrix.index')
+
+DEFAULT_CHANNEL_ALIAS = 'https://conda.anaconda.org'
+DEFAULT_INDEX_TTL = 600
+# what a relative path to a local channel starts with
+_RELATIVE_PATH_PREFIXES = tuple(set(
+    prefix + sep for prefix in ('.', '..') for sep in ('/', os.sep)))
+# the anaconda.org token in a channel url
+_TOKEN = re.compile(r'/t/[^/]+/')
+
+
+def channel_urls(channel, subdir):
+    """The urls of one subdir of a channel
+
+    Channel names are resolved by conda, so the channel_alias,
+    custom_channels, tokens and multichannels like 'defaults' in .condarc
+    are all taken into account. Without conda they are looked for under
+    https://conda.anaconda.org.
+
+    Parameters
+    ----------
+    channel : str
+        Something like 'anaconda' or 'https://conda.anaconda.org/anaconda'
+    subdir : str
+        Something like 'linux-64' or 'noarch'
+
+    Returns
+    -------
+    list of str
+        The urls of the subdir, with a trailing slash. More than one for a
+        multichannel
+    """
+    if '://' in channel:
+        return ['{}/{}/'.format(channel.rstrip('/'), subdir)]
+    if Channel is not None:
+        try:
+            urls = Channel(channel).urls(with_credentials=True,
+                                         subdirs=(subdir, ))
+        except TypeError:
+            # conda 4.3 takes a platform and adds noarch to it
+            urls = Channel(channel).urls(with_credentials=True,
+                                         platform=subdir)
+    elif normalize_urls is not None:
+        urls = normalize_urls([channel], platform=subdir)
+    else:
+        urls = ['{}/{}/{}'.format(DEFAULT_CHANNEL_ALIAS, channel.strip('/'),
+                                  subdir)]
+    found = []
+    for url in urls:
+        url = url.rstrip('/') + '/'
+        # older condas hand back noarch too, whatever was asked for
+        if url.endswith('/{}/'.format(subdir)) and url not in found:
+            found.append(url)
+    return found
+
+
+def url_opener():
+    """A urllib opener that uses the proxy_servers and ssl_verify of conda
+    """
+    proxies, ssl_verify = None, True
+    try:
+        from conda.base.context import context
+        proxies = getattr(context, 'proxy_servers', None)
+        ssl_verify = getattr(context, 'ssl_verify', True)
+    except ImportError:
+        try:
+            from conda import config
+            proxies = config.get_proxy_servers()
+            ssl_verify = config.ssl_verify
+        except (ImportError, AttributeError):
+            pass
+    handlers = []
+    if proxies:
+        handlers.append(ProxyHandler(dict(proxies)))
+    if ssl_verify is not True and hasattr(ssl, 'create_default_context'):
+        if ssl_verify is False or str(ssl_verify).lower() == 'false':
+            context = ssl._create_unverified_context()
+        else:
+            # the path of a CA bundle
+            context = ssl.create_default_context(cafile=ssl_verify)
+        handlers.append(HTTPSHandler(context=context))
+    return build_opener(*handlers)
+
+
+def local_channel_path(channel):
+    """The folder that a channel lives in, if it is on this machine
+
+    Parameters
+    ----------
+    channel : str
+        Channel name, url, file:// url or path. Only absolute paths and
+        paths that start with ./ or ../ are paths, so that a channel name
+        never turns into a folder that happens to be in the working directory
+
+    Returns
+    -------
+    str or None
+        None if `channel` is not a local channel
+    """
+    if channel.startswith('file://'):
+        return url2pathname(urlparse(channel).path)
+    if os.path.isabs(channel) or channel.startswith(_RELATIVE_PATH_PREFIXES):
+        return os.path.abspath(channel)
+    return None
+
+
+# A json object key that looks like a package file name. In repodata.json the
+# only such keys are the ones in 'packages' and 'packages.conda' (the "fn"
+# fields and the "removed" list are values, which are never followed by a
+# colon). Package file names are name-version-build.ext, where version and
+# build have no dashes, and never contain quotes or backslashes.
+_FILE_NAME_KEY = re.compile(
+    br'"([^"\\]+-[^"\\-]+-[^"\\-]+\.(?:tar\.bz2|conda))"\s*:')
+
+
+def iter_repodata_file_names(path):
+    """Stream the package file names out of a repodata.json on disk
+
+    The file is memory mapped and scanned with a regex, so memory use stays
+    flat and no json is decoded no matter how large the repodata is.
+
+    Parameters
+    ----------
+    path : str
+        Path to a repodata.json
+
+    Yields
+    ------
+    str
+        Something like 'album-0.0.2.post0-0_g6b05c00_py27.tar.bz2'
+    """
+    with open(path, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # empty file
+            return
+        try:
+            for match in _FILE_NAME_KEY.finditer(data):
+                yield match.group(1).decode('utf-8')
+        finally:
+            data.close()
+
+
+def local_package_index(channel, subdirs, names=None):
+    """Read the builds of some packages straight out of a local channel
+
+    Parameters
+    ----------
+    channel : str
+        file:// url or path of a channel on this machine
+    subdirs : iterable of str
+    names : iterable, optional
+        Package names to look for. Defaults to all of them
+
+    Returns
+    -------
+    PackageIndex
+    """
+    path = local_channel_path(channel)
+    if path is None:
+        raise ValueError("{} is not a local channel".format(channel))
+    packages = PackageIndex(names)
+    for subdir in subdirs:
+        repodata = os.path.join(path, subdir, 'repodata.json')
+        if not os.path.exists(repodata):
+            logger.debug('%s has no %s packages', channel, subdir)
+            continue
+        for fn in iter_repodata_file_names(repodata):
+            packages.add('{}/{}'.format(subdir, fn), channel)
+    return packages
+
+
+def package_name(file_name):
+    """Get the package name out of a conda package file name
+
+    >>> package_name('linux-64/album-0.0.2.post0-0_g6b05c00_py27.tar.bz2')
+    'album'
+    """
+    return file_name.rsplit('/', 1)[-1].rsplit('-', 2)[0]
+
+
+class PackageIndex(object):
+    """Which builds of some packages exist on one or more channels
+
+    This maps package name -> {'subdir/filename': channel} for its builds.
+    When it is made with `names`, the builds of every other package are
+    dropped on the way in, so it stays as small as the set of packages we
+    care about no matter how big the channels are.
+
+    Parameters
+    ----------
+    names : iterable, optional
+        The only package names to keep track of. Defaults to all of them
+
+    Examples
+    --------
+    >>> packages = PackageIndex(['album'])
+    >>> packages.add('linux-64/album-0.0.2-py27_0.tar.bz2', 'staging')
+    >>> packages.add('linux-64/numpy-1.11.1-py27_0.tar.bz2', 'staging')
+    >>> 'linux-64/album-0.0.2-py27_0.tar.bz2' in packages
+    True
+    >>> packages.channel_for('linux-64/album-0.0.2-py27_0.tar.bz2')
+    'staging'
+    >>> len(packages)
+    1
+    """
+    def __init__(self, names=None):
+        self.names = None if names is None else frozenset(names)
+        self.builds = {}
+
+    def wants(self, name):
+        """Whether builds of the package `name` are kept track of"""
+        return self.names is None or name in self.names
+
+    def add(self, file_name, channel=None):
+        """Record that 'subdir/filename' exists on `channel`
+
+        If it was already recorded on another channel, that one is kept.
+        """
+        name = package_name(file_name)
+        if self.wants(name):
+            self.builds.setdefault(name, {}).setdefault(file_name, channel)
+
+    def update(self, other):
+        """Merge in the builds from another PackageIndex
+
+        Builds that are already recorded keep their channel, so merge the
+        indexes in order of preference.
+        """
+        for name, builds in other.builds.items():
+            if self.wants(name):
+                for file_name, channel in builds.items():
+                    self.builds.setdefault(name, {}).setdefault(
+                        file_name, channel)
+
+    def channel_for(self, file_name):
+        """The channel that `file_name` was found on, or None"""
+        return self.builds.get(package_name(file_name), {}).get(file_name)
+
+    def __contains__(self, file_name):
+        return file_name in self.builds.get(package_name(file_name), ())
+
+    def __iter__(self):
+        for file_names in self.builds.values():
+            for file_name in file_names:
+                yield file_name
+
+    def __len__(self):
+        return sum(len(file_names) for file_names in self.builds.values())
+
+
+class IndexCache(object):
+    """On-disk cache of channel repodata with a ttl and http revalidation
+
+    Within `ttl` seconds of the last fetch the cached repodata is used without
+    asking the server at all. After that the request is made conditional on
+    the ETag / Last-Modified of the cached copy, so an unchanged index only
+    costs a 304 round trip.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Folder to keep the cached indexes in
+    ttl : float, optional
+        Seconds that a fetched index is trusted without revalidation.
+        Defaults to 600
+    timeout : float, optional
+        Seconds to wait on the server. Defaults to 60
+
+    Attributes
+    ----------
+    missing : set
+        (channel, subdir) of the subdirs that turned out not to exist
+    """
+    def __init__(self, cache_dir, ttl=DEFAULT_INDEX_TTL, timeout=60):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.timeout = timeout
+        self.missing = set()
+        self._opener = url_opener()
+
+    def _paths(self, url):
+        # something like conda.anaconda.org_anaconda/linux-64. Without the
+        # token, if there is one
+        url = _TOKEN.sub('/t/', url)
+        name = re.sub(r'[^\w.-]+', '_', url.split('://', 1)[-1]).strip('_')
+        dirname = os.path.join(self.cache_dir, name)
+        return (os.path.join(dirname, 'repodata.json'),
+                os.path.join(dirname, 'state.json'))
+
+    def _load(self, path):
+        with open(path, 'rb') as f:
+            return json.loads(f.read().decode('utf-8'))
+
+    def fetch(self, channel, subdir):
+        """Get the repodata for one subdir of a channel
+
+        Parameters
+        ----------
+        channel : str
+            Channel name or url
+        subdir : str
+            Something like 'linux-64' or 'noarch'
+
+        Returns
+        -------
+        dict
+            The parsed repodata.json, the packages of every channel in it for
+            a multichannel. Subdirs that the channel does not have come back
+            with no packages, and are added to `missing`
+        """
+        repodata = None
+        for path in self.repodata_paths(channel, subdir):
+            data = self._load(path)
+            if repodata is None:
+                repodata = data
+                continue
+            for key in ('packages', 'packages.conda'):
+                # the channels of a multichannel that come first win
+                for fn, info in (data.get(key) or {}).items():
+                    repodata.setdefault(key, {}).setdefault(fn, info)
+        return repodata if repodata is not None else {'packages': {}}
+
+    def repodata_paths(self, channel, subdir):
+        """Bring the cached repodata for one subdir of a channel up to date
+
+        Parameters
+        ----------
+        channel : str
+            Channel name or url
+        subdir : str
+            Something like 'linux-64' or 'noarch'
+
+        Returns
+        -------
+        list of str
+            Paths of the cached repodata.json files, one for each channel of
+            a multichannel. Nothing is decoded, so they can be scanned with
+            `iter_repodata_file_names`. Subdirs that the channel does not
+            have come back empty, and are added to `missing`
+        """
+        paths = [path for path in map(self._fetch_url,
+                                      channel_urls(channel, subdir))
+                 if path is not None]
+        if not paths:
+            logger.debug('%s has no %s packages', channel, subdir)
+            self.missing.add((channel, subdir))
+        return paths
+
+    def _fetch_url(self, url):
+        # the path of the cached repodata.json of `url`, or None if there is
+        # none
+        repodata_path, state_path = self._paths(url)
+        try:
+            state = self._load(state_path)
+        except (IOError, OSError, ValueError):
+            state = {}
+        have_cache = state and os.path.exists(repodata_path)
+        if have_cache and time.time() - state.get('fetched', 0) < self.ttl:
+            logger.debug('Using cached index for %s', url)
+            return repodata_path
+
+        request = Request(url + 'repodata.json')
+        request.add_header('Accept-Encoding', 'gzip')
+        if have_cache:
+            if state.get('etag'):
+                request.add_header('If-None-Match', state['etag'])
+            if state.get('last_modified'):
+                request.add_header('If-Modified-Since', state['last_modified'])
+        try:
+            response = self._opener.open(request, timeout=self.timeout)
+        except HTTPError as e:
+            if e.code == 304 and have_cache:
+                logger.debug('Index for %s has not changed', url)
+                state['fetched'] = time.time()
+                atomic_write(state_path, json.dumps(state).encode('utf-8'))
+                return repodata_path
+            if e.code == 404:
+                return None
+            raise
+        except URLError as e:
+            if have_cache:
+                logger.warning('Could not reach %s (%s). Using the cached '
+                               'index from %s', url, e,
+                               time.ctime(state.get('fetched', 0)))
+                return repodata_path
+            raise
+
+        try:
+            data = response.read()
+            headers = response.info()
+        finally:
+            response.close()
+        if headers.get('Content-Encoding') == 'gzip':
+            data = gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+        logger.debug('Downloaded %s bytes of index for %s', len(data), url)
+        atomic_write(repodata_path, data)
+        state = {'url': _TOKEN.sub('/t/', url),
+                 'etag': headers.get('ETag'),
+                 'last_modified': headers.get('Last-Modified'),
+                 'fetched': time.time()}
+        atomic_write(state_path, json.dumps(state).encode('utf-8'))
+        return repodata_path
+
+    def file_names(self, channel, subdirs):
+        """Get the names of all the files in some subdirs of a channel
+
+        Parameters
+        ----------
+        channel : str
+        subdirs : iterable of str
+
+        Returns
+        -------
+        set
+            Something like 'linux-64/album-0.0.2.post0-0_g6b05c00_py27.tar.bz2'
+        """
+        if local_channel_path(channel) is not None:
+            return set(local_package_index(channel, subdirs))
+        return set(self.package_index(channel, subdirs))
+
+    def package_index(self, channel, subdirs, names=None):
+        """Get the builds of some packages in some subdirs of a channel
+
+        Parameters
+        ----------
+        channel : str
+        subdirs : iterable of str
+        names : iterable, optional
+            Package names to look for. Defaults to all of them
+
+        Returns
+        -------
+        PackageIndex
+        """
+        if local_channel_path(channel) is not None:
+            # nothing to download or cache
+            return local_package_index(channel, subdirs, names=names)
+        packages = PackageIndex(names)
+        for subdir in subdirs:
+            for path in self.repodata_paths(channel, subdir):
+                for fn in iter_repodata_file_names(path):
+                    packages.add('{}/{}'.format(subdir, fn), channel)
+        return packages
@@ -0,0 +1,436 @@
+# Copyright (c) <2015-2016>, Eric Dill
+#
+# All rights reserved.  Redistribution and use in source and binary forms, with
+# or without modification, are permitted provided that the following conditions
+# are met:
+#
+# 1. Redistributions of source code must retain the above copyright notice,
+# this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# 3. Neither the name of the copyright holder nor the names of its contributors
+# may be used to endorse or promote products derived from this software without
+# specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE
+# ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR CONTRIBUTORS BE
+# LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR
+# CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF
+# SUBSTITUTE GOODS OR SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS
+# INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN
+# CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE)
+# ARISING IN ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""
+A work queue in a sqlite database, so that the builds in a plan can be
+spread over `buildmatrix worker` processes on several machines.
+
+The coordinator publishes the planned builds and the dependencies between
+them. Workers claim builds whose dependencies are done, run them and report
+back. All of the coordination happens in sqlite transactions, so the
+database just needs to be on a filesystem that every machine can see.
+
+A claim is a lease that the worker renews while it builds. When a worker
+dies, its lease runs out and the build goes back to pending, so that
+another worker can pick it up.
+"""
+import json
+import logging
+import os
+import socket
+import sqlite3
+import time
+
+logger = logging.getLogger('buildmatrix.workqueue')
+
+PENDING = 'pending'
+RUNNING = 'running'
+SUCCEEDED = 'succeeded'
+FAILED = 'failed'
+TIMED_OUT = 'timed out'
+CANCELLED = 'cancelled'
+
+DEFAULT_LEASE = 300
+DEFAULT_MAX_ATTEMPTS = 3
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    build_name TEXT PRIMARY KEY,
+    position INTEGER NOT NULL,
+    priority REAL NOT NULL DEFAULT 0,
+    command TEXT NOT NULL,
+    env TEXT NOT NULL,
+    full_build_path TEXT,
+    recipe_dir TEXT,
+    recipe_hash TEXT,
+    timeout REAL,
+    output_timeout REAL,
+    state TEXT NOT NULL,
+    worker TEXT,
+    started REAL,
+    heartbeat REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    finished REAL,
+    returncode INTEGER,
+    artifact TEXT,
+    output TEXT
+);
+CREATE TABLE IF NOT EXISTS deps (
+    build_name TEXT NOT NULL,
+    dep TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS deps_build_name ON deps (build_name);
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def default_worker_name():
+    """hostname:pid"""
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+class WorkQueue(object):
+    """A queue of builds with dependencies, kept in a sqlite database
+
+    Parameters
+    ----------
+    path : str
+        The sqlite database. It is created if it does not exist
+    timeout : float, optional
+        Seconds to wait on another process that holds the database lock.
+        Defaults to 60
+    """
+    def __init__(self, path, timeout=60):
+        self.path = path
+        # isolation_level=None so that the transactions are the explicit
+        # BEGIN IMMEDIATE ones below
+        self._conn = sqlite3.connect(path, timeout=timeout,
+                                     isolation_level=None,
+                                     check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.executescript(_SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    def _transaction(self, statements):
+        # run (sql, args) pairs in one write transaction
+        cursor = self._conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            for sql, args in statements:
+                cursor.execute(sql, args)
+        except Exception:
+            cursor.execute('ROLLBACK')
+            raise
+        cursor.execute('COMMIT')
+
+    def publish(self, jobs, dependency_graph, allow_failures=False,
+                lease=DEFAULT_LEASE, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """Replace whatever is in the queue with a new plan
+
+        Parameters
+        ----------
+        jobs : list of dict
+            One per build, in build order, with the keys 'build_name',
+            'command' (list), 'env' (dict of environment variables to set),
+            'full_build_path' and optionally 'priority' (higher goes first),
+            'timeout' and 'output_timeout' (seconds), 'recipe_dir' and
+            'recipe_hash' (see `hash_recipe_dir`)
+        dependency_graph : dict
+            Maps build_name -> the build_names it depends on. Dependencies
+            that are not in `jobs` are ignored
+        allow_failures : bool, optional
+            True: builds whose dependencies failed still get built
+        lease : float, optional
+            Seconds a worker may go without renewing its claim on a build
+            before the build is handed to another worker. Defaults to 5
+            minutes
+        max_attempts : int, optional
+            Number of workers a build may be handed to before it counts as
+            failed, so that a build which takes its worker down does not go
+            round forever. Defaults to 3
+        """
+        names = set(job['build_name'] for job in jobs)
+        statements = [('DELETE FROM jobs', ()), ('DELETE FROM deps', ()),
+                      ('DELETE FROM settings', ()),
+                      ('INSERT INTO settings VALUES (?, ?)',
+                       ('allow_failures', json.dumps(bool(allow_failures)))),
+                      ('INSERT INTO settings VALUES (?, ?)',
+                       ('lease', json.dumps(lease))),
+                      ('INSERT INTO settings VALUES (?, ?)',
+                       ('max_attempts', json.dumps(max_attempts))),
+                      ('INSERT INTO settings VALUES (?, ?)',
+                       ('published', json.dumps(time.time())))]
+        for position, job in enumerate(jobs):
+            statements.append((
+                'INSERT INTO jobs (build_name, position, priority, command, '
+                'env, full_build_path, recipe_dir, recipe_hash, timeout, '
+                'output_timeout, state) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (job['build_name'], position, job.get('priority', 0),
+                 json.dumps(job['command']), json.dumps(job.get('env', {})),
+                 job.get('full_build_path'), job.get('recipe_dir'),
+                 job.get('recipe_hash'), job.get('timeout'),
+                 job.get('output_timeout'), PENDING)))
+            deps = set(dependency_graph.get(job['build_name'], ()))
+            for dep in sorted(deps & names):
+                statements.append(('INSERT INTO deps VALUES (?, ?)',
+                                   (job['build_name'], dep)))
+        self._transaction(statements)
+
+    def _setting(self, key):
+        row = self._conn.execute(
+            'SELECT value FROM settings WHERE key = ?', (key, )).fetchone()
+        return json.loads(row['value']) if row else None
+
+    def _allow_failures(self):
+        return bool(self._setting('allow_failures'))
+
+    def is_published(self):
+        """Whether a coordinator has put a plan in the queue yet"""
+        return self._setting('published') is not None
+
+    def lease(self):
+        """Seconds a claim is good for without being renewed"""
+        lease = self._setting('lease')
+        return DEFAULT_LEASE if lease is None else lease
+
+    def claim(self, worker=None):
+        """Take the next build whose dependencies are done
+
+        Parameters
+        ----------
+        worker : str, optional
+            Name to record as running the build. Defaults to hostname:pid
+
+        Returns
+        -------
+        dict or None
+            The job (see `publish`), or None if nothing is ready right now
+        """
+        worker = worker or default_worker_name()
+        done = ((SUCCEEDED, FAILED, TIMED_OUT) if self._allow_failures()
+                else (SUCCEEDED, ))
+        cursor = self._conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            self._requeue_expired(cursor)
+            row = cursor.execute(
+                'SELECT * FROM jobs AS j WHERE state = ? AND NOT EXISTS ('
+                '  SELECT 1 FROM deps AS d JOIN jobs AS u'
+                '  ON u.build_name = d.dep'
+                '  WHERE d.build_name = j.build_name AND u.state NOT IN ({}))'
+                ' ORDER BY priority DESC, position LIMIT 1'
+                ''.format(', '.join('?' * len(done))),
+                (PENDING, ) + done).fetchone()
+            if row is not None:
+                now = time.time()
+                cursor.execute(
+                    'UPDATE jobs SET state = ?, worker = ?, started = ?, '
+                    'heartbeat = ?, attempts = attempts + 1 '
+                    'WHERE build_name = ?',
+                    (RUNNING, worker, now, now, row['build_name']))
+        except Exception:
+            cursor.execute('ROLLBACK')
+            raise
+        cursor.execute('COMMIT')
+        if row is None:
+            return None
+        return self._job(row)
+
+    def heartbeat(self, build_name, worker):
+        """Renew the lease of `worker` on `build_name`
+
+        Returns
+        -------
+        bool
+            False if the build was handed to another worker in the meantime
+        """
+        cursor = self._conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            cursor.execute(
+                'UPDATE jobs SET heartbeat = ? WHERE build_name = ? AND '
+                'worker = ? AND state = ?',
+                (time.time(), build_name, worker, RUNNING))
+            renewed = cursor.rowcount > 0
+        except Exception:
+            cursor.execute('ROLLBACK')
+            raise
+        cursor.execute('COMMIT')
+        return renewed
+
+    def requeue_expired(self):
+        """Put the builds of workers whose lease ran out back to pending
+
+        Returns
+        -------
+        list
+            The build_names that were put back, or failed for running out of
+            attempts
+        """
+        cursor = self._conn.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            expired = self._requeue_expired(cursor)
+        except Exception:
+            cursor.execute('ROLLBACK')
+            raise
+        cursor.execute('COMMIT')
+        return expired
+
+    def _requeue_expired(self, cursor):
+        now = time.time()
+        rows = cursor.execute(
+            'SELECT build_name, worker, attempts FROM jobs WHERE state = ? '
+            'AND heartbeat < ?', (RUNNING, now - self.lease())).fetchall()
+        max_attempts = self._setting('max_attempts') or DEFAULT_MAX_ATTEMPTS
+        for row in rows:
+            if row['attempts'] >= max_attempts:
+                logger.error('%s lost its worker %s times. Giving up on it',
+                             row['build_name'], row['attempts'])
+                # the worker is kept, so a late report from it is still
+                # taken
+                cursor.execute(
+                    'UPDATE jobs SET state = ?, finished = ?, output = ? '
+                    'WHERE build_name = ?',
+                    (FAILED, now, 'The build lost its worker {} times, the '
+                     'last one was {}'.format(row['attempts'], row['worker']),
+                     row['build_name']))
+            else:
+                logger.warning('%s lost its worker %s. Putting it back in '
+                               'the queue', row['build_name'], row['worker'])
+                cursor.execute('UPDATE jobs SET state = ? WHERE build_name = ?',
+                               (PENDING, row['build_name']))
+        return [row['build_name'] for row in rows]
+
+    def _job(self, row):
+        job = dict((key, row[key]) for key in row.keys())
+        job['command'] = json.loads(job['command'])
+        job['env'] = json.loads(job['env'])
+        return job
+
+    def report(self, build_name, returncode, artifact=None, output=None,
+               timed_out=False, worker=None):
+        """Record how a claimed build went
+
+        Parameters
+        ----------
+        build_name : str
+        returncode : int
+            0 for success
+        artifact : str, optional
+            Where the built package can be found
+        output : str, optional
+            The (tail of the) build output, to show when it failed
+        timed_out : bool, optional
+            True if the build was killed for taking too long. It counts as a
+            failure
+        worker : str, optional
+            The worker that claimed the build. If given, the report is only
+            taken while the build has not been handed to another worker
+        """
+        if timed_out:
+            state = TIMED_OUT
+        else:
+            state = SUCCEEDED if returncode == 0 else FAILED
+        sql = ('UPDATE jobs SET state = ?, finished = ?, returncode = ?, '
+               'artifact = ?, output = ? WHERE build_name = ?')
+        args = (state, time.time(), returncode, artifact, output, build_name)
+        if worker is not None:
+            # its lease may have run out, but nobody else claimed it yet
+            sql += ' AND worker = ? AND state IN (?, ?, ?)'
+            args += (worker, RUNNING, PENDING, FAILED)
+        self._transaction([(sql, args)])
+
+    def upstream_artifacts(self, build_name):
+        """The packages that `build_name` depends on, directly or further up
+
+        Returns
+        -------
+        list of (build_name, artifact)
+            For the dependencies that succeeded and were copied somewhere
+        """
+        rows = self._conn.execute(
+            'WITH RECURSIVE upstream(build_name) AS ('
+            '  SELECT dep FROM deps WHERE build_name = ?'
+            '  UNION'
+            '  SELECT d.dep FROM deps AS d JOIN upstream AS u'
+            '  ON d.build_name = u.build_name)'
+            ' SELECT build_name, artifact FROM jobs WHERE state = ? AND'
+            ' artifact IS NOT NULL AND build_name IN ('
+            '  SELECT build_name FROM upstream) ORDER BY position',
+            (build_name, SUCCEEDED))
+        return [(row['build_name'], row['artifact']) for row in rows]
+
+    def cancel_pending(self):
+        """Make sure that no more builds get claimed"""
+        self._transaction([('UPDATE jobs SET state = ? WHERE state = ?',
+                            (CANCELLED, PENDING))])
+
+    def jobs(self, state=None):
+        """All the jobs, or the ones in `state`, in build order"""
+        if state is None:
+            rows = self._conn.execute('SELECT * FROM jobs ORDER BY position')
+        else:
+            rows = self._conn.execute(
+                'SELECT * FROM jobs WHERE state = ? ORDER BY position',
+                (state, ))
+        return [self._job(row) for row in rows]
+
+    def counts(self):
+        """Number of jobs in each state"""
+        return dict((row['state'], row['n']) for row in self._conn.execute(
+            'SELECT state, count(*) AS n FROM jobs GROUP BY state'))
+
+    def is_done(self):
+        """Whether there is nothing left that could still be built
+
+        That is, nothing is running and none of the pending builds can ever
+        become ready, because something they depend on failed. A queue that
+        has not been published to yet is not done, so that workers can be
+        started before the coordinator has finished planning.
+        """
+        # one read transaction, so that a build that gets claimed half way
+        # through does not make it look like there is nothing left
+        cursor = self._conn.cursor()
+        cursor.execute('BEGIN')
+        try:
+            return self._is_done()
+        finally:
+            cursor.execute('COMMIT')
+
+    def _is_done(self):
+        if not self.is_published():
+            return False
+        counts = self.counts()
+        if counts.get(RUNNING):
+            return False
+        if not counts.get(PENDING):
+            return True
+        if self._allow_failures():
+            return False
+        # pending builds are stuck for good if one of their dependencies
+        # failed, or is stuck itself. A pending build that is not stuck can
+        # still run.
+        row = self._conn.execute(
+            'WITH RECURSIVE stuck(build_name) AS ('
+            '  SELECT d.build_name FROM deps AS d JOIN jobs AS u'
+            '  ON u.build_name = d.dep WHERE u.state NOT IN (?, ?, ?)'
+            '  UNION'
+            '  SELECT d.build_name FROM deps AS d JOIN stuck AS s'
+            '  ON d.dep = s.build_name)'
+            ' SELECT 1 FROM jobs WHERE state = ? AND build_name NOT IN ('
+            '  SELECT build_name FROM stuck) LIMIT 1',
+            (SUCCEEDED, PENDING, RUNNING, PENDING)).fetchone()
+        return row is None
@@ -1,9 +1,74 @@
+import hashlib
+import threading
+
 import pytest
 from os.path import join, dirname
 
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    # python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
 
 @pytest.fixture(scope="session")
 def examples_dir():
     # fixture that returns the path to the folder that contains the example
     # conda recipes that are used in the test suite
     return join(dirname(__file__), 'example-recipes')
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # Serves `server.files` (a dict of path -> bytes) with ETags so that the
+    # caches can be tested against something that behaves like a channel
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requests.append(('GET', self.path, dict(self.headers)))
+        body = self.server.files.get(self.path)
+        if body is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('ETag', etag)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_HEAD(self):
+        self.server.requests.append(('HEAD', self.path, dict(self.headers)))
+        body = self.server.files.get(self.path)
+        self.send_response(404 if body is None else 200)
+        self.end_headers()
+
+    def do_PUT(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length)
+        self.server.requests.append(('PUT', self.path, dict(self.headers)))
+        self.server.files[self.path] = body
+        self.send_response(201)
+        self.end_headers()
+
+
+@pytest.fixture
+def http_server():
+    # fixture that runs a small http server on localhost. Put content in
+    # `server.files` and look at `server.requests` to see what was asked for
+    server = HTTPServer(('127.0.0.1', 0), _Handler)
+    server.files = {}
+    server.requests = []
+    server.url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
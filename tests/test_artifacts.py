@@ -0,0 +1,128 @@
+import os
+import time
+
+from buildmatrix import artifacts
+
+
+def test_store_roundtrip(tmpdir):
+    store = artifacts.ArtifactStore(str(tmpdir.join('store')))
+    built = tmpdir.join('bld', 'a-1-0.tar.bz2')
+    built.write('package a', ensure=True)
+    restored = tmpdir.join('restored', 'linux-64', 'a-1-0.tar.bz2')
+    assert not store.get('abc123', str(restored))
+    store.put('abc123', str(built))
+    assert store.get('abc123', str(restored))
+    assert restored.read() == 'package a'
+
+
+def test_incomplete_entries_are_misses(tmpdir):
+    store = artifacts.ArtifactStore(str(tmpdir.join('store')))
+    # a put that died before writing the entry file
+    tmpdir.join('store', 'ab', 'abc123', 'a-1-0.tar.bz2').write(
+        'half', ensure=True)
+    assert not store.get('abc123', str(tmpdir.join('a-1-0.tar.bz2')))
+
+
+def test_eviction_by_size_and_age(tmpdir):
+    store = artifacts.ArtifactStore(str(tmpdir.join('store')), max_size=1)
+    for key in ('aa1', 'bb2', 'cc3'):
+        built = tmpdir.join(key + '.tar.bz2')
+        built.write('x' * (400 * 1024))
+        store.put(key, str(built))
+        # make sure the entries have different ages
+        entry_dir = os.path.join(store.store_dir, key[:2], key)
+        os.utime(entry_dir, (time.time() - 100 + len(store.entries()),) * 2)
+    # only two 400K packages fit in a megabyte, the oldest one goes
+    assert not store.get('aa1', str(tmpdir.join('out')))
+    assert store.get('bb2', str(tmpdir.join('out')))
+    assert store.get('cc3', str(tmpdir.join('out')))
+
+    old = artifacts.ArtifactStore(store.store_dir, max_age=60)
+    os.utime(os.path.join(store.store_dir, 'bb', 'bb2'),
+             (time.time() - 120, ) * 2)
+    old.evict()
+    assert not old.get('bb2', str(tmpdir.join('out')))
+    assert old.get('cc3', str(tmpdir.join('out')))
+
+
+def test_http_cache(http_server, tmpdir):
+    remote = artifacts.remote_artifact_cache(http_server.url + '/cache/')
+    assert isinstance(remote, artifacts.HTTPArtifactCache)
+    dest = tmpdir.join('restored', 'a-1-0.tar.bz2')
+    assert not remote.get('abc123', str(dest))
+    built = tmpdir.join('a-1-0.tar.bz2')
+    built.write('package a')
+    remote.put('abc123', str(built))
+    assert http_server.files['/cache/ab/abc123/a-1-0.tar.bz2'] == b'package a'
+    assert remote.get('abc123', str(dest))
+    assert dest.read() == 'package a'
+
+
+def test_tiered_cache(http_server, tmpdir):
+    local = artifacts.ArtifactStore(str(tmpdir.join('local')))
+    shared = tmpdir.join('shared')
+    # what another machine pushed
+    built = tmpdir.join('a-1-0.tar.bz2')
+    built.write('package a')
+    artifacts.remote_artifact_cache(str(shared)).put('abc123', str(built))
+
+    cache = artifacts.TieredArtifactCache(
+        local, artifacts.remote_artifact_cache(str(shared)))
+    assert cache.get('abc123', str(tmpdir.join('out', 'a-1-0.tar.bz2')))
+    # and now it is in the local store too
+    assert local.get('abc123', str(tmpdir.join('out2', 'a-1-0.tar.bz2')))
+
+    # a read only cache does not push
+    readonly = artifacts.TieredArtifactCache(
+        None, artifacts.remote_artifact_cache(http_server.url), push=False)
+    readonly.put('def456', str(built))
+    assert http_server.files == {}
+    # and an unreachable one is not fatal
+    down = artifacts.TieredArtifactCache(
+        local, artifacts.HTTPArtifactCache('http://127.0.0.1:1', timeout=1))
+    down.put('def456', str(built))
+    assert not down.get('fff000', str(tmpdir.join('out3', 'x.tar.bz2')))
+    assert local.get('def456', str(tmpdir.join('out4', 'a-1-0.tar.bz2')))
+
+
+def test_failed_downloads_are_misses(http_server, tmpdir, monkeypatch):
+    built = tmpdir.join('a-1-0.tar.bz2')
+    built.write('package a')
+    remote = artifacts.HTTPArtifactCache(http_server.url)
+    remote.put('abc123', str(built))
+
+    def dropped(src, dst):
+        # the connection went away half way through the package
+        raise artifacts.HTTPException('IncompleteRead(4 bytes read)')
+    with monkeypatch.context() as patch:
+        patch.setattr(artifacts.shutil, 'copyfileobj', dropped)
+        assert not remote.get('abc123', str(tmpdir.join('out', 'a.tar.bz2')))
+    assert tmpdir.join('out').listdir() == []
+
+    # and so are packages that cannot be kept in the local store
+    local = artifacts.ArtifactStore(str(tmpdir.join('local')))
+
+    def full(key, path):
+        raise OSError(28, 'No space left on device')
+    monkeypatch.setattr(local, 'put', full)
+    cache = artifacts.TieredArtifactCache(local, remote)
+    assert not cache.get('abc123', str(tmpdir.join('out', 'a.tar.bz2')))
+
+
+def test_rebuilds_do_not_change_the_store(tmpdir):
+    store = artifacts.ArtifactStore(str(tmpdir.join('store')))
+    built = tmpdir.join('bld', 'a-1-0.tar.bz2')
+    built.write('old inputs', ensure=True)
+    store.put('old', str(built))
+    # conda build writes the same file name in place after a recipe edit
+    with open(str(built), 'r+') as f:
+        f.write('new inputs')
+    assert store.get('old', str(tmpdir.join('out', 'a-1-0.tar.bz2')))
+    assert tmpdir.join('out', 'a-1-0.tar.bz2').read() == 'old inputs'
+    # and the same goes for a package that was restored from the store
+    restored = tmpdir.join('bld2', 'a-1-0.tar.bz2')
+    assert store.get('old', str(restored))
+    with open(str(restored), 'r+') as f:
+        f.write('new inputs')
+    assert store.get('old', str(tmpdir.join('out2', 'a-1-0.tar.bz2')))
+    assert tmpdir.join('out2', 'a-1-0.tar.bz2').read() == 'old inputs'
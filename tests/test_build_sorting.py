@@ -1,3 +1,5 @@
+import os
+
 import pytest
 from buildmatrix import cli
 
@@ -12,12 +14,202 @@ def test_sorting(examples_dir):
     metas_to_build, metas_to_skip = cli.decide_what_to_build(
         examples_dir, ['2.7', '3.4', '3.5'], packages, ['1.10', '1.11'])
 
-    dependency_graph = cli.build_dependency_graph(metas_to_build)
-    metas_name_order = cli.resolve_dependencies(dependency_graph)
-    build_order = [meta for name in metas_name_order for meta in metas_to_build
-                   if meta.meta['package']['name'] == name]
+    build_order = cli.sort_build_order(metas_to_build)
 
     assert len(build_order) == 9
 
-    assert build_order[0].meta['package']['name'] == 'package-a'
-    assert build_order[6].meta['package']['name'] == 'package-b'
+    assert build_order[0].name == 'package-a'
+    assert build_order[6].name == 'package-b'
+
+
+def test_parallel_plan_matches_serial(examples_dir):
+    # Rendering the build names on a process pool should give back exactly
+    # the same plan, in the same order, as doing it one at a time
+    cli.init_logging()
+    python = ['2.7', '3.4', '3.5']
+    numpy = ['1.10', '1.11']
+    serial_build, serial_skip = cli.decide_what_to_build(
+        examples_dir, python, set(), numpy)
+    parallel_build, parallel_skip = cli.decide_what_to_build(
+        examples_dir, python, set(), numpy, plan_jobs=4)
+
+    assert ([meta.build_name for meta in serial_build] ==
+            [meta.build_name for meta in parallel_build])
+    assert ([meta.build_command for meta in serial_build] ==
+            [meta.build_command for meta in parallel_build])
+    assert serial_skip == parallel_skip == []
+
+
+def test_warm_build_name_cache(examples_dir, tmpdir, monkeypatch):
+    # A second plan of the same recipes should come entirely from the cache
+    # and match the first one
+    cli.init_logging()
+    python = ['2.7', '3.5']
+    numpy = ['1.11']
+    names = cli.BuildNameCache(str(tmpdir))
+    cold, _ = cli.decide_what_to_build(examples_dir, python, set(), numpy,
+                                       build_name_cache=names)
+    assert len(os.listdir(str(tmpdir))) == len(cold)
+
+    def explode(*args):
+        raise AssertionError("Should not have rendered %s" % (args, ))
+    monkeypatch.setattr(cli, '_render_variant', explode)
+    warm, _ = cli.decide_what_to_build(examples_dir, python, set(), numpy,
+                                       build_name_cache=names)
+    assert ([meta.build_name for meta in cold] ==
+            [meta.build_name for meta in warm])
+
+
+def test_build_name_cache_reuses_recipe_hashes(examples_dir, tmpdir,
+                                               monkeypatch):
+    # run() has hashed every recipe for the checkpoint already
+    cli.init_logging()
+    recipe_hashes = dict((recipe_dir, cli.hash_recipe_dir(recipe_dir))
+                         for recipe_dir in cli.find_recipe_dirs(examples_dir))
+    names = cli.BuildNameCache(str(tmpdir))
+    cold, _ = cli.decide_what_to_build(examples_dir, ['3.5'], set(), ['1.11'],
+                                       build_name_cache=names)
+
+    def explode(recipe_dir):
+        raise AssertionError("Should not have hashed %s" % recipe_dir)
+    monkeypatch.setattr(cli, 'hash_recipe_dir', explode)
+    warm, _ = cli.decide_what_to_build(examples_dir, ['3.5'], set(), ['1.11'],
+                                       build_name_cache=names,
+                                       recipe_hashes=recipe_hashes)
+    assert ([meta.build_name for meta in cold] ==
+            [meta.build_name for meta in warm])
+    assert len(os.listdir(str(tmpdir))) == len(cold)
+
+
+def test_build_name_is_cacheable(tmpdir):
+    recipe = tmpdir.mkdir('recipe')
+    meta = recipe.join('meta.yaml')
+    for text, cacheable in [
+            ('package:\n  name: a\n  version: 1\n', True),
+            ('source:\n  path: ./src\n', True),
+            ('source:\n  - path: src  # in the recipe\n', True),
+            ('package:\n  version: {{ GIT_DESCRIBE_TAG }}\n', False),
+            ("package:\n  version: {{ environ['VERSION'] }}\n", False),
+            ("package:\n  version: {{ environ.get('V', 1) }}\n", False),
+            ('source:\n  path: ../src\n', False),
+            ('source:\n  - path: "/abs/src"\n', False),
+            ('source:\n  path: {{ RECIPE_DIR }}/..\n', False)]:
+        meta.write(text)
+        assert cli._build_name_is_cacheable(str(recipe)) == cacheable, text
+
+
+def test_recipes_are_parsed_once(examples_dir, monkeypatch):
+    # Planning every variant of every recipe should only build one MetaData
+    # per recipe
+    cli.init_logging()
+    parsed = []
+    real_metadata = cli.MetaData
+
+    class CountingMetaData(real_metadata):
+        def __init__(self, path, *args, **kwargs):
+            parsed.append(path)
+            super(CountingMetaData, self).__init__(path, *args, **kwargs)
+
+    monkeypatch.setattr(cli, 'MetaData', CountingMetaData)
+    recipes = cli.load_recipes(examples_dir)
+    metas_to_build, _ = cli.decide_what_to_build(
+        examples_dir, ['2.7', '3.4', '3.5'], set(), ['1.10', '1.11'],
+        render_engine='subprocess', recipes=recipes)
+    assert len(metas_to_build) == 9
+    assert sorted(parsed) == sorted(recipe.recipe_dir for recipe in recipes)
+    # but each variant still gets its own build name
+    assert len(set(meta.build_name for meta in metas_to_build)) == 9
+
+
+def test_variants_are_compact(examples_dir):
+    # Variant records should not carry the MetaData around unless somebody
+    # asks for it
+    cli.init_logging()
+    metas_to_build, _ = cli.decide_what_to_build(
+        examples_dir, ['2.7'], set(), ['1.11'])
+    variant = [v for v in metas_to_build if v.name == 'package-a'][0]
+    assert not hasattr(variant, '__dict__')
+    assert variant._metadata is None
+    assert (variant.python, variant.numpy) == ('2.7', '1.11')
+    assert 'numpy x.x' in variant.build_deps
+    assert variant.build_command[:2] == ['conda', 'build']
+    # the full metadata is still there on demand
+    assert variant.meta['package']['name'] == 'package-a'
+    assert variant._metadata is not None
+
+
+def test_resolve_dependencies_order():
+    deps = {'a': ['b', 'c'], 'b': ['c'], 'c': ['d'], 'd': []}
+    assert list(cli.resolve_dependencies(deps)) == ['d', 'c', 'b', 'a']
+    # independent packages come out in sorted order
+    deps = {'z': [], 'y': [], 'x': ['z'], 'w': ['y', 'z']}
+    assert list(cli.resolve_dependencies(deps)) == ['y', 'z', 'w', 'x']
+
+
+def test_resolve_dependencies_reports_cycle():
+    deps = {'a': ['b'], 'b': ['c'], 'c': ['a'], 'd': [], 'e': ['a']}
+    with pytest.raises(ValueError) as excinfo:
+        list(cli.resolve_dependencies(deps))
+    assert 'a -> b -> c -> a' in str(excinfo.value)
+
+
+def test_resolve_dependencies_missing_package():
+    with pytest.raises(ValueError) as excinfo:
+        list(cli.resolve_dependencies({'a': ['b']}))
+    assert 'depends on b' in str(excinfo.value)
+
+
+def test_resolve_dependencies_large_graph():
+    # a long chain plus a wide fan out should sort without trouble
+    deps = {'pkg%05d' % i: ['pkg%05d' % (i - 1)] if i else []
+            for i in range(5000)}
+    deps.update({'leaf%05d' % i: ['pkg04999'] for i in range(5000)})
+    order = list(cli.resolve_dependencies(deps))
+    assert order[:5000] == sorted(k for k in deps if k.startswith('pkg'))
+    assert len(order) == 10000
+
+
+def variant(name, py, deps=(), npy='1.11', build_deps=('python', )):
+    # make a Variant record without going through conda
+    return cli.Variant(
+        name, '1', py, npy,
+        '/bld/linux-64/%s-1-np%spy%s_0.tar.bz2' % (name, npy, py),
+        ['conda', 'build', name], build_deps=build_deps, run_deps=deps)
+
+
+def test_sort_build_order_groups_by_name():
+    metas = [variant('b', '27', ['a']), variant('a', '27'),
+             variant('b', '35', ['a']), variant('c', '35'),
+             variant('a', '35')]
+    build_order = cli.sort_build_order(metas)
+    assert ([(meta.name, meta.python) for meta in build_order] ==
+            [('a', '27'), ('a', '35'), ('b', '27'), ('b', '35'), ('c', '35')])
+
+
+def test_variant_graph_links_matching_python():
+    numpy_build = ('python', 'numpy x.x')
+    metas = [variant('a', '27', npy='1.10', build_deps=numpy_build),
+             variant('a', '27', npy='1.11', build_deps=numpy_build),
+             variant('a', '35', npy='1.11', build_deps=numpy_build),
+             # b does not care about the numpy version
+             variant('b', '27', deps=['a']),
+             variant('b', '35', deps=['a']),
+             # c pins numpy too, so it only needs the matching build of a
+             variant('c', '35', deps=['a'], npy='1.11',
+                     build_deps=numpy_build),
+             # d is python agnostic, so every build of d needs it
+             variant('d', '35', build_deps=()),
+             variant('e', '27', deps=['d'])]
+    names = dict(((meta.name, meta.python, meta.numpy), meta.build_name)
+                 for meta in metas)
+    graph = cli.build_variant_graph(metas)
+    assert graph[names['a', '27', '1.10']] == []
+    assert (sorted(graph[names['b', '27', '1.11']]) ==
+            sorted([names['a', '27', '1.10'], names['a', '27', '1.11']]))
+    assert graph[names['b', '35', '1.11']] == [names['a', '35', '1.11']]
+    assert graph[names['c', '35', '1.11']] == [names['a', '35', '1.11']]
+    assert graph[names['e', '27', '1.11']] == [names['d', '35', '1.11']]
+    # and it can be sorted like the package graph
+    order = list(cli.resolve_dependencies(graph))
+    assert order.index(names['a', '35', '1.11']) < order.index(
+        names['b', '35', '1.11'])
@@ -0,0 +1,115 @@
+import os
+import time
+
+from buildmatrix import cache
+
+
+def test_hash_recipe_dir_tracks_contents(tmpdir):
+    recipe = tmpdir.mkdir('recipe')
+    recipe.join('meta.yaml').write('package:\n  name: a\n')
+    first = cache.hash_recipe_dir(str(recipe))
+    assert cache.hash_recipe_dir(str(recipe)) == first
+
+    recipe.join('build.sh').write('python setup.py install\n')
+    second = cache.hash_recipe_dir(str(recipe))
+    assert second != first
+
+    recipe.join('build.sh').write('python setup.py install --old\n')
+    assert cache.hash_recipe_dir(str(recipe)) not in (first, second)
+
+
+def test_build_name_cache_roundtrip(tmpdir):
+    names = cache.BuildNameCache(str(tmpdir))
+    key = names.key('abc', '/recipes/a', '3.5', '1.11', '1.11', '2.0.0')
+    assert names.get(key) is None
+    value = ('/bld/linux-64/a-1-py35_0.tar.bz2',
+             ['conda', 'build', '/recipes/a', '--python', '3.5'])
+    names.put(key, value)
+    assert names.get(key) == (value[0], value[1])
+    # and a fresh instance reads what the first one wrote
+    assert cache.BuildNameCache(str(tmpdir)).get(key) == (value[0], value[1])
+
+
+def test_build_name_cache_key_covers_variant():
+    names = cache.BuildNameCache('unused')
+    base = names.key('abc', '/recipes/a', '3.5', '1.11', '1.11', '2.0.0')
+    assert base != names.key('abc', '/recipes/a', '2.7', '1.11', '1.11',
+                             '2.0.0')
+    assert base != names.key('abc', '/recipes/a', '3.5', '1.10', '1.10',
+                             '2.0.0')
+    assert base != names.key('abd', '/recipes/a', '3.5', '1.11', '1.11',
+                             '2.0.0')
+    assert base != names.key('abc', '/recipes/a', '3.5', '1.11', '1.11',
+                             '2.0.1')
+    assert base != names.key('abc', '/recipes/a', '3.5', '1.11', '1.11',
+                             '2.0.0', croot='/elsewhere/conda-bld')
+
+
+def test_build_name_cache_evicts_least_recently_used(tmpdir):
+    names = cache.BuildNameCache(str(tmpdir), max_entries=2)
+    now = time.time()
+    for idx, key in enumerate(['a', 'b']):
+        names.put(key, (key, [key]))
+        os.utime(names._path(key), (now - 100 + idx, now - 100 + idx))
+    # reading 'a' makes 'b' the least recently used entry
+    assert names.get('a') is not None
+    names.put('c', ('c', ['c']))
+    assert names.get('b') is None
+    assert names.get('a') is not None
+    assert names.get('c') is not None
+
+
+def test_build_name_cache_counts_entries_once(tmpdir, monkeypatch):
+    names = cache.BuildNameCache(str(tmpdir), max_entries=5)
+    listings = []
+    listdir = os.listdir
+
+    def counting_listdir(path):
+        listings.append(path)
+        return listdir(path)
+    monkeypatch.setattr(cache.os, 'listdir', counting_listdir)
+    for key in 'abcd':
+        names.put(key, (key, [key]))
+    assert len(listings) == 1
+    # overwriting an entry does not make the cache any bigger
+    names.put('a', ('a', ['a']))
+    assert len(listings) == 1
+    for key in 'efg':
+        names.put(key, (key, [key]))
+    assert len(tmpdir.listdir()) == 5
+
+
+def test_build_history(tmpdir):
+    path = str(tmpdir.join('durations.json'))
+    history = cache.BuildHistory(path, smoothing=0.5)
+    key = history.key('a', '3.5', '1.11')
+    assert history.get(key) is None
+    history.record(key, 10)
+    history.record(key, 20)
+    assert history.get(key) == 15
+    history.save()
+    assert cache.BuildHistory(path).get(key) == 15
+
+
+def test_checkpoint_roundtrip(tmpdir):
+    path = str(tmpdir.join('checkpoint.jsonl'))
+    checkpoint = cache.Checkpoint(path)
+    assert checkpoint.load('key') == (None, {})
+    checkpoint.start('key', {'build': ['a', 'b']}, planned=['a', 'b'])
+    assert checkpoint.load('key')[1]['b'] == {'name': 'b', 'state': 'planned'}
+    checkpoint.set_state('a', checkpoint.BUILDING)
+    checkpoint.set_state('a', checkpoint.SUCCEEDED, artifact='/a.tar.bz2')
+    checkpoint.set_state('b', checkpoint.BUILDING)
+    # a run that dies half way through writing a line
+    with open(path, 'a') as f:
+        f.write('{"name": "b", "sta')
+    plan, states = cache.Checkpoint(path).load('key')
+    assert plan == {'build': ['a', 'b']}
+    assert states['a'] == {'name': 'a', 'state': 'succeeded',
+                           'artifact': '/a.tar.bz2'}
+    assert states['b']['state'] == 'building'
+    # a checkpoint for other recipes or options is not used
+    assert checkpoint.load('other key') == (None, {})
+    # and starting again forgets the old states
+    checkpoint.start('key', {'build': []})
+    assert checkpoint.load('key') == ({'build': []}, {})
@@ -1,8 +1,12 @@
 from buildmatrix import cli
+from buildmatrix.index import IndexCache
 import pytest
 from contextlib import contextmanager
 import copy
 from os.path import join, sep, dirname
+from glob import glob
+import json
+import os
 import sys
 
 
@@ -54,3 +58,232 @@ def test_numpy_xx(argv, examples_dir):
     with temp_argv([recipe] + argv):
         cli.cli()
 
+
+
+@pytest.mark.skipif(cli.conda_build_api is None,
+                    reason="conda_build.api is not available")
+def test_render_engines_agree(examples_dir):
+    # The in-process render should give the same (path, cmd) contract as
+    # asking `conda build --output` in a subprocess
+    recipe = join(examples_dir, 'needs-numpy-at-compilation')
+    args = ('--python', '3.5', '--numpy', '1.11')
+    with cli.env_var('CONDA_NPY', '1.11'):
+        from_api = cli.determine_build_name(recipe, *args, engine='api')
+        from_subprocess = cli.determine_build_name(recipe, *args,
+                                                   engine='subprocess')
+    assert from_api == from_subprocess
+
+
+def test_render_api_rejects_unknown_args():
+    with pytest.raises(ValueError):
+        cli._conda_build_api_kwargs(['--no-test'])
+
+
+def test_get_package_index_multiple_channels(http_server, tmpdir):
+    # Builds can be on any of the channels. The first channel that has a
+    # build is the one that gets reported
+    def repodata(*filenames):
+        return json.dumps({'packages': {fn: {} for fn in filenames}}).encode()
+    http_server.files['/staging/linux-64/repodata.json'] = repodata(
+        'package-a-1-py35_0.tar.bz2')
+    http_server.files['/release/linux-64/repodata.json'] = repodata(
+        'package-a-1-py35_0.tar.bz2', 'package-a-1-py27_0.tar.bz2',
+        'unrelated-1-py27_0.tar.bz2')
+    staging = http_server.url + '/staging'
+    release = http_server.url + '/release'
+    packages = cli.get_package_index(
+        [staging, release], ['package-a'],
+        index_cache=IndexCache(str(tmpdir)), subdirs=['linux-64'])
+    assert (packages.channel_for('linux-64/package-a-1-py35_0.tar.bz2') ==
+            staging)
+    assert (packages.channel_for('linux-64/package-a-1-py27_0.tar.bz2') ==
+            release)
+    assert 'linux-64/unrelated-1-py27_0.tar.bz2' not in packages
+
+
+def test_recipe_subdirs(examples_dir, tmpdir):
+    # Only the subdirs that the recipes build into need their index fetched
+    noarch = tmpdir.mkdir('noarch-recipe')
+    noarch.join('meta.yaml').write(
+        'package:\n  name: c\n  version: 1\n'
+        'build:\n  noarch_python: True\n')
+    assert cli.Recipe(str(noarch)).subdir == 'noarch'
+    recipes = cli.load_recipes(examples_dir)
+    assert set(recipe.subdir for recipe in recipes) == {cli.native_subdir()}
+
+
+def test_recipe_resources(tmpdir):
+    recipe = tmpdir.mkdir('recipe')
+    recipe.join('meta.yaml').write(
+        'package:\n  name: big\n  version: 1\n'
+        'extra:\n  buildmatrix:\n    cpus: 16\n    memory: 16G\n')
+    assert cli.get_resources(str(recipe), cli.Recipe(str(recipe)).metadata.meta
+                             ) == (16, 16384)
+    # the sidecar file wins
+    recipe.join('buildmatrix.yaml').write('cpus: 4\nmemory: 512M\n')
+    built = cli.Recipe(str(recipe)).variant('3.5', '1.11', '/bld/x-1-0.tar.bz2',
+                                            ['conda', 'build'])
+    assert (built.cpus, built.memory) == (4, 512)
+    assert cli.build_env(['conda', 'build'], built.cpus)['CPU_COUNT'] == '4'
+    # and a recipe that does not say is left to the environment
+    assert 'CPU_COUNT' not in cli.build_env_vars(['conda', 'build'])
+
+
+def test_recipe_timeouts(tmpdir):
+    recipe = tmpdir.mkdir('recipe')
+    recipe.join('meta.yaml').write(
+        'package:\n  name: slow\n  version: 1\n'
+        'extra:\n  buildmatrix:\n    timeout: 2h\n')
+    built = cli.Recipe(str(recipe)).variant('3.5', '1.11', '/bld/x-1-0.tar.bz2',
+                                            ['conda', 'build'])
+    assert (built.timeout, built.output_timeout) == (7200, None)
+    recipe.join('buildmatrix.yaml').write('output_timeout: 90\n')
+    assert cli.get_timeouts(str(recipe)) == (None, 90)
+    assert cli.parse_duration('1.5m') == 90
+
+
+class PlannedRun(object):
+    # Runs `cli.run` on a plan that the test makes up. `plan` writes a tree of
+    # recipes and has `decide_what_to_build` return a Variant for each one,
+    # and `run_build` only records what it was asked to build in `built`,
+    # failing the builds that are in `failing`
+
+    def __init__(self, tmpdir, monkeypatch):
+        self.tmpdir = tmpdir
+        self.monkeypatch = monkeypatch
+        self.bld = tmpdir.mkdir('bld').mkdir('linux-64')
+        self.built = []
+        self.failing = set()
+        self.kwargs = {}
+        monkeypatch.setattr(cli, 'run_build', self.run_build)
+
+    def plan(self, names, tree='recipes', build_deps=None, run_deps=()):
+        recipes = self.tmpdir.mkdir(tree)
+        variants = []
+        for name in names:
+            recipes.mkdir(name).join('meta.yaml').write(
+                'package:\n  name: %s\n  version: 1\n' % name)
+            variants.append(cli.Variant(
+                name, '1', '3.5', '1.11',
+                str(self.bld.join('%s-1-0.tar.bz2' % name)),
+                ['conda', 'build', name],
+                build_deps=(build_deps or {}).get(name, ()),
+                run_deps=run_deps, recipe_dir=str(recipes.join(name))))
+        self.monkeypatch.setattr(cli, 'decide_what_to_build',
+                                 lambda *args, **kwargs: (variants, []))
+        self.kwargs = dict(recipes_path=str(recipes), python=['3.5'],
+                           channel=[str(self.tmpdir.join('channel'))],
+                           numpy=['1.11'],
+                           cache_dir=str(self.tmpdir.join('cache')))
+        return variants
+
+    def run_build(self, build_order, **kwargs):
+        results = {'build_success': [], 'build_or_test_failed': [],
+                   'build_timed_out': [], 'upstream_failed': []}
+        for meta in build_order:
+            self.built.append(meta.name)
+            failed = meta.name in self.failing
+            if kwargs.get('checkpoint') is not None:
+                kwargs['checkpoint'].set_state(
+                    meta.build_name, 'failed' if failed else 'succeeded')
+            results['build_or_test_failed' if failed else
+                    'build_success'].append(meta.build_name)
+        return results
+
+
+@pytest.fixture
+def planned_run(tmpdir, monkeypatch):
+    return PlannedRun(tmpdir, monkeypatch)
+
+
+def test_resume_skips_planning_and_finished_builds(planned_run, monkeypatch):
+    planned_run.plan('ab')
+    # a was built, b failed
+    planned_run.bld.join('a-1-0.tar.bz2').write('')
+    planned_run.failing.add('b')
+    with pytest.raises(SystemExit):
+        cli.run(**planned_run.kwargs)
+    assert planned_run.built == ['a', 'b']
+
+    def no_planning(*args, **kwargs):
+        raise AssertionError('the plan should come from the checkpoint')
+
+    monkeypatch.setattr(cli, 'decide_what_to_build', no_planning)
+    monkeypatch.setattr(cli, 'load_recipes', no_planning)
+    with pytest.raises(SystemExit):
+        cli.run(resume=True, **planned_run.kwargs)
+    assert planned_run.built == ['a', 'b', 'b']
+
+
+def test_checkpoint_per_recipe_tree(tmpdir, planned_run):
+    cache_dir = tmpdir.join('cache')
+    for count, tree in enumerate(('one', 'two')):
+        variant, = planned_run.plan([tree], tree=tree)
+        # a dry run does not start a checkpoint
+        with pytest.raises(SystemExit):
+            cli.run(dry_run=True, **planned_run.kwargs)
+        assert len(glob(str(cache_dir.join('checkpoints', '*')))) == count
+        cli.run(**planned_run.kwargs)
+    checkpoints = cache_dir.join('checkpoints').listdir()
+    assert len(checkpoints) == 2
+    # planned first, then whatever the build made of it
+    assert all('"planned"' in checkpoint.read() for checkpoint in checkpoints)
+    # and a dry run leaves them as they were
+    before = [checkpoint.read() for checkpoint in checkpoints]
+    plan_file = tmpdir.join('plan.json')
+    with pytest.raises(SystemExit):
+        cli.run(dry_run=True, plan_file=str(plan_file), **planned_run.kwargs)
+    assert [checkpoint.read() for checkpoint in checkpoints] == before
+    # the plan is the parsed meta.yaml, as before, and the Variant record
+    plan = json.loads(plan_file.read())
+    assert [dct['package'] for dct in plan] == [
+        {'name': 'two', 'version': 1}]
+    assert [cli.Variant.from_dict(dct['variant']).build_name
+            for dct in plan] == [variant.build_name]
+
+
+def test_preflight_finds_unsatisfiable_variants(tmpdir, monkeypatch,
+                                                planned_run):
+    from test_envs import fake_solver
+    conda, calls = fake_solver(tmpdir)
+    monkeypatch.setenv('PATH', dirname(conda) + ':' + os.environ['PATH'])
+    # a cannot be built, b needs a, and c is fine
+    planned_run.plan('abc', build_deps={'a': ['python', 'missing-lib'],
+                                        'b': ['python', 'a'],
+                                        'c': ['python', 'six']},
+                     run_deps=['python'])
+    kwargs = dict(planned_run.kwargs, preflight=True, preflight_jobs=4)
+    with pytest.raises(SystemExit) as exc:
+        cli.run(**kwargs)
+    assert exc.value.code == 1
+    assert planned_run.built == []
+    # the build environment of a is solved without python, which is in both
+    # b and c's, and a is left out of b's because it is built in the run
+    assert sorted(calls.read().splitlines()) == [
+        'missing-lib python 3.5*', 'python 3.5*', 'python 3.5* six']
+
+    with pytest.raises(SystemExit) as exc:
+        cli.run(keep_going=True, **kwargs)
+    assert exc.value.code == 1
+    assert planned_run.built == ['c']
+    # every run solves for itself
+    assert len(calls.read().splitlines()) == 6
+
+
+def test_no_recipes(tmpdir):
+    index_cache = IndexCache(str(tmpdir.join('index')))
+    assert len(cli.get_package_index(['anaconda'], ['a'], subdirs=[],
+                                     index_cache=index_cache)) == 0
+    with pytest.raises(SystemExit) as exc:
+        cli.run(str(tmpdir.mkdir('recipes')), ['3.5'], ['anaconda'], ['1.11'],
+                cache_dir=str(tmpdir.join('cache')))
+    assert exc.value.code == 0
+
+
+def test_warn_about_channels_that_do_not_exist(http_server, tmpdir, caplog):
+    index_cache = IndexCache(str(tmpdir.join('index')))
+    packages = cli.get_package_index([http_server.url + '/typo'], ['a'],
+                                     index_cache=index_cache,
+                                     subdirs=['linux-64', 'noarch'])
+    assert len(packages) == 0
+    assert 'Is it the right channel?' in caplog.text
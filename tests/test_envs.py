@@ -0,0 +1,129 @@
+import stat
+import sys
+import threading
+
+from buildmatrix import envs
+
+FAKE_CONDA = """#!{python}
+# `conda create --download-only ... --prefix PREFIX SPEC...` that writes down
+# the specs it was called with, and fails for the ones named 'missing'
+import sys, time
+args = sys.argv[1:]
+specs = args[args.index('--prefix') + 2:]
+with open({calls!r}, 'a') as f:
+    f.write(' '.join(specs) + '\\n')
+time.sleep(0.1)
+sys.exit('missing' in specs)
+"""
+
+
+def fake_conda(tmpdir):
+    calls = tmpdir.join('calls')
+    conda = tmpdir.join('conda')
+    conda.write(FAKE_CONDA.format(python=sys.executable, calls=str(calls)))
+    conda.chmod(conda.stat().mode | stat.S_IEXEC)
+    return str(conda), calls
+
+
+FAKE_SOLVER = """#!{python}
+# `conda create --dry-run --json ... --prefix PREFIX SPEC...` that links
+# version 1.0 of every spec, unless its name starts with 'missing'
+import json, sys
+args = sys.argv[1:]
+specs = args[args.index('--prefix') + 2:]
+with open({calls!r}, 'a') as f:
+    f.write(' '.join(specs) + '\\n')
+missing = [spec for spec in specs if spec.startswith('missing')]
+if missing:
+    print(json.dumps({{'exception_name': 'PackagesNotFoundError',
+                      'message': 'not found: ' + ' '.join(missing)}}))
+    sys.exit(1)
+print(json.dumps({{'success': True, 'dry_run': True, 'actions': {{'LINK': [
+    {{'name': spec.split()[0], 'version': '1.0', 'build_string': '0'}}
+    for spec in specs]}}}}))
+"""
+
+
+def fake_solver(tmpdir):
+    # in a folder of its own, so that it can go on the PATH
+    calls = tmpdir.join('solves')
+    conda = tmpdir.mkdir('solver').join('conda')
+    conda.write(FAKE_SOLVER.format(python=sys.executable, calls=str(calls)))
+    conda.chmod(conda.stat().mode | stat.S_IEXEC)
+    return str(conda), calls
+
+
+def test_packages_are_fetched_once(tmpdir):
+    conda, calls = fake_conda(tmpdir)
+    prefetcher = envs.Prefetcher(conda=conda)
+    specs = ['python 3.5*', 'numpy 1.11*']
+    threads = [threading.Thread(target=prefetcher.fetch, args=(specs, ))
+               for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert calls.read() == 'numpy 1.11* python 3.5*\n'
+    assert prefetcher.fetch(list(reversed(specs)))
+    assert len(calls.read().splitlines()) == 1
+    # failing is not fatal, the build says what is wrong
+    assert not prefetcher.fetch(['missing'])
+    # and the next fetch tries again, something may have changed since
+    assert not prefetcher.fetch(['missing'])
+    assert calls.read().splitlines()[1:] == ['missing', 'missing']
+
+
+def test_packages_are_fetched_in_the_background(tmpdir):
+    conda, calls = fake_conda(tmpdir)
+    prefetcher = envs.Prefetcher(jobs=2, conda=conda)
+    prefetcher.start([['a'], ['b'], [], ['a'], ['c']])
+    # waits for the background fetch instead of doing it again
+    assert prefetcher.fetch(['c'])
+    for specs in (['a'], ['b']):
+        prefetcher.fetch(specs)
+    assert sorted(calls.read().splitlines()) == ['a', 'b', 'c']
+
+
+def test_each_set_of_specs_is_solved_once(tmpdir):
+    conda, calls = fake_solver(tmpdir)
+    solver = envs.Solver(conda=conda)
+    specs = ['python 3.5*', 'six']
+    solutions = []
+    threads = [threading.Thread(
+        target=lambda: solutions.append(solver.solve(specs)))
+        for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert calls.read() == 'python 3.5* six\n'
+    assert solutions[0]['packages'] == ['python=1.0=0', 'six=1.0=0']
+    assert solutions[0]['unsatisfiable'] is None
+    assert all(solution == solutions[0] for solution in solutions)
+    assert solver.solve(list(reversed(specs))) == solutions[0]
+    assert solver.get(specs) == solutions[0]
+    assert len(calls.read().splitlines()) == 1
+    # a new run solves again, the channels may have changed
+    again = envs.Solver(conda=conda)
+    assert again.get(specs) is None
+    again.solve(specs)
+    assert len(calls.read().splitlines()) == 2
+
+
+def test_unsatisfiable_specs(tmpdir):
+    conda, calls = fake_solver(tmpdir)
+    solver = envs.Solver(conda=conda)
+    solution = solver.solve(['missing-lib >=2', 'six'])
+    assert solution['packages'] is None
+    assert 'missing-lib' in solution['unsatisfiable']
+
+
+def test_packages_are_fetched_from_solutions(tmpdir):
+    solver_conda, _ = fake_solver(tmpdir)
+    conda, calls = fake_conda(tmpdir)
+    solver = envs.Solver(conda=solver_conda)
+    prefetcher = envs.Prefetcher(conda=conda, solver=solver)
+    prefetcher.fetch(['python 3.5*'])
+    solver.solve(['six'])
+    prefetcher.fetch(['six'])
+    assert calls.read().splitlines() == ['python 3.5*', 'six=1.0=0']
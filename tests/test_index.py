@@ -0,0 +1,203 @@
+import json
+
+import pytest
+
+from buildmatrix import index
+
+
+def repodata(*filenames):
+    return json.dumps({
+        'info': {},
+        'packages': {fn: {'name': fn.rsplit('-', 2)[0]} for fn in filenames},
+    }).encode()
+
+
+def test_channel_urls(monkeypatch):
+    monkeypatch.setattr(index, 'Channel', None)
+    monkeypatch.setattr(index, 'normalize_urls', None)
+    assert (index.channel_urls('anaconda', 'linux-64') ==
+            ['https://conda.anaconda.org/anaconda/linux-64/'])
+    assert (index.channel_urls('http://example.com/chan/', 'noarch') ==
+            ['http://example.com/chan/noarch/'])
+
+
+def test_channel_urls_come_from_conda(monkeypatch):
+    class Channel(object):
+        # conda's, for a condarc with a channel alias and a token
+        def __init__(self, name):
+            self.name = name
+
+        def urls(self, with_credentials=False, subdirs=None):
+            assert with_credentials
+            if self.name == 'defaults':
+                return ['https://repo.example.com/pkgs/%s/%s' % (chan, subdir)
+                        for chan in ('main', 'free') for subdir in subdirs]
+            return ['https://conda.example.com/t/secret/%s/%s' % (
+                self.name, subdir) for subdir in subdirs]
+
+    monkeypatch.setattr(index, 'Channel', Channel)
+    assert index.channel_urls('defaults', 'noarch') == [
+        'https://repo.example.com/pkgs/main/noarch/',
+        'https://repo.example.com/pkgs/free/noarch/']
+    assert index.channel_urls('private', 'linux-64') == [
+        'https://conda.example.com/t/secret/private/linux-64/']
+
+
+def test_index_cache_leaves_tokens_out_of_the_cache(http_server, tmpdir):
+    http_server.files['/t/secret/chan/linux-64/repodata.json'] = repodata(
+        'a-1-py35_0.tar.bz2')
+    cached = index.IndexCache(str(tmpdir))
+    assert (cached.file_names(http_server.url + '/t/secret/chan',
+                              ['linux-64']) == {'linux-64/a-1-py35_0.tar.bz2'})
+    assert 'secret' not in ''.join(str(path) for path in tmpdir.visit())
+    assert 'secret' not in ''.join(path.read() for path in
+                                   tmpdir.visit('state.json'))
+
+
+def test_index_cache_ttl_and_revalidation(http_server, tmpdir):
+    http_server.files['/chan/linux-64/repodata.json'] = repodata(
+        'a-1-py35_0.tar.bz2')
+    channel = http_server.url + '/chan'
+
+    cached = index.IndexCache(str(tmpdir), ttl=3600)
+    assert (cached.file_names(channel, ['linux-64']) ==
+            {'linux-64/a-1-py35_0.tar.bz2'})
+    assert len(http_server.requests) == 1
+    # inside the ttl the server is not asked at all
+    cached.file_names(channel, ['linux-64'])
+    assert len(http_server.requests) == 1
+
+    # past the ttl the request is conditional and answered with a 304
+    stale = index.IndexCache(str(tmpdir), ttl=0)
+    assert (stale.file_names(channel, ['linux-64']) ==
+            {'linux-64/a-1-py35_0.tar.bz2'})
+    method, path, headers = http_server.requests[-1]
+    assert 'If-None-Match' in headers
+    assert len(http_server.requests) == 2
+
+    # and picks up changes on the channel
+    http_server.files['/chan/linux-64/repodata.json'] = repodata(
+        'a-1-py35_0.tar.bz2', 'b-1-py35_0.tar.bz2')
+    assert (stale.file_names(channel, ['linux-64']) ==
+            {'linux-64/a-1-py35_0.tar.bz2', 'linux-64/b-1-py35_0.tar.bz2'})
+
+
+def test_index_cache_scans_without_decoding(http_server, tmpdir,
+                                           monkeypatch):
+    http_server.files['/chan/linux-64/repodata.json'] = repodata(
+        'a-1-py35_0.tar.bz2')
+    channel = http_server.url + '/chan'
+    index.IndexCache(str(tmpdir)).file_names(channel, ['linux-64'])
+
+    json_loads = index.json.loads
+
+    def loads(data, *args, **kwargs):
+        # state.json is fine
+        assert 'packages' not in data, 'repodata was decoded'
+        return json_loads(data, *args, **kwargs)
+    monkeypatch.setattr(index.json, 'loads', loads)
+    for ttl in (3600, 0):
+        # a ttl hit and a 304
+        cached = index.IndexCache(str(tmpdir), ttl=ttl)
+        assert (set(cached.package_index(channel, ['linux-64'])) ==
+                {'linux-64/a-1-py35_0.tar.bz2'})
+    assert len(http_server.requests) == 2
+
+
+def test_index_cache_missing_subdir(http_server, tmpdir):
+    http_server.files['/chan/noarch/repodata.json'] = repodata(
+        'c-1-py_0.tar.bz2')
+    cached = index.IndexCache(str(tmpdir))
+    assert (cached.file_names(http_server.url + '/chan',
+                              ['linux-64', 'noarch']) ==
+            {'noarch/c-1-py_0.tar.bz2'})
+    assert cached.missing == {(http_server.url + '/chan', 'linux-64')}
+
+
+def test_index_cache_falls_back_to_stale_copy(http_server, tmpdir):
+    http_server.files['/chan/linux-64/repodata.json'] = repodata(
+        'a-1-py35_0.tar.bz2')
+    channel = http_server.url + '/chan'
+    index.IndexCache(str(tmpdir)).fetch(channel, 'linux-64')
+    http_server.shutdown()
+    http_server.server_close()
+    stale = index.IndexCache(str(tmpdir), ttl=0, timeout=1)
+    assert 'a-1-py35_0.tar.bz2' in stale.fetch(channel, 'linux-64')['packages']
+
+
+def test_package_index_only_keeps_wanted_names(http_server, tmpdir):
+    http_server.files['/chan/linux-64/repodata.json'] = repodata(
+        'a-1-py35_0.tar.bz2', 'a-2-py35_0.tar.bz2', 'numpy-1.11.1-py35_0.tar.bz2',
+        'scipy-0.18.1-np111py35_0.tar.bz2')
+    cached = index.IndexCache(str(tmpdir))
+    packages = cached.package_index(http_server.url + '/chan', ['linux-64'],
+                                    names=['a', 'not-on-the-channel'])
+    assert 'linux-64/a-1-py35_0.tar.bz2' in packages
+    assert 'linux-64/a-3-py35_0.tar.bz2' not in packages
+    assert 'linux-64/numpy-1.11.1-py35_0.tar.bz2' not in packages
+    assert set(packages.builds) == {'a'}
+    assert len(packages) == 2
+
+
+def test_package_name():
+    assert index.package_name('linux-64/package-a-1-np111py35_0.tar.bz2') == \
+        'package-a'
+    assert index.package_name('noarch/c-1.0-py_0.tar.bz2') == 'c'
+
+
+def test_package_index_merge_keeps_first_channel():
+    staging = index.PackageIndex(['a'])
+    staging.add('linux-64/a-1-py35_0.tar.bz2', 'staging')
+    release = index.PackageIndex(['a'])
+    release.add('linux-64/a-1-py35_0.tar.bz2', 'release')
+    release.add('linux-64/a-0.9-py35_0.tar.bz2', 'release')
+
+    merged = index.PackageIndex(['a'])
+    merged.update(staging)
+    merged.update(release)
+    assert merged.channel_for('linux-64/a-1-py35_0.tar.bz2') == 'staging'
+    assert merged.channel_for('linux-64/a-0.9-py35_0.tar.bz2') == 'release'
+    assert merged.channel_for('linux-64/a-0.8-py35_0.tar.bz2') is None
+
+
+def test_iter_repodata_file_names(tmpdir):
+    path = tmpdir.join('repodata.json')
+    path.write(json.dumps({
+        'info': {'subdir': 'linux-64'},
+        'packages': {
+            'a-b-1-py35_0.tar.bz2': {'fn': 'a-b-1-py35_0.tar.bz2',
+                                     'depends': ['c {1}', 'd "e": f']},
+            'c-2-0.tar.bz2': {}},
+        'packages.conda': {'d-1-0.conda': {}},
+        'removed': ['e-1-0.tar.bz2'],
+    }, indent=1))
+    assert (sorted(index.iter_repodata_file_names(str(path))) ==
+            ['a-b-1-py35_0.tar.bz2', 'c-2-0.tar.bz2', 'd-1-0.conda'])
+    tmpdir.join('empty.json').write('')
+    assert list(index.iter_repodata_file_names(
+        str(tmpdir.join('empty.json')))) == []
+
+
+def test_local_channel(tmpdir, monkeypatch):
+    channel = tmpdir.mkdir('channel')
+    channel.mkdir('linux-64').join('repodata.json').write(
+        repodata('a-1-py35_0.tar.bz2', 'b-1-py35_0.tar.bz2').decode())
+    for chan in (str(channel), 'file://' + str(channel)):
+        assert index.local_channel_path(chan) == str(channel)
+        packages = index.local_package_index(chan, ['linux-64', 'noarch'],
+                                             names=['a'])
+        assert 'linux-64/a-1-py35_0.tar.bz2' in packages
+        assert 'linux-64/b-1-py35_0.tar.bz2' not in packages
+        assert packages.channel_for('linux-64/a-1-py35_0.tar.bz2') == chan
+    assert index.local_channel_path('anaconda') is None
+    # a folder in the working directory is not mistaken for a channel name
+    monkeypatch.chdir(str(tmpdir))
+    assert index.local_channel_path('channel') is None
+    assert index.local_channel_path('./channel') == str(channel)
+    assert index.local_channel_path('../') == str(tmpdir.dirpath())
+    assert index.local_channel_path('https://example.com/chan') is None
+    # the index cache goes straight to the local files too
+    cached = index.IndexCache(str(tmpdir.join('cache')))
+    assert (cached.file_names(str(channel), ['linux-64']) ==
+            {'linux-64/a-1-py35_0.tar.bz2', 'linux-64/b-1-py35_0.tar.bz2'})
+    assert not tmpdir.join('cache').check()
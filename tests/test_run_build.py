@@ -0,0 +1,606 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+try:
+    from http.client import IncompleteRead
+except ImportError:
+    # python 2
+    from httplib import IncompleteRead
+
+from buildmatrix import artifacts, cli
+
+
+SCRIPT = """
+import sys, time
+log, name, seconds, status = sys.argv[1:]
+with open(log, 'a') as f:
+    f.write('start %s\\n' % name)
+time.sleep(float(seconds))
+with open(log, 'a') as f:
+    f.write('end %s\\n' % name)
+sys.exit(int(status))
+"""
+
+
+def fake_variant(log, name, seconds=0, status=0, py='3.5'):
+    # A Variant whose "build" is a short python script that logs when it
+    # starts and ends
+    cmd = [sys.executable, '-c', SCRIPT, str(log), name, str(seconds),
+           str(status)]
+    return cli.Variant(name, '1', py, '1.11',
+                       '/bld/linux-64/%s-1-py35_0.tar.bz2' % name, cmd)
+
+
+def events(log):
+    return log.read().split('\n')[:-1]
+
+
+def test_serial_build_keeps_order(tmpdir):
+    log = tmpdir.join('log')
+    build_order = [fake_variant(log, name) for name in 'cab']
+    results = cli.run_build(build_order, log_dir=str(tmpdir.join('builds')))
+    assert events(log) == ['start c', 'end c', 'start a', 'end a',
+                           'start b', 'end b']
+    assert results['build_success'] == sorted(
+        meta.build_name for meta in build_order)
+    assert results['build_or_test_failed'] == []
+
+
+def test_parallel_build_respects_dependencies(tmpdir):
+    log = tmpdir.join('log')
+    a = fake_variant(log, 'a', seconds=0.5)
+    b = fake_variant(log, 'b', seconds=0.5)
+    c = fake_variant(log, 'c', seconds=0.1)
+    graph = {a.build_name: [], b.build_name: [], c.build_name: [a.build_name]}
+    start = time.time()
+    results = cli.run_build([a, b, c], jobs=2, dependency_graph=graph,
+                            log_dir=str(tmpdir.join('builds')))
+    # a and b run side by side
+    assert time.time() - start < 1.5
+    log_events = events(log)
+    assert set(log_events[:2]) == {'start a', 'start b'}
+    assert log_events.index('start c') > log_events.index('end a')
+    assert len(results['build_success']) == 3
+
+
+def test_failed_build_with_allow_failures(tmpdir):
+    log = tmpdir.join('log')
+    build_order = [fake_variant(log, 'a', status=1), fake_variant(log, 'b')]
+    results = cli.run_build(build_order, allow_failures=True, jobs=2,
+                            log_dir=str(tmpdir.join('builds')))
+    assert results['build_or_test_failed'] == [build_order[0].build_name]
+    assert results['build_success'] == [build_order[1].build_name]
+
+
+def test_failed_build_stops_new_builds(tmpdir):
+    log = tmpdir.join('log')
+    a = fake_variant(log, 'a', status=1)
+    b = fake_variant(log, 'b')
+    with pytest.raises(SystemExit) as se:
+        cli.run_build([a, b], dependency_graph={b.build_name: [a.build_name]},
+                      jobs=2, log_dir=str(tmpdir.join('builds')))
+    assert se.value.code == 1
+    assert 'start b' not in events(log)
+
+
+def test_critical_path_goes_first(tmpdir):
+    log = tmpdir.join('log')
+    b = fake_variant(log, 'b')
+    a = fake_variant(log, 'a')
+    c = fake_variant(log, 'c')
+    graph = {c.build_name: [a.build_name]}
+    history = cli.BuildHistory(str(tmpdir.join('durations.json')))
+    for meta, seconds in ((a, 1), (b, 5), (c, 10)):
+        history.record(history.key(meta.name, meta.python, meta.numpy),
+                       seconds)
+    # b comes first in the build order, but a -> c is the longer chain
+    cli.run_build([b, a, c], dependency_graph=graph, history=history,
+                  log_dir=str(tmpdir.join('builds')))
+    assert [event for event in events(log) if event.startswith('start')] == [
+        'start a', 'start c', 'start b']
+    # and the new durations were folded in and saved
+    saved = cli.BuildHistory(str(tmpdir.join('durations.json')))
+    assert saved.get(saved.key('c', '3.5', '1.11')) < 10
+
+
+def test_longest_build_goes_first_without_dependencies(tmpdir):
+    log = tmpdir.join('log')
+    a = fake_variant(log, 'a')
+    b = fake_variant(log, 'b')
+    history = cli.BuildHistory(str(tmpdir.join('durations.json')))
+    history.record(history.key('a', '3.5', '1.11'), 1)
+    history.record(history.key('b', '3.5', '1.11'), 5)
+    cli.run_build([a, b], history=history, log_dir=str(tmpdir.join('builds')))
+    assert [event for event in events(log) if event.startswith('start')] == [
+        'start b', 'start a']
+
+
+def test_critical_path_lengths():
+    graph = {'a': [], 'b': ['a'], 'c': ['b'], 'd': []}
+    lengths = cli.critical_path_lengths(graph, {'d': 5}, default=2)
+    assert lengths == {'a': 6, 'b': 4, 'c': 2, 'd': 5}
+
+
+def test_builds_are_packed_into_the_cpu_budget(tmpdir):
+    log = tmpdir.join('log')
+    big = fake_variant(log, 'big', seconds=0.3)
+    big.cpus = 4
+    small = [fake_variant(log, name, seconds=0.3) for name in 'ab']
+    oversized = fake_variant(log, 'huge')
+    oversized.cpus = 8
+    cli.run_build([big] + small + [oversized], jobs=3, cpus=4,
+                  log_dir=str(tmpdir.join('builds')))
+    log_events = events(log)
+    # the big build has the machine to itself
+    assert log_events[:2] == ['start big', 'end big']
+    # then the small ones share it
+    assert set(log_events[2:4]) == {'start a', 'start b'}
+    # and the one that is bigger than the machine runs alone at the end
+    assert log_events[-2:] == ['start huge', 'end huge']
+
+
+def test_builds_are_packed_into_the_memory_budget(tmpdir):
+    log = tmpdir.join('log')
+    a = fake_variant(log, 'a', seconds=0.3)
+    b = fake_variant(log, 'b', seconds=0.3)
+    a.memory = b.memory = 3000
+    cli.run_build([a, b], jobs=2, memory=4000,
+                  log_dir=str(tmpdir.join('builds')))
+    assert events(log) == ['start a', 'end a', 'start b', 'end b']
+
+
+def test_distributed_build(tmpdir):
+    log = tmpdir.join('log')
+    a = fake_variant(log, 'a')
+    b = fake_variant(log, 'b')
+    bld = tmpdir.mkdir('bld').mkdir('linux-64')
+    # the package lands in the worker's conda-bld, wherever the
+    # coordinator's is
+    bld.join('a-1-py35_0.tar.bz2').write('package a')
+    queue = str(tmpdir.join('queue.db'))
+    # the workers can start before the coordinator has published anything
+    worker_results = []
+    workers = [threading.Thread(target=lambda: worker_results.append(
+        cli.run_worker(queue, poll_interval=0.05,
+                       log_dir=str(tmpdir.join('builds')),
+                       bld_dir=str(tmpdir.join('bld')))))
+        for _ in range(2)]
+    for worker in workers:
+        worker.start()
+    results = cli.run_distributed([a, b], queue, poll_interval=0.05,
+                                  dependency_graph={b.build_name:
+                                                    [a.build_name]})
+    for worker in workers:
+        worker.join()
+    assert events(log) == ['start a', 'end a', 'start b', 'end b']
+    assert results['build_success'] == sorted([a.build_name, b.build_name])
+    assert sum(len(r['build_success']) for r in worker_results) == 2
+    # the package was copied next to the queue
+    assert tmpdir.join('artifacts', a.build_name).read() == 'package a'
+
+
+def test_distributed_build_stops_on_failure(tmpdir):
+    log = tmpdir.join('log')
+    a = fake_variant(log, 'a', status=1)
+    b = fake_variant(log, 'b')
+    queue = str(tmpdir.join('queue.db'))
+    worker = threading.Thread(target=cli.run_worker, args=(queue, ),
+                              kwargs={'poll_interval': 0.05,
+                                      'log_dir': str(tmpdir.join('builds')),
+                                      'bld_dir': str(tmpdir.join('bld'))})
+    worker.start()
+    with pytest.raises(SystemExit):
+        cli.run_distributed([a, b], queue, poll_interval=0.05,
+                            dependency_graph={b.build_name: [a.build_name]})
+    worker.join()
+    assert 'start b' not in events(log)
+
+
+def test_workers_fetch_upstream_packages(tmpdir, monkeypatch):
+    indexed = []
+    monkeypatch.setattr(cli, 'update_local_index',
+                        lambda folders: indexed.extend(folders))
+    log = tmpdir.join('log')
+    a = fake_variant(log, 'a')
+    b = fake_variant(log, 'b')
+    # a was built on another machine and copied to the shared folder
+    tmpdir.mkdir('artifacts').mkdir('linux-64').join(
+        'a-1-py35_0.tar.bz2').write('package a')
+    # with a conda-bld somewhere else than the coordinator's
+    node = tmpdir.mkdir('node2').mkdir('linux-64')
+    queue = cli.WorkQueue(str(tmpdir.join('queue.db')))
+    queue.publish([{'build_name': meta.build_name,
+                    'command': meta.build_command,
+                    'full_build_path': meta.full_build_path}
+                   for meta in (a, b)], {b.build_name: [a.build_name]})
+    queue.claim()
+    queue.report(a.build_name, 0, artifact=str(tmpdir.join(
+        'artifacts', 'linux-64', 'a-1-py35_0.tar.bz2')))
+    results = cli.run_worker(str(tmpdir.join('queue.db')),
+                             poll_interval=0.05,
+                             log_dir=str(tmpdir.join('builds')),
+                             bld_dir=str(tmpdir.join('node2')))
+    assert results['build_success'] == [b.build_name]
+    assert node.join('a-1-py35_0.tar.bz2').read() == 'package a'
+    assert indexed == [str(node)]
+
+
+def test_workers_check_the_recipes(tmpdir):
+    recipe = tmpdir.mkdir('recipe')
+    recipe.join('meta.yaml').write('package:\n  name: a\n')
+    a = fake_variant(tmpdir.join('log'), 'a')
+    a.recipe_dir = str(recipe)
+    queue = cli.WorkQueue(str(tmpdir.join('queue.db')))
+    # what the coordinator publishes
+    queue.publish([{'build_name': a.build_name, 'command': a.build_command,
+                    'recipe_dir': a.recipe_dir,
+                    'recipe_hash': cli.hash_recipe_dir(a.recipe_dir)}], {})
+    # and the checkout on this worker is at another revision
+    recipe.join('meta.yaml').write('package:\n  name: a\n  version: 2\n')
+    results = cli.run_worker(str(tmpdir.join('queue.db')),
+                             poll_interval=0.05,
+                             log_dir=str(tmpdir.join('builds')),
+                             bld_dir=str(tmpdir.join('bld')))
+    assert results['build_or_test_failed'] == [a.build_name]
+    assert not tmpdir.join('log').check()
+    job, = queue.jobs()
+    assert 'not the same as on the coordinator' in job['output']
+
+
+def test_workers_report_builds_that_raise(tmpdir):
+    missing = cli.Variant('a', '1', '3.5', '1.11',
+                          str(tmpdir.join('a-1-py35_0.tar.bz2')),
+                          [str(tmpdir.join('no-such-command'))])
+    queue = str(tmpdir.join('queue.db'))
+    worker = threading.Thread(target=cli.run_worker, args=(queue, ),
+                              kwargs={'poll_interval': 0.05,
+                                      'log_dir': str(tmpdir.join('builds')),
+                                      'bld_dir': str(tmpdir.join('bld'))})
+    worker.start()
+    results = cli.run_distributed([missing], queue, poll_interval=0.05,
+                                  allow_failures=True)
+    worker.join()
+    assert results['build_or_test_failed'] == [missing.build_name]
+
+
+def test_run_logged_keeps_a_bounded_tail(tmpdir):
+    log_path = str(tmpdir.join('logs', 'chatty.log'))
+    cmd = [sys.executable, '-c',
+           'import sys\n'
+           'for i in range(1000): print(i)\n'
+           'sys.stderr.write("oops\\n")\n'
+           'sys.exit(3)']
+    returncode, tail, timed_out = cli.run_logged(cmd, log_path,
+                                                 tail_lines=5)
+    assert (returncode, timed_out) == (3, None)
+    assert tail.split() == ['996', '997', '998', '999', 'oops']
+    # the whole output, stdout and stderr, is in the log file
+    with open(log_path) as f:
+        lines = f.read().split()
+    assert lines[0] == '0'
+    assert len(lines) == 1001
+
+
+def test_build_output_goes_to_a_log_per_variant(tmpdir, caplog):
+    log = tmpdir.join('log')
+    a = fake_variant(log, 'a', status=1)
+    results = cli.run_build([a], allow_failures=True,
+                            log_dir=str(tmpdir.join('builds')))
+    assert results['build_or_test_failed'] == [a.build_name]
+    log_path = cli.build_log_path(str(tmpdir.join('builds')), a.build_name)
+    assert log_path == str(tmpdir.join('builds', 'linux-64', 'a-1-py35_0.log'))
+    assert os.path.exists(log_path)
+    assert log_path in caplog.text
+
+
+def test_hung_builds_are_killed(tmpdir):
+    log = tmpdir.join('log')
+    # a build that starts a child which would outlive it, then hangs
+    hung = fake_variant(log, 'hung')
+    hung.build_command = [
+        sys.executable, '-c',
+        'import subprocess, sys, time\n'
+        'subprocess.Popen([sys.executable, "-c", "import time; '
+        'time.sleep(60)"])\n'
+        'print("working")\n'
+        'sys.stdout.flush()\n'
+        'time.sleep(60)']
+    quick = fake_variant(log, 'quick')
+    start = time.time()
+    results = cli.run_build([hung, quick], allow_failures=True,
+                            output_timeout=0.5,
+                            log_dir=str(tmpdir.join('builds')))
+    # the orphaned grandchild does not keep the pipe (and the run) open
+    assert time.time() - start < 20
+    assert results['build_timed_out'] == [hung.build_name]
+    assert results['build_or_test_failed'] == []
+    assert results['build_success'] == [quick.build_name]
+
+
+def test_limits_hold_after_the_build_exits(tmpdir, monkeypatch):
+    # the build exits right away, but leaves a child holding its output
+    cmd = [sys.executable, '-c',
+           'import subprocess, sys\n'
+           'subprocess.Popen([sys.executable, "-c", "import time; '
+           'time.sleep(60)"])']
+    start = time.time()
+    returncode, tail, timed_out = cli.run_logged(
+        cmd, str(tmpdir.join('timeout.log')), output_timeout=1)
+    assert time.time() - start < 20
+    assert timed_out == 'no output for 1s'
+    # and without limits, what it leaves running is killed after a while
+    monkeypatch.setattr(cli, 'DEFAULT_LEFTOVER_GRACE', 0.5)
+    start = time.time()
+    returncode, tail, timed_out = cli.run_logged(
+        cmd, str(tmpdir.join('leftover.log')))
+    assert time.time() - start < 20
+    assert (returncode, timed_out) == (0, None)
+
+
+def test_limits_hold_after_the_output_is_closed(tmpdir):
+    cmd = ['sh', '-c', 'echo hi; exec >&- 2>&-; sleep 30']
+    start = time.time()
+    returncode, tail, timed_out = cli.run_logged(
+        cmd, str(tmpdir.join('closed.log')), timeout=1)
+    assert time.time() - start < 20
+    assert timed_out == 'took longer than 1s'
+    assert returncode != 0
+
+
+def test_recipe_timeout_beats_the_default(tmpdir):
+    slow = fake_variant(tmpdir.join('log'), 'slow', seconds=30)
+    slow.timeout = 0.5
+    start = time.time()
+    results = cli.run_build([slow], allow_failures=True, timeout=600,
+                            log_dir=str(tmpdir.join('builds')))
+    assert time.time() - start < 20
+    assert results['build_timed_out'] == [slow.build_name]
+    log_path = cli.build_log_path(str(tmpdir.join('builds')), slow.build_name)
+    with open(log_path) as f:
+        assert 'took longer than 0.5s' in f.read()
+
+
+def test_keep_going_skips_dependents_of_failures(tmpdir):
+    log = tmpdir.join('log')
+    a = fake_variant(log, 'a', status=1)
+    b = fake_variant(log, 'b')
+    c = fake_variant(log, 'c')
+    d = fake_variant(log, 'd', seconds=0.3)
+    graph = {b.build_name: [a.build_name], c.build_name: [b.build_name]}
+    checkpoint = cli.Checkpoint(str(tmpdir.join('checkpoint.jsonl')))
+    checkpoint.start('key', {})
+    results = cli.run_build([a, b, c, d], jobs=2, dependency_graph=graph,
+                            keep_going=True, checkpoint=checkpoint,
+                            log_dir=str(tmpdir.join('builds')))
+    started = [event for event in events(log) if event.startswith('start')]
+    assert sorted(started) == ['start a', 'start d']
+    assert results['build_or_test_failed'] == [a.build_name]
+    assert results['upstream_failed'] == sorted([b.build_name, c.build_name])
+    assert results['build_success'] == [d.build_name]
+    states = checkpoint.load('key')[1]
+    assert states[c.build_name] == {'name': c.build_name, 'state': 'skipped',
+                                    'upstream': a.build_name}
+
+
+def test_distributed_keep_going(tmpdir):
+    log = tmpdir.join('log')
+    a = fake_variant(log, 'a', status=1)
+    b = fake_variant(log, 'b')
+    c = fake_variant(log, 'c')
+    d = fake_variant(log, 'd')
+    queue = str(tmpdir.join('queue.db'))
+    worker = threading.Thread(target=cli.run_worker, args=(queue, ),
+                              kwargs={'poll_interval': 0.05,
+                                      'log_dir': str(tmpdir.join('builds')),
+                                      'bld_dir': str(tmpdir.join('bld'))})
+    worker.start()
+    results = cli.run_distributed(
+        [a, b, c, d], queue, poll_interval=0.05, keep_going=True,
+        dependency_graph={b.build_name: [a.build_name],
+                          c.build_name: [b.build_name]})
+    worker.join()
+    assert results['upstream_failed'] == sorted([b.build_name, c.build_name])
+    assert results['build_success'] == [d.build_name]
+    assert 'start b' not in events(log)
+    assert 'start c' not in events(log)
+
+
+def test_input_hashes_follow_upstream_changes(tmpdir):
+    recipes = tmpdir.mkdir('recipes')
+    variants = []
+    for name in 'ab':
+        recipes.mkdir(name).join('meta.yaml').write('package: %s\n' % name)
+        variant = fake_variant(tmpdir.join('log'), name)
+        variant.recipe_dir = str(recipes.join(name))
+        variants.append(variant)
+    a, b = variants
+    graph = {b.build_name: [a.build_name]}
+    first = cli.compute_input_hashes(variants, graph)
+    assert b.input_hash == first[b.build_name]
+    assert cli.compute_input_hashes(variants, graph) == first
+    recipes.join('a', 'meta.yaml').write('package: a\nbuild: 1\n')
+    second = cli.compute_input_hashes(variants, graph)
+    assert second[a.build_name] != first[a.build_name]
+    assert second[b.build_name] != first[b.build_name]
+
+
+def test_input_hashes_follow_new_releases(tmpdir):
+    from test_envs import FAKE_SOLVER
+    recipes = tmpdir.mkdir('recipes')
+    variants = []
+    for name in 'abc':
+        recipes.mkdir(name).join('meta.yaml').write('package: %s\n' % name)
+        variant = fake_variant(tmpdir.join('log'), name)
+        variant.recipe_dir = str(recipes.join(name))
+        variants.append(variant)
+    a, b, c = variants
+    a.build_deps = ['six']
+    b.build_deps = ['a']
+    c.build_deps = ['missing-lib']
+    graph = {b.build_name: [a.build_name]}
+    conda = tmpdir.join('conda')
+
+    def hashes(version):
+        conda.write(FAKE_SOLVER.replace("'1.0'", repr(version)).format(
+            python=sys.executable, calls=str(tmpdir.join('solves'))))
+        conda.chmod(0o755)
+        return cli.compute_input_hashes(variants, graph,
+                                        solver=cli.Solver(conda=str(conda)))
+
+    first = hashes('1.9')
+    # a new six changes a and what is built on top of it
+    second = hashes('1.10')
+    assert second[a.build_name] != first[a.build_name]
+    assert second[b.build_name] != first[b.build_name]
+    # and what cannot be solved is never restored
+    assert first[c.build_name] is None and c.input_hash is None
+
+
+def test_builds_are_stored_and_restored(tmpdir, monkeypatch):
+    a = fake_variant(tmpdir.join('log'), 'a')
+    a.full_build_path = str(tmpdir.join('bld', 'linux-64', 'a-1-0.tar.bz2'))
+    a.input_hash = 'abcdef'
+    # pretend that the build put the package there
+    tmpdir.join('bld', 'linux-64', 'a-1-0.tar.bz2').write('a', ensure=True)
+    store = cli.ArtifactStore(str(tmpdir.join('store')))
+    cli.run_build([a], artifact_store=store,
+                  log_dir=str(tmpdir.join('builds')))
+
+    os.remove(a.full_build_path)
+    indexed = []
+    monkeypatch.setattr(cli, 'update_local_index', lambda folders:
+                        indexed.extend(folders))
+    b = fake_variant(tmpdir.join('log'), 'b')
+    restored, remaining = cli.restore_artifacts([a, b], store)
+    assert (restored, remaining) == ([a], [b])
+    assert os.path.exists(a.full_build_path)
+    assert indexed == [str(tmpdir.join('bld', 'linux-64'))]
+
+
+def test_failed_push_is_not_fatal(tmpdir, monkeypatch):
+    a = fake_variant(tmpdir.join('log'), 'a')
+    a.full_build_path = str(tmpdir.join('bld', 'linux-64', 'a-1-0.tar.bz2'))
+    a.input_hash = 'abcdef'
+    tmpdir.join('bld', 'linux-64', 'a-1-0.tar.bz2').write('a', ensure=True)
+    remote = artifacts.HTTPArtifactCache('http://127.0.0.1:1')
+
+    def hang_up(url, data, length):
+        # not an IOError
+        raise IncompleteRead(b'')
+    monkeypatch.setattr(remote, '_put', hang_up)
+    store = cli.TieredArtifactCache(
+        cli.ArtifactStore(str(tmpdir.join('store'))), remote)
+    results = {}
+    thread = threading.Thread(target=lambda: results.update(cli.run_build(
+        [a], artifact_store=store, log_dir=str(tmpdir.join('builds')))))
+    thread.daemon = True
+    thread.start()
+    thread.join(30)
+    assert results['build_success'] == [a.build_name]
+
+
+def test_restore_from_a_shared_cache(tmpdir, http_server, monkeypatch):
+    monkeypatch.setattr(cli, 'update_local_index', lambda folders: None)
+    built = tmpdir.join('pkg.tar.bz2')
+    built.write('package')
+    remote = cli.remote_artifact_cache(http_server.url)
+    variants = []
+    for name in 'abc':
+        variant = fake_variant(tmpdir.join('log'), name)
+        variant.full_build_path = str(
+            tmpdir.join('bld', 'linux-64', '%s-1-0.tar.bz2' % name))
+        variant.input_hash = name * 6
+        variants.append(variant)
+    for variant in variants[:2]:
+        remote.put(variant.input_hash, str(built))
+    local = cli.ArtifactStore(str(tmpdir.join('store')))
+    restored, remaining = cli.restore_artifacts(
+        variants, cli.TieredArtifactCache(local, remote))
+    assert (restored, remaining) == (variants[:2], variants[2:])
+    assert all(os.path.exists(variant.full_build_path)
+               for variant in restored)
+
+
+def test_packages_are_prefetched(tmpdir):
+    from test_envs import fake_conda
+    conda, calls = fake_conda(tmpdir)
+    prefetcher = cli.Prefetcher(conda=conda)
+    build_order = []
+    for name, py in (('a', '3.5'), ('b', '3.5'), ('c', '2.7')):
+        variant = fake_variant(tmpdir.join('log'), name, py=py)
+        variant.build_deps = ('python', )
+        build_order.append(variant)
+    # a is not built yet, there is nothing to fetch for it
+    build_order[2].build_deps = ('python', 'a')
+    results = cli.run_build(build_order, jobs=3, prefetcher=prefetcher,
+                            log_dir=str(tmpdir.join('builds')))
+    assert len(results['build_success']) == 3
+    assert sorted(calls.read().splitlines()) == ['python 2.7*',
+                                                 'python 3.5*']
+
+
+def test_prefetch_uses_the_preflight_solutions(tmpdir):
+    from test_envs import fake_conda, fake_solver
+    solver_conda, solves = fake_solver(tmpdir)
+    conda, calls = fake_conda(tmpdir)
+    a = fake_variant(tmpdir.join('log'), 'a')
+    a.build_deps = ['python']
+    # b needs a, which is only there once it is built
+    b = fake_variant(tmpdir.join('log'), 'b')
+    b.build_deps = ['python', 'a']
+    solver = cli.Solver(conda=solver_conda)
+    assert cli.solve_environments([a, b], solver) == {}
+    prefetcher = cli.Prefetcher(conda=conda, solver=solver)
+    cli.run_build([a, b], dependency_graph={b.build_name: [a.build_name]},
+                  prefetcher=prefetcher, log_dir=str(tmpdir.join('builds')))
+    # a and b need the same packages from elsewhere, solved once
+    assert solves.read() == 'python 3.5*\n'
+    assert calls.read() == 'python=1.0=0\n'
+
+
+def test_cpu_count(tmpdir, monkeypatch):
+    monkeypatch.setenv('CPU_COUNT', '32')
+    out = tmpdir.join('cpu_count')
+    cmd = [sys.executable, '-c',
+           "import os, sys; open(sys.argv[1], 'a').write("
+           "os.environ.get('CPU_COUNT', 'unset') + '\\n')", str(out)]
+
+    def variant(name, cpus=None):
+        meta = cli.Variant(name, '1', '3.5', '1.11',
+                           '/bld/linux-64/%s-1-py35_0.tar.bz2' % name, cmd)
+        meta.cpus = cpus
+        return meta
+
+    # a serial build keeps what the user exported
+    cli.run_build([variant('a')], cpus=8, log_dir=str(tmpdir))
+    assert out.read() == '32\n'
+    # parallel builds share the cores, unless the recipe says
+    out.remove()
+    cli.run_build([variant('b'), variant('c', cpus=3)], jobs=2, cpus=8,
+                  log_dir=str(tmpdir))
+    assert sorted(out.read().split()) == ['3', '4']
+
+
+def test_big_build_is_not_starved(tmpdir):
+    # b needs every core and is on the critical path, behind a short a. The
+    # small builds should not keep taking the cores that a frees up
+    log = tmpdir.join('log')
+    a = fake_variant(log, 'a', seconds=0.1)
+    b = fake_variant(log, 'b')
+    b.cpus = 4
+    small = [fake_variant(log, 'c%s' % i, seconds=0.5) for i in range(6)]
+    history = cli.BuildHistory(str(tmpdir.join('durations.json')))
+    history.record(history.key('a', '3.5', '1.11'), 0.1)
+    history.record(history.key('b', '3.5', '1.11'), 100)
+    for meta in small:
+        history.record(history.key(meta.name, '3.5', '1.11'), 0.5)
+    graph = {b.build_name: [a.build_name]}
+    cli.run_build([a, b] + small, jobs=4, cpus=4, dependency_graph=graph,
+                  history=history, log_dir=str(tmpdir))
+    started = [event for event in events(log) if event.startswith('start')]
+    # a and three small ones, then b as soon as those are done
+    assert started.index('start b') == 4
@@ -0,0 +1,134 @@
+import time
+
+from buildmatrix import workqueue
+
+
+def job(name, priority=0):
+    return {'build_name': name, 'command': ['echo', name],
+            'env': {'CONDA_NPY': '1.11'}, 'priority': priority,
+            'full_build_path': '/bld/linux-64/%s.tar.bz2' % name}
+
+
+def test_claims_follow_dependencies(tmpdir):
+    queue = workqueue.WorkQueue(str(tmpdir.join('queue.db')))
+    assert not queue.is_done()
+    queue.publish([job('a'), job('b'), job('c')], {'c': ['a', 'b']})
+    first = queue.claim('w1')
+    assert first['build_name'] == 'a'
+    assert first['command'] == ['echo', 'a']
+    assert first['env'] == {'CONDA_NPY': '1.11'}
+    # a second worker (with its own connection) gets the next one
+    other = workqueue.WorkQueue(str(tmpdir.join('queue.db')))
+    assert other.claim('w2')['build_name'] == 'b'
+    # c waits for both
+    assert queue.claim('w1') is None
+    queue.report('a', 0, artifact='/artifacts/a.tar.bz2')
+    assert queue.claim('w1') is None
+    other.report('b', 0)
+    assert queue.claim('w1')['build_name'] == 'c'
+    assert not queue.is_done()
+    queue.report('c', 0)
+    assert queue.is_done()
+    jobs = queue.jobs()
+    assert [j['state'] for j in jobs] == ['succeeded'] * 3
+    assert jobs[0]['worker'] == 'w1'
+    assert jobs[0]['artifact'] == '/artifacts/a.tar.bz2'
+
+
+def test_priority_beats_order(tmpdir):
+    queue = workqueue.WorkQueue(str(tmpdir.join('queue.db')))
+    queue.publish([job('a', 1), job('b', 5)], {})
+    assert queue.claim()['build_name'] == 'b'
+
+
+def test_failure_blocks_dependents(tmpdir):
+    queue = workqueue.WorkQueue(str(tmpdir.join('queue.db')))
+    queue.publish([job('a'), job('b')], {'b': ['a']})
+    queue.claim()
+    queue.report('a', 1, output='boom')
+    assert queue.claim() is None
+    # b can never run, so there is nothing left to wait for
+    assert queue.is_done()
+    assert queue.jobs('failed')[0]['output'] == 'boom'
+
+
+def test_failure_blocks_the_whole_chain(tmpdir):
+    queue = workqueue.WorkQueue(str(tmpdir.join('queue.db')))
+    queue.publish([job('a'), job('b'), job('c'), job('d')],
+                  {'b': ['a'], 'c': ['b']})
+    queue.claim()
+    queue.report('a', 1)
+    assert not queue.is_done()
+    assert queue.claim()['build_name'] == 'd'
+    assert not queue.is_done()
+    queue.report('d', 0)
+    # c waits on b, which waits on the failed a
+    assert queue.counts() == {'failed': 1, 'pending': 2, 'succeeded': 1}
+    assert queue.is_done()
+
+
+def test_allow_failures_runs_dependents(tmpdir):
+    queue = workqueue.WorkQueue(str(tmpdir.join('queue.db')))
+    queue.publish([job('a'), job('b')], {'b': ['a']}, allow_failures=True)
+    queue.claim()
+    queue.report('a', 1)
+    assert not queue.is_done()
+    assert queue.claim()['build_name'] == 'b'
+
+
+def test_cancel_pending(tmpdir):
+    queue = workqueue.WorkQueue(str(tmpdir.join('queue.db')))
+    queue.publish([job('a'), job('b')], {})
+    queue.claim()
+    queue.cancel_pending()
+    assert queue.claim() is None
+    assert not queue.is_done()
+    queue.report('a', 0)
+    assert queue.is_done()
+    assert queue.counts() == {'succeeded': 1, 'cancelled': 1}
+
+
+def test_timed_out_counts_as_failed(tmpdir):
+    queue = workqueue.WorkQueue(str(tmpdir.join('queue.db')))
+    slow = dict(job('a'), timeout=60, output_timeout=10)
+    queue.publish([slow, job('b')], {'b': ['a']})
+    claimed = queue.claim()
+    assert (claimed['timeout'], claimed['output_timeout']) == (60, 10)
+    queue.report('a', -15, timed_out=True)
+    assert queue.counts() == {'timed out': 1, 'pending': 1}
+    assert queue.is_done()
+
+
+def test_builds_of_dead_workers_are_handed_out_again(tmpdir):
+    queue = workqueue.WorkQueue(str(tmpdir.join('queue.db')))
+    queue.publish([job('a')], {}, lease=0.2, max_attempts=2)
+    queue.claim('w1')
+    assert queue.heartbeat('a', 'w1')
+    assert queue.requeue_expired() == []
+    time.sleep(0.3)
+    # w1 died. The build is not stuck running
+    assert queue.requeue_expired() == ['a']
+    assert queue.counts() == {'pending': 1}
+    assert queue.claim('w2')['build_name'] == 'a'
+    # w1 was only slow, but w2 has it now
+    assert not queue.heartbeat('a', 'w1')
+    queue.report('a', 1, worker='w1')
+    assert queue.counts() == {'running': 1}
+    # w2 dies too, and that was the last attempt
+    time.sleep(0.3)
+    assert queue.requeue_expired() == ['a']
+    assert queue.counts() == {'failed': 1}
+    assert queue.is_done()
+    assert 'lost its worker 2 times' in queue.jobs('failed')[0]['output']
+
+
+def test_upstream_artifacts(tmpdir):
+    queue = workqueue.WorkQueue(str(tmpdir.join('queue.db')))
+    queue.publish([job('a'), job('b'), job('c'), job('d')],
+                  {'b': ['a'], 'c': ['b']})
+    for name in 'abd':
+        queue.claim()
+        queue.report(name, 0, artifact='/artifacts/%s.tar.bz2' % name)
+    assert queue.upstream_artifacts('c') == [('a', '/artifacts/a.tar.bz2'),
+                                             ('b', '/artifacts/b.tar.bz2')]
+    assert queue.upstream_artifacts('a') == []